@@ -0,0 +1,274 @@
+""" Asyncio collection engine for the acs-tools scripts.
+
+The collect functions of the scripts are synchronous. They are run against
+a PrefetchedClient which answers API calls from responses fetched before.
+Each call a collector makes that has not been fetched yet is recorded and
+stops the collector. All recorded calls of all projects are then fetched
+concurrently over one aiohttp session and the stopped collectors are run
+again, until every collector ran through. """
+
+import sys
+import json
+import time
+import asyncio
+import aiohttp
+from cs import CloudStackApiException, CloudStackException
+from cs.client import transform
+from cs._async import AIOCloudStack
+import acs_cache
+import acs_profile
+import acs_ratelimit
+
+CONCURRENCY = 50
+
+
+class AsyncClient(AIOCloudStack):
+    """ Async CloudStack client sharing one aiohttp session for all calls.
+    A semaphore limits the number of requests in flight, an optional
+    RateLimiter adapts the rate to API throttling. """
+
+    def __init__(
+            self, *args, concurrency=CONCURRENCY, limiter=None,
+            api_retries=0, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.concurrency = concurrency
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.limiter = limiter
+        self.api_retries = api_retries
+        self.http_session = None
+
+    async def __aenter__(self):
+        self.http_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                ssl=self._ssl_context(), limit=self.concurrency),
+            timeout=aiohttp.ClientTimeout(
+                sock_connect=self.timeout, sock_read=self.timeout))
+        return self
+
+    async def __aexit__(self, *args):
+        await self.http_session.close()
+
+    async def _request(self, command, **params):
+        if self.limiter is None:
+            return await self._send(command, **params)
+
+        attempt = 0
+        while True:
+            await self.limiter.acquire_async()
+            started = time.monotonic()
+            try:
+                data = await self._send(command, **params)
+            except CloudStackException as error:
+                retryable = acs_ratelimit.is_retryable(command, error)
+                self.limiter.release(
+                    time.monotonic() - started,
+                    throttled=acs_ratelimit.is_throttled(command, error))
+                if not retryable or attempt >= self.api_retries:
+                    raise
+                await asyncio.sleep(acs_ratelimit.BACKOFF * 2**attempt)
+                attempt = attempt + 1
+                continue
+            except BaseException:
+                self.limiter.release(time.monotonic() - started)
+                raise
+            self.limiter.release(time.monotonic() - started)
+            return data
+
+    async def _send(self, command, **params):
+        kind, params = self._prepare_request(command, **params)
+        transform(params)
+        self._sign(params)
+
+        async with self.semaphore:
+            started = time.monotonic()
+            handler = getattr(self.http_session, self.method)
+            try:
+                async with handler(
+                        self.endpoint, headers=self.headers,
+                        **{kind: params}) as response:
+                    body = await response.read()
+            except BaseException:
+                acs_profile.PROFILER.record_call(
+                    command, time.monotonic() - started, error=True)
+                raise
+            acs_profile.PROFILER.record_call(
+                command, time.monotonic() - started,
+                error=response.status != 200)
+
+        decode_started = time.monotonic()
+        try:
+            data = json.loads(body)
+        except ValueError as error:
+            raise CloudStackException(
+                f"HTTP {response.status} response from CloudStack",
+                f"{error}. Make sure endpoint URL {self.endpoint!r} "
+                "is correct.",
+                response=response) from error
+        finally:
+            acs_profile.PROFILER.record_response(
+                command, len(body), time.monotonic() - decode_started)
+
+        [key] = data.keys()
+        data = data[key]
+        if response.status != 200:
+            raise CloudStackApiException(
+                f"HTTP {response.status} response from CloudStack",
+                error=data,
+                response=response)
+        return data
+
+
+def call_key(command, params):
+    """ Key of one API call in the prefetched responses."""
+    return acs_cache.ResponseCache.make_key(None, command, params)
+
+
+class MissingResponse(Exception):
+    """ Raised by PrefetchedClient for calls not fetched yet."""
+
+
+class PrefetchedClient:
+    """ Synchronous stand-in for the CloudStack client answering calls
+    from prefetched responses. Calls without response are recorded in
+    missing and raise MissingResponse, answered calls in used. """
+
+    def __init__(self, responses):
+        self.responses = responses
+        self.missing = {}
+        self.used = set()
+
+    def __getattr__(self, command):
+        def handler(**params):
+            key = call_key(command, params)
+            if key not in self.responses:
+                self.missing[key] = (command, params)
+                raise MissingResponse(command)
+            response = self.responses[key]
+            self.used.add(key)
+            if isinstance(response, Exception):
+                raise response
+            return response
+
+        return handler
+
+
+async def fetch_call(client, responses, command, params):
+    """ Fetch one API call. For the first page of a paged call all other
+    pages are fetched as well. Failed calls are stored as exception, they
+    are raised when the collector makes the call. Connection errors are
+    stored as CloudStackException, so collectors handle failed calls the
+    same way as with the synchronous client. """
+
+    try:
+        response = await getattr(client, command)(**params)
+    except CloudStackException as error:
+        responses[call_key(command, params)] = error
+        return
+    except aiohttp.ClientError as error:
+        responses[call_key(command, params)] = CloudStackException(
+            f'{command} failed: {error}')
+        return
+    responses[call_key(command, params)] = response
+
+    if str(params.get("page", "")) != "1" or "pagesize" not in params:
+        return
+    pagesize = int(params["pagesize"])
+    last_page = -(-response.get("count", 0) // pagesize)
+    await asyncio.gather(*(
+        fetch_call(client, responses, command, dict(params, page=page))
+        for page in range(2, last_page + 1)))
+
+
+async def fetch_calls(cloudstack, calls, concurrency):
+    """ Fetch all calls concurrently. Returns the responses by call key. """
+
+    responses = {}
+    async with AsyncClient(
+            cloudstack.endpoint,
+            key=cloudstack.key,
+            secret=cloudstack.secret,
+            timeout=cloudstack.timeout,
+            method=cloudstack.method,
+            verify=cloudstack.verify,
+            cert=cloudstack.cert,
+            headers=cloudstack.headers,
+            concurrency=concurrency,
+            limiter=getattr(cloudstack, "limiter", None),
+            api_retries=getattr(cloudstack, "api_retries", 0)) as client:
+        await asyncio.gather(*(
+            fetch_call(client, responses, command, params)
+            for command, params in calls))
+    return responses
+
+
+def fetch_missing(cloudstack, missing, responses, concurrency):
+    """ Add the responses of the missing calls to responses. Calls found in
+    the response cache of cloudstack are not fetched again. """
+
+    cache = getattr(cloudstack, "cache", None)
+    scope = (cloudstack.endpoint, cloudstack.key)
+    calls = []
+    for key, (command, params) in missing.items():
+        cached = None
+        if cache is not None and acs_cache.is_cacheable(command):
+            cached = cache.get(scope, command, params)
+        if cached is not None:
+            responses[key] = cached
+        else:
+            calls.append((command, params))
+
+    try:
+        fetched = asyncio.run(fetch_calls(cloudstack, calls, concurrency))
+    except KeyboardInterrupt:
+        print('Interrupted, all pending API calls cancelled.',
+              file=sys.stderr)
+        sys.exit(130)
+
+    if cache is not None:
+        for command, params in calls:
+            response = fetched.get(call_key(command, params))
+            if acs_cache.is_cacheable(command) and isinstance(response, dict):
+                cache.put(scope, command, params, response)
+    responses.update(fetched)
+
+
+def iter_projects(collect, cloudstack, projects, concurrency=CONCURRENCY):
+    """ Generator yielding the records of collect(cloudstack, projectid) for
+    all projects, in the order of projects. The API calls of all projects
+    run concurrently on the asyncio engine.
+
+    The records of a project are yielded as soon as it is complete and all
+    projects before it were yielded, its responses are released then. A
+    response shared with a project still pending is fetched again. """
+
+    responses = {}
+    # Records of complete projects waiting for a project before them
+    project_records = {}
+    order = [project["id"] for project in projects]
+    position = 0
+    pending = order
+    while pending:
+        missing = {}
+        stopped = []
+        for projectid in pending:
+            client = PrefetchedClient(responses)
+            try:
+                records = list(collect(client, projectid))
+            except MissingResponse:
+                missing.update(client.missing)
+                stopped.append(projectid)
+                continue
+            for key in client.used:
+                responses.pop(key, None)
+            if projectid != order[position]:
+                project_records[projectid] = records
+                continue
+            yield from records
+            position = position + 1
+            while position < len(order) and order[position] in \
+                    project_records:
+                yield from project_records.pop(order[position])
+                position = position + 1
+        if stopped:
+            fetch_missing(cloudstack, missing, responses, concurrency)
+        pending = stopped
@@ -0,0 +1,158 @@
+""" Persistent cache for responses of read-only CloudStack API calls. """
+
+import os
+import json
+import time
+import zlib
+import sqlite3
+import hashlib
+import threading
+from cs.client import transform
+
+CACHE_FILE = os.path.join(
+    os.path.expanduser("~"), ".cache", "acs-tools", "responses.sqlite")
+CACHE_SIZE = 512 * 1024**2
+
+# Seconds a cached response stays valid.
+DEFAULT_TTL = 300
+COMMAND_TTLS = {
+    "listConfigurations": 3600,
+    "listHosts": 3600,
+    "listProjects": 3600,
+    "listUsers": 3600,
+}
+
+# List commands never cached, the incremental inventory sync needs their
+# current state.
+UNCACHED_COMMANDS = ("listEvents", "listAsyncJobs")
+
+# Stores between two removals of expired entries.
+EXPIRE_INTERVAL = 1000
+# Eviction shrinks the cache to this part of the maximum size, so it does
+# not run again on the next store.
+EVICT_TARGET = 0.9
+
+
+def is_cacheable(command):
+    """ Only responses of list commands are cached."""
+    return command.startswith("list") and command not in UNCACHED_COMMANDS
+
+
+class ResponseCache:
+    """ SQLite backed cache for API responses. Entries are keyed by endpoint,
+    API key, command and normalized parameters. They expire after the TTL
+    of their command, the least recently used entries are evicted when the
+    cache grows beyond max_size bytes. With refresh, cached entries are
+    ignored but new responses are still stored. """
+
+    def __init__(
+            self, path=CACHE_FILE, max_size=CACHE_SIZE, ttls=None,
+            refresh=False):
+        self.max_size = max_size
+        self.ttls = dict(COMMAND_TTLS, **(ttls or {}))
+        self.refresh = refresh
+        self.lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        columns = [
+            row[1] for row in
+            self.db.execute('PRAGMA table_info(responses)').fetchall()]
+        if columns and "expires" not in columns:
+            # Cache of an older version, the entries are just dropped.
+            self.db.execute('DROP TABLE responses')
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS responses ('
+            'key TEXT PRIMARY KEY, command TEXT, created REAL, '
+            'accessed REAL, expires REAL, size INTEGER, body BLOB)')
+        self.db.execute(
+            'CREATE INDEX IF NOT EXISTS responses_accessed '
+            'ON responses (accessed)')
+        self.db.execute(
+            'CREATE INDEX IF NOT EXISTS responses_expires '
+            'ON responses (expires)')
+        self.db.commit()
+        self.total_size = self.stored_size()
+        self.puts = 0
+
+    def stored_size(self):
+        """ Size of all stored responses in bytes."""
+        return self.db.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+
+    @staticmethod
+    def make_key(scope, command, params):
+        """ Key for one API call. The parameters are normalized the way the
+        cs client sends them."""
+        normalized = dict(params)
+        transform(normalized)
+        normalized = sorted(
+            (key.lower(), value) for key, value in normalized.items())
+        key_data = json.dumps([scope, command, normalized])
+        return hashlib.sha256(key_data.encode("utf-8")).hexdigest()
+
+    def ttl(self, command):
+        """ TTL in seconds for one command."""
+        return self.ttls.get(command, DEFAULT_TTL)
+
+    def get(self, scope, command, params):
+        """ Cached response or None."""
+        if self.refresh:
+            return None
+
+        key = self.make_key(scope, command, params)
+        now = time.time()
+        with self.lock:
+            row = self.db.execute(
+                'SELECT created, body FROM responses WHERE key = ?',
+                (key,)).fetchone()
+            if row is None or row[0] + self.ttl(command) < now:
+                return None
+            self.db.execute(
+                'UPDATE responses SET accessed = ? WHERE key = ?',
+                (now, key))
+            self.db.commit()
+
+        return json.loads(zlib.decompress(row[1]))
+
+    def put(self, scope, command, params, data):
+        """ Store one response. Expired entries are removed every
+        EXPIRE_INTERVAL stores, least recently used entries only when the
+        running total size exceeds max_size."""
+        key = self.make_key(scope, command, params)
+        body = zlib.compress(json.dumps(data).encode("utf-8"), 1)
+        now = time.time()
+        with self.lock:
+            row = self.db.execute(
+                'SELECT size FROM responses WHERE key = ?', (key,)).fetchone()
+            self.db.execute(
+                'INSERT OR REPLACE INTO responses '
+                '(key, command, created, accessed, expires, size, body) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (key, command, now, now, now + self.ttl(command), len(body),
+                 body))
+            self.total_size = (
+                self.total_size + len(body) - (row[0] if row else 0))
+            self.puts = self.puts + 1
+            if self.puts % EXPIRE_INTERVAL == 0 or \
+                    self.total_size > self.max_size:
+                self.evict(now)
+            self.db.commit()
+
+    def evict(self, now):
+        """ Remove expired entries and, if the cache is still larger than
+        max_size, the least recently used ones down to EVICT_TARGET. The
+        total is read from the database, other processes may share it."""
+        self.db.execute('DELETE FROM responses WHERE expires < ?', (now,))
+        self.total_size = self.stored_size()
+        if self.total_size <= self.max_size:
+            return
+
+        evict_keys = []
+        for key, size in self.db.execute(
+                'SELECT key, size FROM responses ORDER BY accessed'):
+            if self.total_size <= self.max_size * EVICT_TARGET:
+                break
+            evict_keys.append((key,))
+            self.total_size = self.total_size - size
+        self.db.executemany('DELETE FROM responses WHERE key = ?', evict_keys)
@@ -0,0 +1,335 @@
+""" Shared CloudStack API client for the acs-tools scripts. """
+
+import os
+import sys
+import time
+import atexit
+import argparse
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from cs import CloudStack, CloudStackException, read_config
+import acs_cache
+import acs_inventory
+import acs_profile
+import acs_ratelimit
+
+POOL_SIZE = 10
+RETRIES = 3
+ASYNC_CONCURRENCY = 50
+
+
+class PooledSession(requests.Session):
+    """ Session that keeps its connections open. The cs client closes its
+    session after every call, which would drop all kept-alive
+    connections. """
+
+    def __exit__(self, *args):
+        pass
+
+
+class Client(CloudStack):
+    """ CloudStack client answering list calls from a ResponseCache, if
+    one is set. All other calls pass the RateLimiter, throttled calls are
+    retried with backoff. Each call is recorded by acs_profile. """
+
+    cache = None
+    limiter = None
+    async_concurrency = 0
+    api_retries = RETRIES
+    current = threading.local()
+
+    def _request(self, command, **params):
+        if self.cache is None or not acs_cache.is_cacheable(command):
+            return self._limited_request(command, **params)
+
+        scope = (self.endpoint, self.key)
+        data = self.cache.get(scope, command, params)
+        if data is None:
+            data = self._limited_request(command, **params)
+            self.cache.put(scope, command, params, data)
+        else:
+            acs_profile.PROFILER.record_cached(command)
+        return data
+
+    def _limited_request(self, command, **params):
+        if self.limiter is None:
+            return self._timed_request(command, **params)
+
+        attempt = 0
+        while True:
+            self.limiter.acquire()
+            started = time.monotonic()
+            try:
+                data = self._timed_request(command, **params)
+            except CloudStackException as error:
+                retryable = acs_ratelimit.is_retryable(command, error)
+                self.limiter.release(
+                    time.monotonic() - started,
+                    throttled=acs_ratelimit.is_throttled(command, error))
+                if not retryable or attempt >= self.api_retries:
+                    raise
+                time.sleep(acs_ratelimit.BACKOFF * 2**attempt)
+                attempt = attempt + 1
+                continue
+            except BaseException:
+                self.limiter.release(time.monotonic() - started)
+                raise
+            self.limiter.release(time.monotonic() - started)
+            return data
+
+    def _timed_request(self, command, **params):
+        self.current.command = command
+        started = time.monotonic()
+        try:
+            data = super()._request(command, **params)
+        except BaseException:
+            acs_profile.PROFILER.record_call(
+                command, time.monotonic() - started, error=True)
+            raise
+        acs_profile.PROFILER.record_call(command, time.monotonic() - started)
+        return data
+
+    def _response_value(self, response, json=True):
+        started = time.monotonic()
+        try:
+            return super()._response_value(response, json)
+        finally:
+            acs_profile.PROFILER.record_response(
+                getattr(self.current, 'command', ''),
+                len(response.content),
+                time.monotonic() - started)
+
+
+def parse_ttl(value):
+    """ Parse a COMMAND=SECONDS option value."""
+
+    command, _, seconds = value.partition('=')
+    try:
+        return command, int(seconds)
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            f'invalid TTL "{value}", expected COMMAND=SECONDS')
+
+
+def add_arguments(parser, with_async=True, with_cache=True,
+                  with_inventory=True):
+    """ Add the API client options to an argument parser. Scripts without
+    per project queries pass with_async=False, they have no use for
+    --async. Scripts changing resources pass with_cache=False and
+    with_inventory=False, they must decide on current responses and make
+    calls the inventory cannot answer. ACS_TOOLS_CACHE is ignored for
+    them."""
+
+    group = parser.add_argument_group('API client')
+    group.add_argument(
+        '--api-timeout',
+        dest='api_timeout',
+        help='Timeout for each API call in seconds '
+             '(default: timeout from ~/.cloudstack.ini).',
+        type=int,
+        required=False)
+    group.add_argument(
+        '--api-retries',
+        dest='api_retries',
+        help=f'Number of retries for failed connections (default: {RETRIES}).',
+        type=int,
+        default=RETRIES,
+        required=False)
+    group.add_argument(
+        '--pool-size',
+        dest='pool_size',
+        help=f'Number of kept-alive HTTP connections (default: {POOL_SIZE}, '
+             'at least the number of workers).',
+        type=int,
+        default=POOL_SIZE,
+        required=False)
+    if with_async:
+        group.add_argument(
+            '--async',
+            dest='async_concurrency',
+            metavar='N',
+            help='Run the API calls for all projects on the asyncio engine '
+                 f'with up to N calls in flight (default: '
+                 f'{ASYNC_CONCURRENCY}). Requires aiohttp.',
+            type=int,
+            nargs='?',
+            const=ASYNC_CONCURRENCY,
+            default=0,
+            required=False)
+    group.add_argument(
+        '--max-rate',
+        dest='max_rate',
+        metavar='CALLS_PER_SECOND',
+        help='Maximum API calls per second (default: no limit until the '
+             'API throttles).',
+        type=float,
+        default=0,
+        required=False)
+    group.add_argument(
+        '--profile',
+        dest='profile',
+        metavar='PATH',
+        help='Write a JSON summary of the API calls per command and the time '
+             'per phase to PATH at the end, without PATH to stderr.',
+        nargs='?',
+        const='-',
+        required=False)
+    group.add_argument(
+        '--rate-report',
+        dest='rate_report',
+        help='Print the effective API call rate at the end.',
+        action='store_true',
+        required=False)
+
+    if with_inventory:
+        group = parser.add_argument_group('Inventory')
+        group.add_argument(
+            '--from-db',
+            dest='from_db',
+            metavar='PATH',
+            help='Read the resources from the inventory created by '
+                 'crawl_inventory.py instead of the API (default PATH: '
+                 f'{acs_inventory.INVENTORY_FILE}).',
+            nargs='?',
+            const=acs_inventory.INVENTORY_FILE,
+            required=False)
+
+    if not with_cache:
+        return
+    group = parser.add_argument_group('Response cache')
+    group.add_argument(
+        '--cache',
+        dest='cache',
+        help='Answer list calls from the response cache. Also enabled by '
+             'setting ACS_TOOLS_CACHE=1.',
+        action='store_true',
+        required=False)
+    group.add_argument(
+        '--no-cache',
+        dest='no_cache',
+        help='Do not use the response cache.',
+        action='store_true',
+        required=False)
+    group.add_argument(
+        '--refresh',
+        dest='refresh',
+        help='Ignore cached responses, but store the new ones.',
+        action='store_true',
+        required=False)
+    group.add_argument(
+        '--cache-file',
+        dest='cache_file',
+        help=f'Cache database (default: {acs_cache.CACHE_FILE}).',
+        default=acs_cache.CACHE_FILE,
+        required=False)
+    group.add_argument(
+        '--cache-size',
+        dest='cache_size',
+        help='Maximum size of the cache in MB '
+             f'(default: {acs_cache.CACHE_SIZE // 1024**2}).',
+        type=int,
+        default=acs_cache.CACHE_SIZE // 1024**2,
+        required=False)
+    group.add_argument(
+        '--cache-ttl',
+        dest='cache_ttls',
+        metavar='COMMAND=SECONDS',
+        help='TTL for the responses of one API command, can be given '
+             f'multiple times (default: {acs_cache.DEFAULT_TTL}s, 3600s for '
+             'projects, hosts, users and configurations).',
+        type=parse_ttl,
+        action='append',
+        default=[],
+        required=False)
+
+
+def create_session(pool_size=POOL_SIZE, retries=RETRIES):
+    """ Create a HTTP session with a pool of kept-alive connections.
+    Connection errors are retried with backoff, error responses are
+    retried by Client."""
+
+    retry = Retry(
+        total=retries,
+        connect=retries,
+        read=0,
+        status=0,
+        backoff_factor=acs_ratelimit.BACKOFF,
+        raise_on_status=False)
+    adapter = HTTPAdapter(
+        pool_connections=pool_size,
+        pool_maxsize=pool_size,
+        max_retries=retry)
+
+    session = PooledSession()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def report_rate(limiter, always=False):
+    """ Print the effective call rate, always or when calls were
+    throttled."""
+
+    if always or limiter.throttled:
+        print(limiter.summary(), file=sys.stderr)
+
+
+def use_cache(args):
+    """ Whether the response cache is enabled by options or environment."""
+
+    if args is None or not hasattr(args, 'cache_file') or \
+            getattr(args, 'no_cache', False):
+        return False
+    if getattr(args, 'cache', False):
+        return True
+    return os.environ.get('ACS_TOOLS_CACHE', '') not in ('', '0')
+
+
+def get_cloudstack(args=None):
+    """ Create a CloudStack client from ~/.cloudstack.ini using the options
+    added by add_arguments(). The client can be shared between threads."""
+
+    if getattr(args, 'profile', None) is not None:
+        atexit.register(acs_profile.PROFILER.report, args.profile)
+
+    if getattr(args, 'from_db', None) is not None:
+        if not os.path.exists(args.from_db):
+            sys.exit(f'Inventory {args.from_db} not found, '
+                     'run crawl_inventory.py first.')
+        # The inventory makes no API calls, there is no rate to limit,
+        # report or run concurrently.
+        for option, dest in (('--rate-report', 'rate_report'),
+                             ('--max-rate', 'max_rate'),
+                             ('--async', 'async_concurrency')):
+            if getattr(args, dest, None):
+                sys.exit(f'{option} cannot be used with --from-db.')
+        return acs_inventory.InventoryClient(args.from_db)
+
+    pool_size = max(
+        getattr(args, 'pool_size', POOL_SIZE),
+        getattr(args, 'workers', 1),
+        getattr(args, 'page_workers', 1))
+    retries = getattr(args, 'api_retries', RETRIES)
+
+    # Reads ~/.cloudstack.ini
+    config = read_config()
+    if getattr(args, 'api_timeout', None) is not None:
+        config["timeout"] = args.api_timeout
+
+    cloudstack = Client(session=create_session(pool_size, retries), **config)
+    cloudstack.async_concurrency = getattr(args, 'async_concurrency', 0)
+    cloudstack.api_retries = retries
+    cloudstack.limiter = acs_ratelimit.RateLimiter(
+        max(pool_size, cloudstack.async_concurrency),
+        getattr(args, 'max_rate', 0))
+    atexit.register(
+        report_rate, cloudstack.limiter, getattr(args, 'rate_report', False))
+    if use_cache(args):
+        cloudstack.cache = acs_cache.ResponseCache(
+            path=args.cache_file,
+            max_size=args.cache_size * 1024**2,
+            ttls=dict(args.cache_ttls),
+            refresh=args.refresh)
+    return cloudstack
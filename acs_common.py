@@ -0,0 +1,171 @@
+""" Helpers shared by the acs-tools scripts. """
+
+import sys
+import heapq
+from concurrent.futures import ThreadPoolExecutor
+from cs import CloudStackApiException
+
+PAGESIZE = 500
+
+# --by of the top rankings -> disk counters summed up
+TOP_COUNTERS = {
+    "iops": ("diskioread", "diskiowrite"),
+    "kbs": ("diskkbsread", "diskkbswrite"),
+    "read": ("diskkbsread",),
+    "write": ("diskkbswrite",),
+}
+
+
+def fetch_pages(cloudstack, command, result_key, pagesize=PAGESIZE, **params):
+    """ Generator yielding the records of a list API call. The records are
+    fetched page by page, the next page is only requested when the
+    previous one is consumed. """
+
+    page = 1
+    fetched = 0
+    while True:
+        container = getattr(cloudstack, command)(
+            page=page,
+            pagesize=pagesize,
+            **params)
+        records = container.get(result_key, [])
+        fetched = fetched + len(records)
+        yield from records
+        if not records or fetched >= container.get("count", 0):
+            return
+        page = page + 1
+
+
+def fetch_pages_concurrently(
+        cloudstack, command, result_key, pagesize=PAGESIZE, workers=1,
+        **params):
+    """ Generator yielding the records of a list API call. The first page
+    tells how many records exist, the remaining pages are then fetched by
+    a pool of worker threads sharing the API client. Records are yielded in
+    page order. With a single worker this is fetch_pages(). """
+
+    if workers <= 1:
+        yield from fetch_pages(
+            cloudstack, command, result_key, pagesize, **params)
+        return
+
+    container = getattr(cloudstack, command)(
+        page=1,
+        pagesize=pagesize,
+        **params)
+    records = container.get(result_key, [])
+    yield from records
+    if not records:
+        return
+
+    last_page = -(-container.get("count", 0) // pagesize)
+
+    def fetch_page(page):
+        page_container = getattr(cloudstack, command)(
+            page=page,
+            pagesize=pagesize,
+            **params)
+        return page_container.get(result_key, [])
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for page_records in executor.map(fetch_page, range(2, last_page + 1)):
+            yield from page_records
+
+
+def merge_duplicates(records, merge_key=None):
+    """ Removes records with duplicate ids in one pass, the first record
+    seen for an id is kept. With merge_key the values of this key of all
+    duplicates are collected as list in the kept record. """
+
+    merged_records = {}
+    for record in records:
+        kept_record = merged_records.get(record["id"])
+        if kept_record is None:
+            if merge_key is not None:
+                record[merge_key] = [record[merge_key]]
+            merged_records[record["id"]] = record
+        elif merge_key is not None:
+            kept_record[merge_key].append(record[merge_key])
+
+    return list(merged_records.values())
+
+
+def iter_projects(collect, cloudstack, projects, cross_project_query=False):
+    """ Generator yielding the records of collect(cloudstack, projectid) for
+    all projects.
+
+    With cross_project_query all projects are fetched at once with
+    projectid -1. If the API does not support this, it falls back to one
+    query per project.
+
+    If the client has an async_concurrency above 0, the queries per project
+    run concurrently on the asyncio engine of acs_async. """
+
+    if cross_project_query:
+        yielded = False
+        try:
+            for record in collect(cloudstack, "-1"):
+                yielded = True
+                yield record
+            return
+        except CloudStackApiException as error:
+            if yielded:
+                raise
+            print(
+                f'Cross project query failed ({error}), '
+                'falling back to one query per project.',
+                file=sys.stderr)
+
+    projects = sorted(projects, key=lambda key: key["name"])
+    concurrency = getattr(cloudstack, "async_concurrency", 0)
+    if concurrency > 0:
+        # Optional dependency aiohttp, only needed with --async.
+        import acs_async  # pylint: disable=import-outside-toplevel
+        yield from acs_async.iter_projects(
+            collect, cloudstack, projects, concurrency)
+        return
+
+    for project in projects:
+        yield from collect(cloudstack, project["id"])
+
+
+def collect_projects(collect, cloudstack, projects, cross_project_query=False):
+    """ Runs collect(cloudstack, projectid) for all projects and returns
+    all records as one list. See iter_projects(). """
+
+    return list(iter_projects(
+        collect, cloudstack, projects, cross_project_query))
+
+
+def counter_sum(record, counters):
+    """ Sum of some disk counters of a record, counters without a number
+    like "n.a." count as 0. """
+
+    total = 0.0
+    for counter in counters:
+        try:
+            total = total + float(record[counter])
+        except (TypeError, ValueError):
+            pass
+    return total
+
+
+def top_records(records, count, key, group=None):
+    """ Selects the count records with the highest key(record) in one pass,
+    keeping a heap of at most count records per group(record). Records
+    are consumed one by one and never sorted as a whole. Returns a dict
+    group -> selected records in descending order, without group all
+    records are in group None. Of equal keys the first record wins. """
+
+    heaps = {}
+    for sequence, record in enumerate(records):
+        heap = heaps.setdefault(group(record) if group else None, [])
+        item = (key(record), -sequence, record)
+        if len(heap) < count:
+            heapq.heappush(heap, item)
+        else:
+            heapq.heappushpop(heap, item)
+
+    return {
+        name: [record for _, _, record in sorted(heap, reverse=True)]
+        for name, heap in heaps.items()}
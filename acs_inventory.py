@@ -0,0 +1,240 @@
+""" Local SQLite inventory of a CloudStack cloud.
+
+The inventory is filled by crawl_inventory.py. Each resource kind has its
+own table holding the complete API records as JSON next to indexed columns
+for the parameters the scripts filter on. InventoryClient answers the list
+calls of the scripts from these tables, see --from-db. """
+
+import os
+import json
+import sqlite3
+from cs import CloudStackException
+
+INVENTORY_FILE = os.path.join(
+    os.path.expanduser("~"), ".cache", "acs-tools", "inventory.sqlite")
+
+# Resource kind -> list command and response key
+KINDS = {
+    "project": ("listProjects", "project"),
+    "virtualmachine": ("listVirtualMachines", "virtualmachine"),
+    "volume": ("listVolumes", "volume"),
+    "snapshot": ("listSnapshots", "snapshot"),
+    "vmsnapshot": ("listVMSnapshot", "vmSnapshot"),
+    "network": ("listNetworks", "network"),
+    "router": ("listRouters", "router"),
+    "systemvm": ("listSystemVms", "systemvm"),
+    "template": ("listTemplates", "template"),
+    "iso": ("listIsos", "iso"),
+    "host": ("listHosts", "host"),
+    "user": ("listUsers", "user"),
+    "sshkeypair": ("listSSHKeyPairs", "sshkeypair"),
+    "configuration": ("listConfigurations", "configuration"),
+}
+
+# Resource kinds not owned by projects.
+GLOBAL_KINDS = ("project", "host", "user", "systemvm", "configuration")
+
+# Template filters crawled, each template is stored once per filter.
+TEMPLATE_FILTERS = [
+    "featured", "self", "selfexecutable", "sharedexecutable",
+    "executable", "community"]
+
+# API parameters answered by an indexed column of the same name.
+FILTER_COLUMNS = (
+    "id", "name", "state", "hostid", "virtualmachineid", "volumeid",
+    "domainid", "templatefilter")
+
+# Extra API commands answered from the tables.
+COMMAND_ALIASES = {
+    "listVirtualMachinesMetrics": "virtualmachine",
+    "listVolumesMetrics": "volume",
+}
+
+
+def record_key(kind, record, templatefilter=""):
+    """ Primary key of one record. SSH keypairs have no id, configurations
+    are identified by name. """
+
+    if kind == "template":
+        return f'{templatefilter}/{record["id"]}'
+    if "id" in record:
+        return record["id"]
+    return f'{record.get("projectid", "")}/{record["name"]}'
+
+
+def open_inventory(path=INVENTORY_FILE):
+    """ Open the inventory database, the tables are created if missing."""
+
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    db = sqlite3.connect(path)
+    for kind in list(KINDS) + ["nic"]:
+        db.execute(
+            f'CREATE TABLE IF NOT EXISTS {kind} ('
+            'key TEXT PRIMARY KEY, id TEXT, name TEXT, '
+            'projectid TEXT NOT NULL, state TEXT, hostid TEXT, '
+            'virtualmachineid TEXT, volumeid TEXT, domainid TEXT, '
+            'templatefilter TEXT, shared INTEGER, data TEXT)')
+        for column in ("projectid", "id", "virtualmachineid", "volumeid",
+                       "hostid"):
+            db.execute(
+                f'CREATE INDEX IF NOT EXISTS {kind}_{column} '
+                f'ON {kind} ({column})')
+    db.execute(
+        'CREATE TABLE IF NOT EXISTS crawl (name TEXT PRIMARY KEY, value TEXT)')
+    db.commit()
+    return db
+
+
+def record_row(kind, record, templatefilter="", shared=False):
+    """ Table row of one record. Shared records have no project, but are
+    listed for projects as well, like public templates. """
+
+    return (
+        record_key(kind, record, templatefilter),
+        record.get("id"),
+        record.get("name"),
+        record.get("projectid", ""),
+        record.get("state"),
+        record.get("hostid"),
+        record.get("virtualmachineid"),
+        record.get("volumeid"),
+        record.get("domainid"),
+        templatefilter,
+        int(shared),
+        json.dumps(record))
+
+
+def nic_rows(vm):
+    """ Rows of the nic table for one VM."""
+
+    for nic in vm.get("nic", []):
+        nic = dict(
+            nic,
+            virtualmachineid=vm["id"],
+            projectid=vm.get("projectid", ""))
+        yield record_row("nic", nic)
+
+
+def upsert_records(db, kind, records, templatefilter="", shared_keys=()):
+    """ Insert or update records of one kind. shared_keys are the keys of
+    shared records. The NICs of VMs are stored in the nic table as well. """
+
+    records = list(records)
+    rows = []
+    for record in records:
+        key = record_key(kind, record, templatefilter)
+        rows.append(record_row(
+            kind, record, templatefilter, key in shared_keys))
+    db.executemany(
+        f'INSERT OR REPLACE INTO {kind} VALUES (?,?,?,?,?,?,?,?,?,?,?,?)',
+        rows)
+    if kind == "virtualmachine":
+        db.executemany(
+            'DELETE FROM nic WHERE virtualmachineid = ?',
+            [(vm["id"],) for vm in records])
+        for vm in records:
+            db.executemany(
+                'INSERT OR REPLACE INTO nic VALUES (?,?,?,?,?,?,?,?,?,?,?,?)',
+                nic_rows(vm))
+
+
+def delete_records(db, kind, ids):
+    """ Delete records of one kind by id."""
+
+    ids = [(resource_id,) for resource_id in ids]
+    db.executemany(f'DELETE FROM {kind} WHERE id = ?', ids)
+    if kind == "virtualmachine":
+        db.executemany('DELETE FROM nic WHERE virtualmachineid = ?', ids)
+
+
+def replace_records(
+        db, kind, records, templatefilter=None, shared_keys=()):
+    """ Replace all records of one kind, or of one template filter."""
+
+    if templatefilter is None:
+        db.execute(f'DELETE FROM {kind}')
+        if kind == "virtualmachine":
+            db.execute('DELETE FROM nic')
+    else:
+        db.execute(
+            f'DELETE FROM {kind} WHERE templatefilter = ?', (templatefilter,))
+    upsert_records(db, kind, records, templatefilter or "", shared_keys)
+
+
+def get_value(db, name, default=None):
+    """ Value from the crawl table."""
+    row = db.execute(
+        'SELECT value FROM crawl WHERE name = ?', (name,)).fetchone()
+    return default if row is None else row[0]
+
+
+def set_value(db, name, value):
+    """ Store a value in the crawl table."""
+    db.execute(
+        'INSERT OR REPLACE INTO crawl VALUES (?, ?)', (name, str(value)))
+
+
+class InventoryClient:
+    """ Stand-in for the CloudStack client answering the list calls of the
+    scripts from the inventory. The projectid semantics of the API and the
+    filter parameters in FILTER_COLUMNS are translated to SQL, records are
+    returned in crawl order. Other parameters are ignored. """
+
+    async_concurrency = 0
+
+    def __init__(self, path=INVENTORY_FILE):
+        self.db = sqlite3.connect(
+            f'file:{path}?mode=ro', uri=True, check_same_thread=False)
+
+    def __getattr__(self, command):
+        def handler(**params):
+            return self.select(command, params)
+
+        return handler
+
+    def select(self, command, params):
+        """ Response of one list call."""
+
+        kind = COMMAND_ALIASES.get(command)
+        if kind is None:
+            kind = next((
+                kind for kind, (kind_command, _) in KINDS.items()
+                if kind_command == command), None)
+        if kind is None:
+            raise CloudStackException(
+                f'{command} is not available from the inventory.')
+        response_key = KINDS[kind][1]
+
+        conditions = []
+        values = []
+        projectid = params.get("projectid")
+        if kind not in GLOBAL_KINDS:
+            if projectid is None:
+                conditions.append("projectid = ''")
+            elif str(projectid) == "-1":
+                conditions.append("(projectid != '' OR shared = 1)")
+            else:
+                conditions.append("(projectid = ? OR shared = 1)")
+                values.append(str(projectid))
+        for column in FILTER_COLUMNS:
+            if column in params:
+                conditions.append(f"{column} = ?")
+                values.append(str(params[column]))
+        if "keyword" in params:
+            conditions.append("instr(name, ?) > 0")
+            values.append(str(params["keyword"]))
+        where = f' WHERE {" AND ".join(conditions)}' if conditions else ''
+
+        count = self.db.execute(
+            f'SELECT COUNT(*) FROM {kind}{where}', values).fetchone()[0]
+        if count == 0:
+            return {}
+
+        query = f'SELECT data FROM {kind}{where} ORDER BY rowid'
+        if "page" in params:
+            pagesize = int(params.get("pagesize", 500))
+            query = query + ' LIMIT ? OFFSET ?'
+            values = values + [pagesize, (int(params["page"]) - 1) * pagesize]
+        records = [
+            json.loads(data) for data, in self.db.execute(query, values)]
+        return {"count": count, response_key: records}
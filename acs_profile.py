@@ -0,0 +1,158 @@
+""" Instrumentation of the API calls and phases of the acs-tools scripts. """
+
+import sys
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+
+def percentile(sorted_values, fraction):
+    """ Nearest rank percentile of sorted values."""
+    if not sorted_values:
+        return 0.0
+    return sorted_values[round(fraction * (len(sorted_values) - 1))]
+
+
+class Profiler:
+    """ Counts and times the API calls per command and the time spent in
+    the phases of a script. Safe to use from several threads. """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.commands = {}
+        self.phases = {}
+        self.local = threading.local()
+
+    def command_stats(self, command):
+        """ Statistics of one command, must hold the lock."""
+        if command not in self.commands:
+            self.commands[command] = {
+                "latencies": [],
+                "errors": 0,
+                "cached": 0,
+                "bytes": 0,
+                "decode_time": 0.0,
+            }
+        return self.commands[command]
+
+    def record_call(self, command, latency, error=False):
+        """ Record one API call made."""
+        with self.lock:
+            stats = self.command_stats(command)
+            stats["latencies"].append(latency)
+            if error:
+                stats["errors"] = stats["errors"] + 1
+
+    def record_response(self, command, size, decode_time):
+        """ Record size and JSON decode time of one response."""
+        with self.lock:
+            stats = self.command_stats(command)
+            stats["bytes"] = stats["bytes"] + size
+            stats["decode_time"] = stats["decode_time"] + decode_time
+
+    def record_cached(self, command):
+        """ Record one call answered from the response cache."""
+        with self.lock:
+            stats = self.command_stats(command)
+            stats["cached"] = stats["cached"] + 1
+
+    @contextmanager
+    def phase(self, name):
+        """ Context manager adding the time spent in it to a phase. Time of
+        phases nested in it counts only to the nested phase."""
+        nested = self.nested_times()
+        nested.append(0.0)
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            elapsed = time.monotonic() - started
+            exclusive = elapsed - nested.pop()
+            if nested:
+                nested[-1] = nested[-1] + elapsed
+            with self.lock:
+                self.phases[name] = self.phases.get(name, 0.0) + exclusive
+
+    def nested_times(self):
+        """ Time of nested phases per open phase of this thread."""
+        if not hasattr(self.local, "nested"):
+            self.local.nested = []
+        return self.local.nested
+
+    def filtered(self, name, records, predicate):
+        """ Generator yielding the records predicate is true for. The time
+        spent in predicate counts to phase name, not to the phase
+        consuming the records."""
+        nested = self.nested_times()
+        spent = 0.0
+        try:
+            for record in records:
+                started = time.monotonic()
+                passed = predicate(record)
+                elapsed = time.monotonic() - started
+                spent = spent + elapsed
+                if nested:
+                    nested[-1] = nested[-1] + elapsed
+                if passed:
+                    yield record
+        finally:
+            with self.lock:
+                self.phases[name] = self.phases.get(name, 0.0) + spent
+
+    def summary(self):
+        """ Summary of all calls and phases as dict."""
+
+        with self.lock:
+            commands = {}
+            for command, stats in sorted(self.commands.items()):
+                latencies = sorted(stats["latencies"])
+                commands[command] = {
+                    "calls": len(latencies),
+                    "errors": stats["errors"],
+                    "cached": stats["cached"],
+                    "bytes": stats["bytes"],
+                    "decode_time": round(stats["decode_time"], 4),
+                    "latency_total": round(sum(latencies), 4),
+                    "latency_p50": round(percentile(latencies, 0.5), 4),
+                    "latency_p95": round(percentile(latencies, 0.95), 4),
+                    "latency_max": round(percentile(latencies, 1.0), 4),
+                }
+            phases = {
+                name: round(seconds, 4)
+                for name, seconds in self.phases.items()}
+
+        return {
+            "wall_time": round(time.monotonic() - self.started, 4),
+            "calls": sum(stats["calls"] for stats in commands.values()),
+            "bytes": sum(stats["bytes"] for stats in commands.values()),
+            "phases": phases,
+            "commands": commands,
+        }
+
+    def report(self, path="-"):
+        """ Write the summary as JSON to a file or, for "-", to stderr."""
+
+        summary = json.dumps(self.summary(), indent=2)
+        if path == "-":
+            print(summary, file=sys.stderr)
+        else:
+            with open(path, 'w') as outputfile:
+                outputfile.write(summary + '\n')
+
+
+PROFILER = Profiler()
+
+
+def phase(name):
+    """ Context manager timing a phase of the script, e.g. "collect",
+    "filter", "sort" or "write". With generators the API calls happen in
+    the phase consuming the records. """
+    return PROFILER.phase(name)
+
+
+def filtered(records, predicate):
+    """ Filter records lazily like filter(), timing predicate as phase
+    "filter" while the records are consumed. """
+    return PROFILER.filtered("filter", records, predicate)
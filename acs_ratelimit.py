@@ -0,0 +1,168 @@
+""" Adaptive rate limiting for the CloudStack API calls.
+
+A token bucket limits the calls per second, an AIMD limit the calls in
+flight. Throttled calls (HTTP 429, or 530 for read-only calls, as sent by
+api.throttling or a proxy in front of the management server) halve both.
+While the latency stays flat, the limits grow again by one step per window
+of calls. """
+
+import time
+import asyncio
+import threading
+
+THROTTLE_STATUS = 429
+# CloudStack's generic INTERNAL_ERROR, also used by api.throttling. Only
+# taken as throttling for read-only calls, a failed change is not retried.
+READ_THROTTLE_STATUS = 530
+READ_PREFIXES = ("list", "query")
+BACKOFF = 0.5
+LATENCY_TOLERANCE = 1.5
+MIN_RATE = 0.5
+POLL_INTERVAL = 0.01
+
+
+def error_status(error):
+    """ HTTP status or CloudStack error code of a failed API call."""
+
+    response = getattr(error, "response", None)
+    status = getattr(response, "status_code", getattr(response, "status", 0))
+    if status in (0, None, 200) and isinstance(getattr(error, "error", None),
+                                               dict):
+        status = error.error.get("errorcode", 0)
+    return status or 0
+
+
+def is_throttled(command, error):
+    """ The call was rejected by API throttling."""
+
+    status = error_status(error)
+    if status == THROTTLE_STATUS:
+        return True
+    return status == READ_THROTTLE_STATUS and command.startswith(
+        READ_PREFIXES)
+
+
+def is_retryable(command, error):
+    """ Throttled calls are retried, server errors only for read-only
+    calls."""
+
+    if is_throttled(command, error):
+        return True
+    return error_status(error) >= 500 and command.startswith(READ_PREFIXES)
+
+
+class RateLimiter:
+    """ Token bucket with AIMD adaptive concurrency, shared by all threads
+    and tasks making API calls. max_rate 0 means no limit on calls per
+    second until the API throttles. """
+
+    def __init__(self, max_concurrency, max_rate=0):
+        self.lock = threading.Lock()
+        self.max_concurrency = max_concurrency
+        self.limit = max_concurrency
+        self.in_flight = 0
+        self.max_rate = max_rate
+        self.rate = max_rate
+        self.tokens = 1.0
+        self.updated = time.monotonic()
+        self.base_latency = None
+        self.decreased = 0.0
+        self.successes = 0
+        self.started = time.monotonic()
+        self.calls = 0
+        self.throttled = 0
+
+    def reserve(self):
+        """ Take a slot and a token. Returns 0 on success, otherwise the
+        seconds to wait before trying again."""
+
+        with self.lock:
+            if self.in_flight >= self.limit:
+                return POLL_INTERVAL
+            if self.rate:
+                now = time.monotonic()
+                self.tokens = min(
+                    max(1.0, self.rate),
+                    self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens < 1:
+                    return (1 - self.tokens) / self.rate
+                self.tokens = self.tokens - 1
+            self.in_flight = self.in_flight + 1
+            self.calls = self.calls + 1
+            return 0
+
+    def acquire(self):
+        """ Wait for a slot and a token."""
+        wait = self.reserve()
+        while wait > 0:
+            time.sleep(wait)
+            wait = self.reserve()
+
+    async def acquire_async(self):
+        """ Wait for a slot and a token without blocking the event loop."""
+        wait = self.reserve()
+        while wait > 0:
+            await asyncio.sleep(wait)
+            wait = self.reserve()
+
+    def release(self, latency, throttled=False):
+        """ Free the slot of a finished call and adapt the limits."""
+
+        with self.lock:
+            self.in_flight = self.in_flight - 1
+            now = time.monotonic()
+
+            if throttled:
+                self.throttled = self.throttled + 1
+                self.successes = 0
+                # Calls in flight when the limit dropped are throttled as
+                # well, decrease only once per round trip.
+                if now - self.decreased < max(latency, BACKOFF):
+                    return
+                self.decreased = now
+                self.limit = max(1, self.limit // 2)
+                self.rate = max(
+                    MIN_RATE, (self.rate or self.current_rate()) / 2)
+                self.tokens = min(self.tokens, 1.0)
+                return
+
+            if self.base_latency is None or latency < self.base_latency:
+                self.base_latency = latency
+            else:
+                self.base_latency = 0.99 * self.base_latency + 0.01 * latency
+            if latency > self.base_latency * LATENCY_TOLERANCE:
+                return
+
+            self.successes = self.successes + 1
+            if self.successes < self.limit:
+                return
+            self.successes = 0
+            if self.limit < self.max_concurrency:
+                self.limit = self.limit + 1
+            if self.rate:
+                self.rate = self.rate + 1
+                if self.max_rate and self.rate >= self.max_rate:
+                    self.rate = self.max_rate
+                elif not self.max_rate and self.limit == self.max_concurrency:
+                    # Recovered, no rate limit needed any more.
+                    self.rate = 0
+
+    def current_rate(self):
+        """ Calls per second since the start."""
+        elapsed = time.monotonic() - self.started
+        return self.calls / elapsed if elapsed > 0 else 0.0
+
+    def summary(self):
+        """ One line summary of the calls made."""
+        elapsed = time.monotonic() - self.started
+        if self.rate:
+            rate_limit = f'{self.rate:.1f} calls/s'
+        else:
+            rate_limit = 'none'
+        return (
+            f'API calls: {self.calls} in {elapsed:.1f}s '
+            f'({self.current_rate():.1f} calls/s), '
+            f'{self.throttled} throttled, '
+            f'concurrency {self.limit}/{self.max_concurrency}, '
+            f'rate limit {rate_limit}')
@@ -0,0 +1,126 @@
+""" Compact records for the resources the scripts keep in memory.
+
+The API returns every VM, volume, NIC and snapshot as a dict with dozens of
+fields, while a report uses about a dozen of them. The collectors project
+each API record into one of these classes right away, so the API dict can
+be released. Records support record["field"] like the API dicts, fields
+missing in the API record are "n.a." unless DEFAULTS says otherwise. """
+
+
+class Record:
+    """ Base class of the records. Subclasses list their fields in
+    __slots__, the fields of base classes are inherited. """
+
+    __slots__ = ()
+    FIELDS = ()
+    # Field -> value used when the API record lacks the field
+    DEFAULTS = {}
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls.FIELDS = cls.FIELDS + tuple(cls.__dict__.get("__slots__", ()))
+
+    def __init__(self, record=None, **fields):
+        """ Project an API record, fields given as keywords take
+        precedence. """
+
+        if record is None:
+            record = {}
+        for name in self.FIELDS:
+            if name in fields:
+                value = fields[name]
+            else:
+                value = record.get(name, self.DEFAULTS.get(name, "n.a."))
+            setattr(self, name, value)
+
+    def __getitem__(self, name):
+        if name not in self.FIELDS:
+            raise KeyError(name)
+        return getattr(self, name)
+
+    def __setitem__(self, name, value):
+        if name not in self.FIELDS:
+            raise KeyError(name)
+        setattr(self, name, value)
+
+    def __contains__(self, name):
+        return name in self.FIELDS
+
+    def get(self, name, default=None):
+        """ Value of a field, default for unknown fields."""
+        if name not in self.FIELDS:
+            return default
+        return getattr(self, name)
+
+    def __repr__(self):
+        fields = ", ".join(
+            f'{name}={getattr(self, name)!r}' for name in self.FIELDS)
+        return f'{type(self).__name__}({fields})'
+
+
+class Nic(Record):
+    """ NIC of a VM, with domain, project and name of the VM."""
+
+    __slots__ = (
+        "id", "ipaddress", "macaddress", "isdefault", "networkname",
+        "networkid", "domain", "project", "vmname")
+
+
+class VirtualMachine(Record):
+    """ VM with its NICs. volumestotalsize and volumescount are filled in
+    by list_vms.py. """
+
+    __slots__ = (
+        "id", "name", "instancename", "state", "domain", "project",
+        "projectid", "hostname", "hostid", "cpunumber", "memory", "nic",
+        "volumestotalsize", "volumescount")
+    DEFAULTS = {"nic": ()}
+
+    def __init__(self, record=None, **fields):
+        super().__init__(record, **fields)
+        self.nic = tuple(Nic(nic) for nic in self.nic)
+
+
+class VirtualMachineStats(VirtualMachine):
+    """ VM with its cumulative disk counters."""
+
+    __slots__ = ("diskioread", "diskiowrite", "diskkbsread", "diskkbswrite")
+    DEFAULTS = {
+        "nic": (),
+        "diskioread": 0,
+        "diskiowrite": 0,
+        "diskkbsread": 0,
+        "diskkbswrite": 0,
+    }
+
+
+class VirtualMachineMetrics(VirtualMachineStats):
+    """ VM with the utilisation from listVirtualMachinesMetrics."""
+
+    __slots__ = (
+        "cpuused", "memoryintfreekbs", "networkkbsread", "networkkbswrite")
+
+
+class Volume(Record):
+    """ Volume with the VM it is attached to."""
+
+    __slots__ = (
+        "id", "name", "type", "domain", "project", "projectid", "vmname",
+        "virtualmachineid", "clustername", "hypervisor", "storage", "size",
+        "diskofferingname", "path")
+
+
+class VolumeStats(Volume):
+    """ Volume with its disk counters from listVolumesMetrics."""
+
+    __slots__ = ("diskioread", "diskiowrite", "diskkbsread", "diskkbswrite")
+
+
+class Snapshot(Record):
+    """ Volume or VM snapshot as listed by list_snapshots.py."""
+
+    __slots__ = (
+        "domain", "project", "vmname", "volname", "snapshot_name",
+        "vm_or_vol_snappy", "snapshot_state", "created", "virtualsize_gb",
+        "physicalsize_gb", "intervaltype", "revertable", "snapshottype",
+        "tags")
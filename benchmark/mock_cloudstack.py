@@ -0,0 +1,602 @@
+#!/usr/bin/python3
+
+""" Local stand-in for the CloudStack API serving a synthetic cloud. """
+
+import sys
+import json
+import random
+import argparse
+import calendar
+import textwrap
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+# API command -> (response key, inventory collection)
+COMMANDS = {
+    "listProjects": ("project", "project"),
+    "listVirtualMachines": ("virtualmachine", "virtualmachine"),
+    "listVirtualMachinesMetrics": ("virtualmachine", "virtualmachine"),
+    "listVolumes": ("volume", "volume"),
+    "listVolumesMetrics": ("volume", "volume"),
+    "listSnapshots": ("snapshot", "snapshot"),
+    "listVMSnapshot": ("vmSnapshot", "vmsnapshot"),
+    "listTemplates": ("template", "template"),
+    "listIsos": ("iso", "iso"),
+    "listNetworks": ("network", "network"),
+    "listRouters": ("router", "router"),
+    "listSystemVms": ("systemvm", "systemvm"),
+    "listHosts": ("host", "host"),
+    "listUsers": ("user", "user"),
+    "listSSHKeyPairs": ("sshkeypair", "sshkeypair"),
+    "listConfigurations": ("configuration", "configuration"),
+    "listEvents": ("event", "event"),
+    "listAsyncJobs": ("asyncjobs", "asyncjob"),
+}
+
+# Collections not owned by projects.
+GLOBAL_COLLECTIONS = (
+    "project", "host", "user", "configuration", "systemvm", "asyncjob")
+
+# Offset of the management server timezone to UTC in seconds. Event dates
+# are returned and startdate is read in this timezone, like CloudStack.
+UTC_OFFSET = 0
+
+# Parameter -> record field it filters on
+FIELD_FILTERS = {
+    "id": "id",
+    "vmsnapshotid": "id",
+    "virtualmachineid": "virtualmachineid",
+    "volumeid": "volumeid",
+    "state": "state",
+    "hostid": "hostid",
+}
+
+
+def prepare_arguments():
+    """ Parse commandline arguments."""
+
+    parser = argparse.ArgumentParser(
+        prog='mock_cloudstack.py',
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description=textwrap.dedent('''\
+        Local stand-in for the CloudStack API. Serves the list APIs used by
+        acs-tools for a synthetic cloud of configurable size.
+        '''),
+        epilog=textwrap.dedent('''\
+        Examples:
+
+        Serve a cloud with 100 projects of 50 VMs each:
+            ./mock_cloudstack.py --projects 100 --vms-per-project 50
+
+        Add 20ms latency to each call and throttle above 50 calls/s:
+            ./mock_cloudstack.py --latency 0.02 --throttle 50
+
+        Point the scripts to it:
+            export CLOUDSTACK_ENDPOINT=http://127.0.0.1:8089/client/api
+            export CLOUDSTACK_KEY=key CLOUDSTACK_SECRET=secret
+
+        Additional Infos:
+
+        The command "mockStats" returns the number of calls per API
+        command, "mockReset" resets them. "mockChurn" expunges and deploys
+        the given "count" of VMs and detaches a volume, with the events, to
+        exercise crawl_inventory.py --incremental. With --utc-offset the
+        server runs in another timezone than UTC.
+
+        '''))
+
+    parser.add_argument(
+        '--port',
+        dest='port',
+        help='Port to listen on (default: 8089).',
+        type=int,
+        default=8089,
+        required=False)
+    parser.add_argument(
+        '--projects',
+        dest='projects',
+        help='Number of projects (default: 10).',
+        type=int,
+        default=10,
+        required=False)
+    parser.add_argument(
+        '--vms-per-project',
+        dest='vms_per_project',
+        help='Number of VMs per project and without project (default: 10).',
+        type=int,
+        default=10,
+        required=False)
+    parser.add_argument(
+        '--volumes-per-vm',
+        dest='volumes_per_vm',
+        help='Maximum number of volumes per VM (default: 3).',
+        type=int,
+        default=3,
+        required=False)
+    parser.add_argument(
+        '--snapshots-per-volume',
+        dest='snapshots_per_volume',
+        help='Maximum number of snapshots per volume (default: 2).',
+        type=int,
+        default=2,
+        required=False)
+    parser.add_argument(
+        '--hosts',
+        dest='hosts',
+        help='Number of hypervisor hosts (default: 4).',
+        type=int,
+        default=4,
+        required=False)
+    parser.add_argument(
+        '--latency',
+        dest='latency',
+        help='Latency added to each call in seconds (default: 0).',
+        type=float,
+        default=0.0,
+        required=False)
+    parser.add_argument(
+        '--throttle',
+        dest='throttle',
+        help='Answer calls above this rate per second with HTTP 429 '
+             '(default: no throttling).',
+        type=int,
+        default=0,
+        required=False)
+    parser.add_argument(
+        '--utc-offset',
+        dest='utc_offset',
+        help='Timezone of the server as hours from UTC (default: 0).',
+        type=float,
+        default=0.0,
+        required=False)
+    parser.add_argument(
+        '--seed',
+        dest='seed',
+        help='Seed for the synthetic cloud (default: 1).',
+        type=int,
+        default=1,
+        required=False)
+
+    return parser.parse_args()
+
+
+def owned_by(record, project):
+    """ Add the project fields to a record of a project."""
+
+    if project is not None:
+        record["project"] = project["name"]
+        record["projectid"] = project["id"]
+    return record
+
+
+def build_cloud(
+        projects=10, vms_per_project=10, volumes_per_vm=3,
+        snapshots_per_volume=2, hosts=4, seed=1):
+    """ Build the inventory of a synthetic cloud. Resources without project
+    are generated like those of one project. """
+
+    rnd = random.Random(seed)
+    cloud = {key: [] for key in (
+        "project", "virtualmachine", "volume", "snapshot", "vmsnapshot",
+        "template", "iso", "network", "router", "systemvm", "host", "user",
+        "sshkeypair", "configuration", "event", "asyncjob")}
+
+    for host_number in range(hosts):
+        cloud["host"].append({
+            "id": f"host-{host_number}",
+            "name": f"host-{host_number}",
+            "type": "Routing",
+            "clustername": f"cluster-{host_number % 2}"})
+    cloud["host"].append({
+        "id": "host-ssvm", "name": "s-1-VM", "type": "SecondaryStorageVM"})
+    routing_hosts = cloud["host"][:hosts]
+
+    for project_number in range(projects):
+        cloud["project"].append({
+            "id": f"project-{project_number}",
+            "name": f"Project {project_number:05d}",
+            "domain": "ROOT",
+            "vmlimit": "Unlimited"})
+
+    public = {"domain": "ROOT", "tags": [], "_public": True}
+    cloud["network"].append(dict(
+        public, id="network-shared", name="shared", type="Shared",
+        state="Setup", restartrequired=False, cidr="192.168.0.0/16",
+        redundantrouter=False, vlan="100"))
+    for kind in ("template", "iso"):
+        cloud[kind].append(dict(
+            public, id=f"{kind}-public", name=f"{kind} public",
+            displaytext="public", ostypename="Linux", status="Ready",
+            size=2 * 1024**3, bootable=True, isdynamicallyscalable=False,
+            isextractable=True, isfeatured=True, ispublic=True, isready=True,
+            hypervisor="KVM", format="QCOW2", passwordenabled=False))
+
+    vm_number = 0
+    for project in [None] + cloud["project"]:
+        scope = project["id"] if project else "none"
+        network = owned_by({
+            "id": f"network-{scope}",
+            "name": f"network {scope}",
+            "type": "Isolated",
+            "state": "Implemented",
+            "restartrequired": False,
+            "cidr": "10.0.0.0/16",
+            "redundantrouter": rnd.random() < 0.5,
+            "domain": "ROOT"}, project)
+        cloud["network"].append(network)
+        cloud["router"].append(owned_by({
+            "id": f"router-{scope}",
+            "name": f"r-{scope}-VM",
+            "state": "Running",
+            "hostname": rnd.choice(routing_hosts)["name"],
+            "linklocalip": "169.254.0.1",
+            "guestnetworkname": network["name"],
+            "nic": [{"ipaddress": "10.0.0.1"}],
+            "isredundantrouter": False,
+            "redundantstate": "UNKNOWN"}, project))
+        cloud["sshkeypair"].append(owned_by({
+            "name": f"key-{scope}",
+            "domain": "ROOT",
+            "fingerprint": "00:11:22:33"}, project))
+        for kind in ("template", "iso"):
+            cloud[kind].append(owned_by({
+                "id": f"{kind}-{scope}", "name": f"{kind} {scope}",
+                "displaytext": kind, "ostypename": "Linux", "status": "Ready",
+                "size": 1024**3, "bootable": True,
+                "isdynamicallyscalable": False, "isextractable": True,
+                "isfeatured": False, "ispublic": False, "isready": True,
+                "tags": [], "domain": "ROOT", "hypervisor": "KVM",
+                "format": "QCOW2", "passwordenabled": False}, project))
+
+        for _ in range(vms_per_project):
+            vm_number = vm_number + 1
+            add_vm(cloud, rnd, vm_number, project, network, routing_hosts,
+                   volumes_per_vm, snapshots_per_volume)
+
+    cloud["systemvm"].append({
+        "id": "systemvm-1", "name": "s-1-VM",
+        "systemvmtype": "secondarystoragevm", "publicip": "192.0.2.1",
+        "state": "Running", "hostname": routing_hosts[0]["name"],
+        "linklocalip": "169.254.1.1"})
+    cloud["user"].append({
+        "id": "user-1", "username": "admin", "firstname": "Admin",
+        "lastname": "Admin", "domain": "ROOT", "account": "admin",
+        "created": "2020-01-01T00:00:00+0000"})
+    cloud["configuration"].extend([
+        {"name": "api.throttling.enabled", "value": "false"},
+        {"name": "default.page.size", "value": "500"}])
+    return cloud
+
+
+def add_vm(cloud, rnd, vm_number, project, network, routing_hosts,
+           volumes_per_vm, snapshots_per_volume):
+    """ Add one VM with NICs, volumes and snapshots to the cloud."""
+
+    host = rnd.choice(routing_hosts)
+    state = rnd.choice(["Running", "Running", "Stopped"])
+    vm = owned_by({
+        "id": f"vm-{vm_number}",
+        "name": f"vm-{vm_number:06d}",
+        "instancename": f"i-2-{vm_number}-VM",
+        "state": state,
+        "domain": rnd.choice(["ROOT", "Customers"]),
+        "cpunumber": rnd.choice([1, 2, 4]),
+        "memory": rnd.choice([1024, 2048, 4096]),
+        "diskioread": rnd.randint(0, 10**6),
+        "diskiowrite": rnd.randint(0, 10**6),
+        "diskkbsread": rnd.randint(0, 10**7),
+        "diskkbswrite": rnd.randint(0, 10**7),
+        "cpuused": f"{rnd.randint(0, 100)}%",
+        "memoryintfreekbs": rnd.randint(0, 10**6),
+        "networkkbsread": rnd.randint(0, 10**6),
+        "networkkbswrite": rnd.randint(0, 10**6),
+        "nic": [{
+            "id": f"nic-{vm_number}-{nic_number}",
+            "ipaddress": f"10.0.{vm_number // 250 % 250}.{vm_number % 250}",
+            "macaddress": f"02:00:{vm_number >> 16 & 255:02x}:"
+                          f"{vm_number >> 8 & 255:02x}:"
+                          f"{vm_number & 255:02x}:{nic_number:02x}",
+            "isdefault": nic_number == 0,
+            "networkname": network["name"] if nic_number == 0 else "shared",
+            "networkid": network["id"] if nic_number == 0
+                         else "network-shared",
+        } for nic_number in range(rnd.randint(1, 2))],
+        "tags": []}, project)
+    if state == "Running":
+        vm["hostname"] = host["name"]
+        vm["hostid"] = host["id"]
+    cloud["virtualmachine"].append(vm)
+
+    for disk_number in range(rnd.randint(1, max(1, volumes_per_vm))):
+        volume = owned_by({
+            "id": f"volume-{vm_number}-{disk_number}",
+            "name": f"{'ROOT' if disk_number == 0 else 'DATA'}-"
+                    f"{vm_number}-{disk_number}",
+            "type": "ROOT" if disk_number == 0 else "DATADISK",
+            "size": rnd.randint(1, 100) * 1024**3,
+            "domain": vm["domain"],
+            "hypervisor": "KVM",
+            "storage": f"pool-{disk_number % 2}",
+            "clustername": host["clustername"],
+            "diskofferingname": "small",
+            "path": f"{vm_number}-{disk_number}",
+            "virtualmachineid": vm["id"],
+            "vmname": vm["name"],
+            "diskioread": rnd.randint(0, 1000),
+            "diskiowrite": rnd.randint(0, 1000),
+            "diskkbsread": rnd.randint(0, 10**5),
+            "diskkbswrite": rnd.randint(0, 10**5)}, project)
+        cloud["volume"].append(volume)
+
+        for snapshot_number in range(rnd.randint(0, snapshots_per_volume)):
+            cloud["snapshot"].append(owned_by({
+                "id": f"snapshot-{volume['id']}-{snapshot_number}",
+                "name": f"{volume['name']}-{snapshot_number}",
+                "volumeid": volume["id"],
+                "domain": volume["domain"],
+                "state": "BackedUp",
+                "created": f"2024-01-{snapshot_number + 1:02d}T00:00:00+0000",
+                "virtualsize": volume["size"],
+                "physicalsize": volume["size"] // 2,
+                "intervaltype": "MANUAL",
+                "revertable": False,
+                "snapshottype": "MANUAL",
+                "tags": [],
+                "project": ""}, project))
+
+    if rnd.random() < 0.3:
+        cloud["vmsnapshot"].append(owned_by({
+            "id": f"vmsnapshot-{vm_number}",
+            "name": f"vmsnapshot-{vm_number}",
+            "virtualmachineid": vm["id"],
+            "domain": vm["domain"],
+            "state": "Ready",
+            "created": "2024-02-01T00:00:00+0000",
+            "physicalsize": 1234,
+            "tags": [],
+            "project": ""}, project))
+
+
+def server_time(timestamp):
+    """ A time in the timezone of the server, formatted like CloudStack."""
+
+    offset = abs(int(UTC_OFFSET)) // 60
+    sign = "-" if UTC_OFFSET < 0 else "+"
+    return (
+        time.strftime(
+            "%Y-%m-%dT%H:%M:%S", time.gmtime(timestamp + UTC_OFFSET)) +
+        f'{sign}{offset // 60:02d}{offset % 60:02d}')
+
+
+def add_event(cloud, event_type, record, resource_type):
+    """ Add a completed event about a record to the cloud."""
+
+    now = time.time()
+    project = None
+    if "projectid" in record:
+        project = {"id": record["projectid"], "name": record["project"]}
+    cloud["event"] = [owned_by({
+        "id": f"event-{len(cloud['event'])}",
+        "type": event_type,
+        "level": "INFO",
+        "state": "Completed",
+        "description": f"{event_type} {record['id']}",
+        "created": server_time(now),
+        "resourceid": record["id"],
+        "resourcetype": resource_type,
+        "_created": now}, project)] + cloud["event"]
+
+
+def churn(cloud, rnd, vm_number, count, volumes_per_vm, snapshots_per_volume):
+    """ Expunge and deploy count VMs and detach one data disk, recording
+    the events. Collections are replaced, not changed in place, so calls
+    served at the same time see a consistent state. Returns the last VM
+    number used. """
+
+    routing_hosts = [
+        host for host in cloud["host"] if host["type"] == "Routing"]
+    for _ in range(count):
+        vm = rnd.choice(cloud["virtualmachine"])
+        cloud["virtualmachine"] = [
+            record for record in cloud["virtualmachine"] if record is not vm]
+        cloud["volume"] = [
+            volume for volume in cloud["volume"]
+            if volume.get("virtualmachineid") != vm["id"]]
+        add_event(cloud, "VM.DESTROY", vm, "VirtualMachine")
+        add_event(cloud, "VM.EXPUNGE", vm, "VirtualMachine")
+
+        project = next((
+            project for project in cloud["project"]
+            if project["id"] == vm.get("projectid")), None)
+        network = next(
+            network for network in cloud["network"]
+            if network["type"] == "Isolated"
+            and network.get("projectid") == vm.get("projectid"))
+        vm_number = vm_number + 1
+        new_cloud = {kind: list(cloud[kind]) for kind in (
+            "virtualmachine", "volume", "snapshot", "vmsnapshot", "event")}
+        add_vm(new_cloud, rnd, vm_number, project, network, routing_hosts,
+               volumes_per_vm, snapshots_per_volume)
+        for kind, event_type, resource_type in (
+                ("virtualmachine", "VM.CREATE", "VirtualMachine"),
+                ("volume", "VOLUME.CREATE", "Volume"),
+                ("snapshot", "SNAPSHOT.CREATE", "Snapshot"),
+                ("vmsnapshot", "VMSNAPSHOT.CREATE", "VMSnapshot")):
+            for record in new_cloud[kind][len(cloud[kind]):]:
+                add_event(new_cloud, event_type, record, resource_type)
+        cloud.update(new_cloud)
+
+    for volume in cloud["volume"]:
+        if volume["type"] == "DATADISK" and "virtualmachineid" in volume:
+            detached = {
+                key: value for key, value in volume.items()
+                if key not in ("virtualmachineid", "vmname")}
+            cloud["volume"] = [
+                detached if record is volume else record
+                for record in cloud["volume"]]
+            add_event(cloud, "VOLUME.DETACH", detached, "Volume")
+            break
+    return vm_number
+
+
+def select(cloud, command, params):
+    """ Response of one list call. Records are selected by projectid like
+    CloudStack does: without projectid only records without project, with
+    projectid -1 the records of all projects. """
+
+    response_key, collection = COMMANDS[command]
+    projectid = params.get("projectid")
+
+    records = []
+    for record in cloud[collection]:
+        if collection not in GLOBAL_COLLECTIONS and not record.get("_public"):
+            if projectid is None and "projectid" in record:
+                continue
+            if projectid == "-1" and "projectid" not in record:
+                continue
+            if projectid not in (None, "-1") and \
+                    record.get("projectid") != projectid:
+                continue
+        if any(record.get(field) != params[name]
+               for name, field in FIELD_FILTERS.items() if name in params):
+            continue
+        if "keyword" in params and \
+                params["keyword"] not in record.get("name", ""):
+            continue
+        if "startdate" in params and record["_created"] < calendar.timegm(
+                time.strptime(params["startdate"], "%Y-%m-%d %H:%M:%S")) - \
+                UTC_OFFSET:
+            continue
+        records.append(
+            {key: value for key, value in record.items()
+             if not key.startswith("_")})
+
+    count = len(records)
+    if count == 0:
+        return {}
+    if "page" in params:
+        pagesize = int(params.get("pagesize", 500))
+        page = int(params["page"])
+        records = records[(page - 1) * pagesize:page * pagesize]
+    return {"count": count, response_key: records}
+
+
+class Handler(BaseHTTPRequestHandler):
+    """ Answers API calls from the synthetic cloud of the server."""
+
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def send_json(self, status, body):
+        """ Send a JSON response."""
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """ Handle one API call."""
+
+        params = {
+            key.lower(): values[0] for key, values
+            in parse_qs(urlparse(self.path).query).items()}
+        command = params.get("command", "")
+        response_name = command.lower() + "response"
+        server = self.server
+
+        if command == "mockStats":
+            with server.lock:
+                self.send_json(200, {response_name: dict(server.calls)})
+            return
+        if command == "mockReset":
+            with server.lock:
+                server.calls.clear()
+            self.send_json(200, {response_name: {}})
+            return
+        if command == "mockChurn":
+            with server.lock:
+                server.vm_number = churn(
+                    server.cloud, server.rnd, server.vm_number,
+                    int(params.get("count", 1)), 3, 2)
+            self.send_json(200, {response_name: {}})
+            return
+
+        with server.lock:
+            server.calls[command] = server.calls.get(command, 0) + 1
+            throttled = server.is_throttled()
+        time.sleep(server.latency)
+
+        if throttled:
+            self.send_json(429, {response_name: {
+                "errorcode": 429,
+                "errortext": "There are too many API calls."}})
+        elif command not in COMMANDS:
+            self.send_json(431, {response_name: {
+                "errorcode": 431,
+                "errortext": f"Unknown API {command}"}})
+        else:
+            self.send_json(200, {response_name: select(
+                server.cloud, command, params)})
+
+
+class MockServer(ThreadingHTTPServer):
+    """ HTTP server holding the synthetic cloud and call statistics."""
+
+    daemon_threads = True
+
+    def __init__(self, address, cloud, latency=0.0, throttle=0):
+        super().__init__(address, Handler)
+        self.cloud = cloud
+        self.rnd = random.Random()
+        self.vm_number = len(cloud["virtualmachine"])
+        self.latency = latency
+        self.throttle = throttle
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.window = 0
+        self.window_calls = 0
+
+    def is_throttled(self):
+        """ Count one call in the current second, must hold the lock."""
+        if not self.throttle:
+            return False
+        now = int(time.time())
+        if now != self.window:
+            self.window = now
+            self.window_calls = 0
+        self.window_calls = self.window_calls + 1
+        if self.window_calls <= self.throttle:
+            return False
+        self.calls["_throttled"] = self.calls.get("_throttled", 0) + 1
+        return True
+
+
+def main():
+    """ main :) """
+    args = prepare_arguments()
+
+    global UTC_OFFSET  # pylint: disable=global-statement
+    UTC_OFFSET = args.utc_offset * 3600
+    cloud = build_cloud(
+        args.projects, args.vms_per_project, args.volumes_per_vm,
+        args.snapshots_per_volume, args.hosts, args.seed)
+    server = MockServer(
+        ("127.0.0.1", args.port), cloud, args.latency, args.throttle)
+    print(f'Serving {len(cloud["virtualmachine"])} VMs, '
+          f'{len(cloud["volume"])} volumes on port {server.server_port}',
+          file=sys.stderr, flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,261 @@
+#!/usr/bin/python3
+
+""" Benchmark the acs-tools scripts against the mock CloudStack API. """
+
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import tempfile
+import textwrap
+import subprocess
+import urllib.request
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARK_DIR)
+
+# Name -> script and arguments
+SCRIPTS = {
+    "list_vms": ["list_vms.py"],
+    "list_vms_volumes": ["list_vms.py", "--with-total-volumes"],
+    "list_nics": ["list_nics.py"],
+    "list_volumes": ["list_volumes.py"],
+    "list_snapshots": ["list_snapshots.py"],
+    "list_templates": ["list_templates.py"],
+    "list_isos": ["list_isos.py"],
+    "list_networks": ["list_networks.py"],
+    "list_sshkeypairs": ["list_sshkeypairs.py"],
+    "list_systemvms": ["list_systemvms.py"],
+    "list_users": ["list_users.py"],
+    "list_configurations": ["list_configurations.py"],
+    "report_performance_vm": ["report_performance_vm.py"],
+    "report_performance_disk": ["report_performance_disk.py"],
+}
+
+
+def prepare_arguments():
+    """ Parse commandline arguments."""
+
+    parser = argparse.ArgumentParser(
+        prog='run_benchmark.py',
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description=textwrap.dedent('''\
+        Run the acs-tools scripts against mock_cloudstack.py for synthetic
+        clouds of growing size. Creates a CSV list with wall time, number
+        of API calls and peak RSS per script and cloud size.
+        '''),
+        epilog=textwrap.dedent('''\
+        Examples:
+
+        Benchmark all scripts for 10, 100 and 1000 projects:
+            ./run_benchmark.py --projects 10,100,1000
+
+        Benchmark list_vms.py with 20ms API latency, three runs each:
+            ./run_benchmark.py --script list_vms --latency 0.02 --repeat 3
+
+        Compare the asyncio engine:
+            ./run_benchmark.py --script list_vms -- --async
+
+        Additional Infos:
+
+        Arguments after "--" are passed to every script accepting them.
+        The scripts run with an empty home directory and --no-cache, so
+        neither ~/.cloudstack.ini nor the response cache of the user is
+        used.
+
+        '''))
+
+    parser.add_argument(
+        '--projects',
+        dest='projects',
+        help='Comma separated cloud sizes in projects (default: 10,100).',
+        default='10,100',
+        required=False)
+    parser.add_argument(
+        '--vms-per-project',
+        dest='vms_per_project',
+        help='Number of VMs per project (default: 10).',
+        type=int,
+        default=10,
+        required=False)
+    parser.add_argument(
+        '--latency',
+        dest='latency',
+        help='Latency of each API call in seconds (default: 0).',
+        type=float,
+        default=0.0,
+        required=False)
+    parser.add_argument(
+        '--script',
+        dest='scripts',
+        help='Benchmark only this script, can be given multiple times '
+             f'(choices: {", ".join(SCRIPTS)}).',
+        choices=SCRIPTS,
+        metavar='SCRIPT',
+        action='append',
+        required=False)
+    parser.add_argument(
+        '--repeat',
+        dest='repeat',
+        help='Number of runs per script and size (default: 1).',
+        type=int,
+        default=1,
+        required=False)
+    parser.add_argument(
+        '-o', '--outputfile',
+        dest='name_outputfile',
+        help='Write output to file.',
+        required=False)
+    parser.add_argument(
+        'script_args',
+        help='Arguments passed to every script accepting them.',
+        nargs=argparse.REMAINDER)
+
+    args = parser.parse_args()
+    if args.script_args[:1] == ['--']:
+        args.script_args = args.script_args[1:]
+    return args
+
+
+def free_port():
+    """ Find a free local TCP port."""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def mock_call(endpoint, command):
+    """ Call one of the statistics commands of the mock server."""
+
+    url = f'{endpoint}?command={command}&response=json'
+    with urllib.request.urlopen(url, timeout=10) as response:
+        return json.load(response)[command.lower() + "response"]
+
+
+def start_mock(projects, vms_per_project, latency):
+    """ Start the mock server and wait until it answers. Returns process
+    and endpoint."""
+
+    port = free_port()
+    process = subprocess.Popen([
+        sys.executable, os.path.join(BENCHMARK_DIR, 'mock_cloudstack.py'),
+        '--port', str(port),
+        '--projects', str(projects),
+        '--vms-per-project', str(vms_per_project),
+        '--latency', str(latency)],
+        stderr=subprocess.DEVNULL)
+    endpoint = f'http://127.0.0.1:{port}/client/api'
+
+    for _ in range(600):
+        try:
+            mock_call(endpoint, 'mockReset')
+            return process, endpoint
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError('Mock CloudStack API did not start.')
+
+
+def accepted_args(script, script_args):
+    """ The arguments an option of script_args belongs to, grouped by
+    option, for the options listed in the help of script. Others are
+    reported and left out. """
+
+    usage = subprocess.run(
+        [sys.executable, script, '--help'], cwd=REPO_DIR,
+        capture_output=True, text=True, check=False).stdout
+    groups = []
+    for arg in script_args:
+        if arg.startswith('-') or not groups:
+            groups.append([arg])
+        else:
+            groups[-1].append(arg)
+
+    accepted = []
+    for group in groups:
+        option = group[0].split('=')[0]
+        if option in usage.split():
+            accepted.extend(group)
+        else:
+            print(f'{script} does not accept {option}, left out.',
+                  file=sys.stderr)
+    return accepted
+
+
+def run_script(endpoint, script_args, home):
+    """ Run one script with home as home directory and without response
+    cache. Returns wall time, API calls, peak RSS in MB and exit code."""
+
+    env = dict(
+        os.environ,
+        HOME=home,
+        CLOUDSTACK_ENDPOINT=endpoint,
+        CLOUDSTACK_KEY='benchmark',
+        CLOUDSTACK_SECRET='benchmark')
+    env.pop('ACS_TOOLS_CACHE', None)
+    mock_call(endpoint, 'mockReset')
+
+    started = time.monotonic()
+    process = subprocess.Popen(
+        [sys.executable] + script_args + ['--no-cache'],
+        cwd=REPO_DIR,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL)
+    _, status, rusage = os.wait4(process.pid, 0)
+    wall_time = time.monotonic() - started
+    process.returncode = os.waitstatus_to_exitcode(status)
+
+    calls = mock_call(endpoint, 'mockStats')
+    api_calls = sum(
+        count for command, count in calls.items()
+        if not command.startswith("_"))
+    # ru_maxrss is in KB on Linux.
+    peak_rss = rusage.ru_maxrss / 1024
+    return wall_time, api_calls, peak_rss, process.returncode
+
+
+def main():
+    """ main :) """
+    args = prepare_arguments()
+
+    if args.name_outputfile is not None:
+        outputfile = open(args.name_outputfile, 'w')
+    else:
+        outputfile = sys.stdout
+
+    outputfile.write(
+        'Projects;VMs;Script;Run;Wall Time s;API Calls;Peak RSS MB;'
+        'Exit Code\n')
+    script_args = {
+        name: SCRIPTS[name] + accepted_args(
+            SCRIPTS[name][0], args.script_args)
+        for name in args.scripts or SCRIPTS}
+    home = tempfile.TemporaryDirectory()
+    for projects in [int(size) for size in args.projects.split(',')]:
+        process, endpoint = start_mock(
+            projects, args.vms_per_project, args.latency)
+        try:
+            for name in script_args:
+                for run in range(1, args.repeat + 1):
+                    wall_time, api_calls, peak_rss, returncode = run_script(
+                        endpoint, script_args[name], home.name)
+                    outputfile.write(
+                        f'{projects};'
+                        f'{(projects + 1) * args.vms_per_project};'
+                        f'{name};{run};{wall_time:.3f};{api_calls};'
+                        f'{peak_rss:.1f};{returncode}\n')
+                    outputfile.flush()
+        finally:
+            process.terminate()
+            process.wait()
+    home.cleanup()
+
+    if args.name_outputfile is not None:
+        outputfile.close()
+
+
+if __name__ == "__main__":
+    main()
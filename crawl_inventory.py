@@ -0,0 +1,517 @@
+#!/usr/bin/python3
+
+""" Crawl a CloudStack instance into a local SQLite inventory. """
+
+import sys
+import json
+import time
+import argparse
+from datetime import datetime, timedelta
+import textwrap
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from requests.exceptions import RequestException
+from cs import CloudStackException
+import acs_client
+import acs_common
+import acs_inventory
+
+# Seconds events are read before the stored mark, covers events logged
+# late by the management server.
+SYNC_OVERLAP = 300
+
+# Format of the created date of events. CloudStack returns and reads the
+# dates in the timezone of the management server.
+EVENT_TIME_FORMAT = "%Y-%m-%dT%H:%M:%S%z"
+
+# Most resources of one kind refetched by id, beyond the kind is crawled.
+MAX_REFETCH = 50
+
+# First part of the event type -> kind of the affected resources
+EVENT_KINDS = {
+    "VM": "virtualmachine",
+    "NIC": "virtualmachine",
+    "VOLUME": "volume",
+    "SNAPSHOT": "snapshot",
+    "VMSNAPSHOT": "vmsnapshot",
+    "NETWORK": "network",
+    "ROUTER": "router",
+    "SSVM": "systemvm",
+    "PROXY": "systemvm",
+    "TEMPLATE": "template",
+    "ISO": "iso",
+    "HOST": "host",
+    "USER": "user",
+    "PROJECT": "project",
+    "CONFIGURATION": "configuration",
+}
+
+# Events not changing any resource.
+IGNORED_EVENTS = ("USER.LOGIN", "USER.LOGOUT")
+
+# resourcetype of events and jobinstancetype of async jobs -> kind
+RESOURCE_TYPES = {
+    "VirtualMachine": "virtualmachine",
+    "Volume": "volume",
+    "Snapshot": "snapshot",
+    "VMSnapshot": "vmsnapshot",
+    "Network": "network",
+    "DomainRouter": "router",
+    "SystemVm": "systemvm",
+    "Host": "host",
+    "User": "user",
+    "Project": "project",
+}
+
+# Kinds refetched by id -> id parameter of their list command
+ID_PARAMS = {
+    "virtualmachine": "id",
+    "volume": "id",
+    "snapshot": "id",
+    "vmsnapshot": "vmsnapshotid",
+    "network": "id",
+    "router": "id",
+    "systemvm": "id",
+    "host": "id",
+    "user": "id",
+    "project": "id",
+}
+
+# VM events and async job commands adding or removing volumes of the VM
+VOLUME_EVENTS = ("VM.CREATE", "VM.DESTROY", "VM.EXPUNGE", "VM.RESTORE")
+VOLUME_JOBS = ("DeployVM", "DestroyVM", "ExpungeVM", "RestoreVM")
+
+
+def prepare_arguments():
+    """ Parse commandline arguments."""
+
+    parser = argparse.ArgumentParser(
+        prog='crawl_inventory.py',
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description=textwrap.dedent('''\
+        Fetch projects, VMs with their NICs, volumes, snapshots, VM
+        snapshots, networks, routers, system VMs, templates, ISOs, hosts,
+        users, SSH keypairs and configurations of a CloudStack instance in
+        one concurrent pass into an indexed SQLite database.
+
+        With --incremental only the resources named by the events and
+        async jobs since the last run are fetched again. A full crawl is
+        done when the last one is older than --reconcile-after.
+
+        The list scripts read the inventory instead of the API when called
+        with --from-db.
+        '''),
+        epilog=textwrap.dedent('''\
+        Examples:
+
+        Crawl everything into ~/.cache/acs-tools/inventory.sqlite:
+            ./crawl_inventory.py
+
+        Crawl only VMs and volumes into some database, 8 kinds at a time:
+            ./crawl_inventory.py -d cloud.sqlite --kind virtualmachine \\
+                --kind volume --workers 8
+
+        Sync the changes since the last run, every 6 hours a full crawl:
+            ./crawl_inventory.py --incremental --reconcile-after 6
+
+        Create reports from the inventory:
+            ./list_vms.py --from-db
+            ./list_volumes.py --from-db cloud.sqlite --only-detached
+
+        Additional Infos:
+
+        Uses the "CS" CloudStack API Client.
+        See https://github.com/exoscale/cs.
+        To install use "pip install cs".
+
+        Requires configuration file ~/.cloudstack.ini.
+
+        '''))
+
+    parser.add_argument(
+        '-d', '--database',
+        dest='database',
+        help=f'Inventory database (default: {acs_inventory.INVENTORY_FILE}).',
+        default=acs_inventory.INVENTORY_FILE,
+        required=False)
+    parser.add_argument(
+        '--kind',
+        dest='kinds',
+        help='Crawl only this kind of resources, can be given multiple times '
+             f'(choices: {", ".join(acs_inventory.KINDS)}).',
+        choices=acs_inventory.KINDS,
+        metavar='KIND',
+        action='append',
+        required=False)
+    parser.add_argument(
+        '--page-size',
+        dest='page_size',
+        help=f'Records per API call (default: {acs_common.PAGESIZE}).',
+        type=int,
+        default=acs_common.PAGESIZE,
+        required=False)
+    parser.add_argument(
+        '--workers',
+        dest='workers',
+        help='Number of resource kinds crawled at the same time '
+             '(default: 4).',
+        type=int,
+        default=4,
+        required=False)
+    parser.add_argument(
+        '--incremental',
+        dest='incremental',
+        help='Fetch only the resources changed since the last run, '
+             'according to the events.',
+        action='store_true',
+        required=False)
+    parser.add_argument(
+        '--reconcile-after',
+        dest='reconcile_after',
+        help='With --incremental, crawl everything when the last full crawl '
+             'is older than this many hours (default: 24).',
+        type=float,
+        default=24,
+        required=False)
+    acs_client.add_arguments(parser)
+    args = parser.parse_args()
+
+    if args.workers < 1:
+        parser.error('--workers must be at least 1')
+    if args.from_db is not None:
+        parser.error('--from-db can not be used for crawling')
+    if args.incremental and args.kinds is not None:
+        parser.error('--incremental can not be combined with --kind')
+
+    return args
+
+
+def collect_scopes(
+        cloudstack, command, response_key, projects,
+        pagesize=acs_common.PAGESIZE, **params):
+    """ Collects the records of a list call without project and of all
+    projects. Returns both lists. """
+
+    def collect(cloudstack, projectid=""):
+        if projectid != "":
+            return list(acs_common.fetch_pages(
+                cloudstack, command, response_key,
+                pagesize=pagesize,
+                projectid=projectid,
+                **params))
+        return list(acs_common.fetch_pages(
+            cloudstack, command, response_key,
+            pagesize=pagesize,
+            **params))
+
+    records = collect(cloudstack)
+    if projects is None:
+        return records, []
+    return records, acs_common.collect_projects(
+        collect, cloudstack, projects, cross_project_query=True)
+
+
+def collect_kind(
+        cloudstack, kind, projects, templatefilter=None,
+        pagesize=acs_common.PAGESIZE, **params):
+    """ Collects all records of one kind, without project and of all
+    projects. Returns the records and the keys of the records without
+    project listed for projects as well. """
+
+    command, response_key = acs_inventory.KINDS[kind]
+    if kind != "configuration":
+        params["listall"] = True
+    if templatefilter is not None:
+        params["templatefilter"] = templatefilter
+    if kind in acs_inventory.GLOBAL_KINDS:
+        projects = None
+
+    records, project_records = collect_scopes(
+        cloudstack, command, response_key, projects, pagesize, **params)
+    shared_keys = {
+        acs_inventory.record_key(kind, record, templatefilter or "")
+        for record in project_records if "projectid" not in record}
+    return records + project_records, shared_keys
+
+
+def crawl(cloudstack, db, kinds, workers, pagesize=acs_common.PAGESIZE):
+    """ Crawl all kinds concurrently and replace their records in the
+    inventory. Returns the kinds that failed. """
+
+    projects, _ = collect_kind(
+        cloudstack, "project", [], pagesize=pagesize)
+    if "project" in kinds:
+        acs_inventory.replace_records(db, "project", projects)
+
+    tasks = []
+    for kind in kinds:
+        if kind == "template":
+            tasks.extend(
+                (kind, templatefilter)
+                for templatefilter in acs_inventory.TEMPLATE_FILTERS)
+        elif kind != "project":
+            tasks.append((kind, None))
+
+    failed_kinds = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(
+                collect_kind, cloudstack, kind, projects, templatefilter,
+                pagesize): (kind, templatefilter)
+            for kind, templatefilter in tasks}
+        for future in as_completed(futures):
+            kind, templatefilter = futures[future]
+            try:
+                records, shared_keys = future.result()
+            except (CloudStackException, RequestException) as error:
+                print(f'Crawling {kind} failed, keeping the stored records: '
+                      f'{error}', file=sys.stderr)
+                failed_kinds.append(kind)
+                continue
+            acs_inventory.replace_records(
+                db, kind, records, templatefilter, shared_keys)
+            if templatefilter is not None:
+                kind = f'{kind} ({templatefilter})'
+            print(f'{kind}: {len(records)}', file=sys.stderr)
+
+    return failed_kinds
+
+
+def event_kind(event_type):
+    """ Kind of the resources affected by an event type, None if the
+    inventory is not affected. """
+
+    if event_type in IGNORED_EVENTS:
+        return None
+    if "SSH.KEYPAIR" in event_type:
+        return "sshkeypair"
+    return EVENT_KINDS.get(event_type.split(".")[0])
+
+
+def affected_resources(events):
+    """ Ids of the resources affected by events per kind, the kinds with
+    events naming no resource and the VMs whose volumes changed. """
+
+    resource_ids = {}
+    unresolved_kinds = set()
+    volume_vm_ids = set()
+    for event in events:
+        kind = event_kind(event.get("type", ""))
+        if kind is None:
+            continue
+        resource_kind = RESOURCE_TYPES.get(event.get("resourcetype"))
+        resource_id = event.get("resourceid")
+        if resource_kind in ID_PARAMS and resource_id:
+            resource_ids.setdefault(resource_kind, set()).add(resource_id)
+            if event["type"] in VOLUME_EVENTS:
+                volume_vm_ids.add(resource_id)
+        else:
+            unresolved_kinds.add(kind)
+    return resource_ids, unresolved_kinds, volume_vm_ids
+
+
+def resolve_jobs(jobs, resource_ids, unresolved_kinds, volume_vm_ids):
+    """ Events of older CloudStack versions name no resource. The finished
+    async jobs tell the resources of these kinds instead. Returns the kinds
+    still unresolved. """
+
+    resolved_kinds = set()
+    for job in jobs:
+        kind = RESOURCE_TYPES.get(job.get("jobinstancetype"))
+        resource_id = job.get("jobinstanceid")
+        if kind not in unresolved_kinds or not resource_id or \
+                job.get("jobstatus") == 0:
+            continue
+        resource_ids.setdefault(kind, set()).add(resource_id)
+        resolved_kinds.add(kind)
+        if any(command in job.get("cmd", "") for command in VOLUME_JOBS):
+            volume_vm_ids.add(resource_id)
+    return unresolved_kinds - resolved_kinds
+
+
+def fetch_records(cloudstack, kind, **params):
+    """ Records of one kind matching the parameters, looked for without
+    project and then in all projects. """
+
+    command, response_key = acs_inventory.KINDS[kind]
+    records = list(acs_common.fetch_pages(
+        cloudstack, command, response_key, listall=True, **params))
+    if not records and kind not in acs_inventory.GLOBAL_KINDS:
+        records = list(acs_common.fetch_pages(
+            cloudstack, command, response_key, listall=True, projectid=-1,
+            **params))
+    return records
+
+
+def refetch_records(cloudstack, db, kind, resource_ids):
+    """ Fetch resources by id again, resources not found any more are
+    removed from the inventory. """
+
+    records = []
+    for resource_id in sorted(resource_ids):
+        records.extend(fetch_records(
+            cloudstack, kind, **{ID_PARAMS[kind]: resource_id}))
+    found_ids = {record["id"] for record in records}
+    acs_inventory.delete_records(db, kind, set(resource_ids) - found_ids)
+
+    # Shared records stay shared.
+    shared_keys = {
+        key for key, in db.execute(
+            f'SELECT key FROM {kind} WHERE shared = 1')}
+    acs_inventory.upsert_records(db, kind, records, shared_keys=shared_keys)
+    return len(records)
+
+
+def refetch_volumes(cloudstack, db, vm_ids):
+    """ Fetch the volumes of VMs again, volumes of these VMs not found any
+    more are removed from the inventory. """
+
+    volumes = []
+    for vm_id in sorted(vm_ids):
+        volumes.extend(fetch_records(
+            cloudstack, "volume", virtualmachineid=vm_id))
+    found_ids = {volume["id"] for volume in volumes}
+    for vm_id in vm_ids:
+        stored_ids = {
+            volume_id for volume_id, in db.execute(
+                'SELECT id FROM volume WHERE virtualmachineid = ?', (vm_id,))}
+        acs_inventory.delete_records(db, "volume", stored_ids - found_ids)
+    acs_inventory.upsert_records(db, "volume", volumes)
+    return len(volumes)
+
+
+def newest_event(events, mark=""):
+    """ created of the newest of events, mark if it is newer or there are
+    no events. An empty mark is older than all events. """
+
+    for event in events:
+        if mark == "" or datetime.strptime(
+                event["created"], EVENT_TIME_FORMAT) > datetime.strptime(
+                    mark, EVENT_TIME_FORMAT):
+            mark = event["created"]
+    return mark
+
+
+def last_event(cloudstack):
+    """ created of the newest event without project and in all projects,
+    "" without any events. listEvents lists the newest events first. """
+
+    events = []
+    for params in ({}, {"projectid": -1}):
+        events.extend(cloudstack.listEvents(
+            listall=True, page=1, pagesize=1, **params).get("event", []))
+    return newest_event(events)
+
+
+def event_params(mark):
+    """ Parameters reading the events and async jobs since the created
+    date of an event. The startdate is in the timezone of the management
+    server, like the created date. """
+
+    if mark == "":
+        return {}
+    since = datetime.strptime(mark, EVENT_TIME_FORMAT).replace(tzinfo=None)
+    startdate = since - timedelta(seconds=SYNC_OVERLAP)
+    return {"startdate": startdate.strftime("%Y-%m-%d %H:%M:%S")}
+
+
+def sync(cloudstack, db, mark, workers, pagesize=acs_common.PAGESIZE):
+    """ Update the inventory from the events and async jobs since the
+    created date of the newest event seen before. Kinds with too many or
+    unnamed changed resources are crawled. Returns the kinds that failed
+    and the created date of the newest event. """
+
+    projects = [
+        json.loads(data) for data, in db.execute('SELECT data FROM project')]
+    params = event_params(mark)
+    events, project_events = collect_scopes(
+        cloudstack, "listEvents", "event", projects, pagesize,
+        listall=True, **params)
+    events = events + project_events
+    resource_ids, unresolved_kinds, volume_vm_ids = affected_resources(
+        events)
+    if unresolved_kinds & set(ID_PARAMS):
+        jobs = list(acs_common.fetch_pages(
+            cloudstack, "listAsyncJobs", "asyncjobs", pagesize=pagesize,
+            listall=True, **params))
+        unresolved_kinds = resolve_jobs(
+            jobs, resource_ids, unresolved_kinds, volume_vm_ids)
+    print(f'events: {len(events)}', file=sys.stderr)
+
+    crawl_kinds = set(unresolved_kinds)
+    crawl_kinds.update(
+        kind for kind, ids in resource_ids.items() if len(ids) > MAX_REFETCH)
+    if "virtualmachine" in crawl_kinds:
+        crawl_kinds.add("volume")
+    failed_kinds = []
+    if crawl_kinds:
+        failed_kinds = crawl(
+            cloudstack, db, sorted(crawl_kinds), workers, pagesize)
+
+    for kind, ids in sorted(resource_ids.items()):
+        if kind in crawl_kinds:
+            continue
+        try:
+            count = refetch_records(cloudstack, db, kind, ids)
+            if kind == "virtualmachine" and "volume" not in crawl_kinds:
+                refetch_volumes(cloudstack, db, volume_vm_ids)
+        except (CloudStackException, RequestException) as error:
+            print(f'Fetching {kind} failed, keeping the stored records: '
+                  f'{error}', file=sys.stderr)
+            failed_kinds.append(kind)
+            continue
+        print(f'{kind}: {len(ids)} refetched, {len(ids) - count} removed',
+              file=sys.stderr)
+
+    return failed_kinds, newest_event(events, mark)
+
+
+def main():
+    """ main :) """
+    args = prepare_arguments()
+
+    # Reads ~/.cloudstack.ini
+    cloudstack = acs_client.get_cloudstack(args)
+    # The inventory must hold the current state, crawls and the records
+    # fetched again by sync() must not come from the response cache.
+    cloudstack.cache = None
+
+    db = acs_inventory.open_inventory(args.database)
+    started = time.time()
+    last_full_crawl = float(
+        acs_inventory.get_value(db, "last_full_crawl", 0))
+    # created of the newest event seen, the clock of this host is not
+    # compared with the dates of the management server.
+    mark = acs_inventory.get_value(db, "last_event")
+    if args.incremental and mark is not None and \
+            started - last_full_crawl < args.reconcile_after * 3600:
+        failed_kinds, mark = sync(
+            cloudstack, db, mark, args.workers, args.page_size)
+    else:
+        if args.incremental:
+            print('Last full crawl too old, crawling everything',
+                  file=sys.stderr)
+        mark = None
+        if args.kinds is None:
+            # Taken before the crawl, changes while crawling are read by
+            # the next sync.
+            try:
+                mark = last_event(cloudstack)
+            except (CloudStackException, RequestException) as error:
+                print(f'Listing events failed, the next --incremental run '
+                      f'crawls everything: {error}', file=sys.stderr)
+        failed_kinds = crawl(
+            cloudstack, db, args.kinds or list(acs_inventory.KINDS),
+            args.workers, args.page_size)
+        if args.kinds is None and not failed_kinds:
+            acs_inventory.set_value(db, "last_full_crawl", started)
+    if mark is not None and not failed_kinds:
+        acs_inventory.set_value(db, "last_event", mark)
+    db.commit()
+    db.close()
+
+    if failed_kinds:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -7,7 +7,8 @@ import sys
 # import pprint
 import argparse
 import textwrap
-from cs import CloudStack, read_config
+import acs_client
+import acs_profile
 
 PARSER = argparse.ArgumentParser(
     prog='list_configurations.py',
@@ -40,25 +41,31 @@ PARSER.add_argument('-o', '--outputfile',
                     help='Write output to file.',
                     required=False)
 
+acs_client.add_arguments(PARSER, with_async=False)
+
 ARGS = PARSER.parse_args()
 
 
 def print_global_confs():
     """API call list configurations."""
-    configurations_container = cs.listConfigurations()
+    with acs_profile.phase("collect"):
+        configurations_container = cs.listConfigurations()
 
     if configurations_container != {}:
         configurations = configurations_container["configuration"]
-        for configuration in sorted(
+        with acs_profile.phase("sort"):
+            sorted_configurations = sorted(
                 configurations,
-                key=lambda key: key["name"]):
-            if "value" not in configuration:
-                value = "n.a."
-            else:
-                value = configuration["value"]
+                key=lambda key: key["name"])
+        with acs_profile.phase("write"):
+            for configuration in sorted_configurations:
+                if "value" not in configuration:
+                    value = "n.a."
+                else:
+                    value = configuration["value"]
 
-            OUTPUTFILE.write(
-                f'{configuration["name"]};{value}\n')
+                OUTPUTFILE.write(
+                    f'{configuration["name"]};{value}\n')
 
 
 if ARGS.name_outputfile is not None:
@@ -67,7 +74,7 @@ else:
     OUTPUTFILE = sys.stdout
 
 # Reads ~/.cloudstack.ini
-cs = CloudStack(**read_config())
+cs = acs_client.get_cloudstack(ARGS)
 
 # projects_container = cs.listProjects(listall=True)
 # projects = projects_container["project"]
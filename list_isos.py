@@ -6,7 +6,9 @@ import sys
 # import pprint
 import argparse
 import textwrap
-from cs import CloudStack, read_config
+import acs_client
+import acs_common
+import acs_profile
 
 
 def prepare_arguments():
@@ -60,6 +62,13 @@ def prepare_arguments():
         dest='name_outputfile',
         help='Write output to file.',
         required=False)
+    parser.add_argument(
+        '--cross-project-query',
+        dest='cross_project_query',
+        help='Query all projects at once (projectid=-1).',
+        action='store_true',
+        required=False)
+    acs_client.add_arguments(parser)
     args = parser.parse_args()
 
     return args
@@ -68,48 +77,34 @@ def prepare_arguments():
 def collect_isos(cloudstack, projectid=""):
     """ Collects all isos for one project. """
 
-    project_isos = []
     if projectid != "":
-        isos_container = cloudstack.listIsos(
+        project_isos = list(acs_common.fetch_pages(
+            cloudstack, "listIsos", "iso",
             listall=True,
-            projectid=projectid)
+            projectid=projectid))
     else:
-        isos_container = cloudstack.listIsos(listall=True)
+        project_isos = list(acs_common.fetch_pages(
+            cloudstack, "listIsos", "iso",
+            listall=True))
 
-    if isos_container != {}:
-        project_isos = isos_container["iso"]
-        for my_isos in project_isos:
-            for key in ["project", "projectid"]:
-                if key not in my_isos:
-                    my_isos[key] = "n.a."
+    for my_isos in project_isos:
+        for key in ["project", "projectid"]:
+            if key not in my_isos:
+                my_isos[key] = "n.a."
 
-            tags_string = ''
-            for tag in my_isos["tags"]:
-                tags_string = (
-                        tags_string +
-                        f'{tag["key"]}=\"{tag["value"]}\"')
-            my_isos["tags_string"] = tags_string
+        tags_string = ''
+        for tag in my_isos["tags"]:
+            tags_string = (
+                    tags_string +
+                    f'{tag["key"]}=\"{tag["value"]}\"')
+        my_isos["tags_string"] = tags_string
 
-            if my_isos["domain"] == "ROOT":
-                my_isos["domain"] = " ROOT"
+        if my_isos["domain"] == "ROOT":
+            my_isos["domain"] = " ROOT"
 
     return project_isos
 
 
-def remove_duplicates(all_isos):
-    """ Remove duplicate entries."""
-
-    isos_condensed = []
-    last_id = ''
-    for loop_iso in sorted(all_isos, key=lambda i: (
-            i["id"])):
-        if loop_iso["id"] != last_id:
-            isos_condensed = isos_condensed + [loop_iso.copy(), ]
-        last_id = loop_iso["id"]
-
-    return isos_condensed
-
-
 def filter_isos(all_isos, args):
     """ Filter set of isos according to commandline parameters."""
     filtered_isos = all_isos.copy()
@@ -138,18 +133,23 @@ def print_isos(filtered_isos, outputfile):
         'Public;Ready;Tags\n')
     outputfile.write(output_string)
 
-    for isos in sorted(filtered_isos, key=lambda i: (
+    with acs_profile.phase("sort"):
+        sorted_isos = sorted(filtered_isos, key=lambda i: (
             i["domain"],
             i["project"],
-            i["name"])):
-        output_string = (
-            f'{isos["domain"]};{isos["project"]};'
-            f'{isos["name"]};{isos["displaytext"]};{isos["ostypename"]};'
-            f'{isos["status"]};{round(isos["size"]/1024**2, 0)};'
-            f'{isos["bootable"]};{isos["isdynamicallyscalable"]};'
-            f'{isos["isextractable"]};{isos["isfeatured"]};{isos["ispublic"]};'
-            f'{isos["isready"]};{isos["tags_string"]}')
-        outputfile.write(f'{output_string}\n')
+            i["name"],
+            i["id"]))
+    with acs_profile.phase("write"):
+        for isos in sorted_isos:
+            output_string = (
+                f'{isos["domain"]};{isos["project"]};'
+                f'{isos["name"]};{isos["displaytext"]};{isos["ostypename"]};'
+                f'{isos["status"]};{round(isos["size"]/1024**2, 0)};'
+                f'{isos["bootable"]};{isos["isdynamicallyscalable"]};'
+                f'{isos["isextractable"]};'
+                f'{isos["isfeatured"]};{isos["ispublic"]};'
+                f'{isos["isready"]};{isos["tags_string"]}')
+            outputfile.write(f'{output_string}\n')
 
 
 def main():
@@ -162,22 +162,22 @@ def main():
         outputfile = sys.stdout
 
     # Reads ~/.cloudstack.ini
-    cloudstack = CloudStack(**read_config())
+    cloudstack = acs_client.get_cloudstack(args)
 
-    all_isos = collect_isos(cloudstack)
+    with acs_profile.phase("collect"):
+        all_isos = collect_isos(cloudstack)
 
-    projects_container = cloudstack.listProjects(listall=True)
-    projects = projects_container["project"]
+        projects_container = cloudstack.listProjects(listall=True)
+        projects = projects_container["project"]
 
-    for project in sorted(projects, key=lambda key: key["name"]):
-        project_id = project["id"]
-        all_isos = all_isos + collect_isos(
-            cloudstack, project_id)
+        all_isos = all_isos + acs_common.collect_projects(
+            collect_isos, cloudstack, projects, args.cross_project_query)
 
     # pprint.pprint(all_isos)
 
-    condensed_isos = remove_duplicates(all_isos)
-    filtered_isos = filter_isos(condensed_isos, args)
+    with acs_profile.phase("filter"):
+        condensed_isos = acs_common.merge_duplicates(all_isos)
+        filtered_isos = list(filter_isos(condensed_isos, args))
 
     print_isos(filtered_isos, outputfile)
 
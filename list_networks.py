@@ -6,7 +6,9 @@ import sys
 # import pprint
 import argparse
 import textwrap
-from cs import CloudStack, read_config
+import acs_client
+import acs_common
+import acs_profile
 
 
 def prepare_arguments():
@@ -84,6 +86,13 @@ def prepare_arguments():
         dest='name_outputfile',
         help='Write output to file.',
         required=False)
+    parser.add_argument(
+        '--cross-project-query',
+        dest='cross_project_query',
+        help='Query all projects at once (projectid=-1).',
+        action='store_true',
+        required=False)
+    acs_client.add_arguments(parser)
     args = parser.parse_args()
 
     return args
@@ -92,40 +101,26 @@ def prepare_arguments():
 def collect_nets(cloudstack, projectid=""):
     """ Collects all networks for one project. """
 
-    project_nets = []
     if projectid != "":
-        nets_container = cloudstack.listNetworks(
+        project_nets = list(acs_common.fetch_pages(
+            cloudstack, "listNetworks", "network",
             listall=True,
-            projectid=projectid)
+            projectid=projectid))
     else:
-        nets_container = cloudstack.listNetworks(listall=True)
+        project_nets = list(acs_common.fetch_pages(
+            cloudstack, "listNetworks", "network",
+            listall=True))
 
-    if nets_container != {}:
-        project_nets = nets_container["network"]
-        for my_nets in project_nets:
-            for key in ["project", "projectid", "vlan"]:
-                if key not in my_nets:
-                    my_nets[key] = "n.a."
-            if my_nets["domain"] == "ROOT":
-                my_nets["domain"] = " ROOT"
+    for my_nets in project_nets:
+        for key in ["project", "projectid", "vlan"]:
+            if key not in my_nets:
+                my_nets[key] = "n.a."
+        if my_nets["domain"] == "ROOT":
+            my_nets["domain"] = " ROOT"
 
     return project_nets
 
 
-def remove_duplicates(all_nets):
-    """ Remove duplicate entries."""
-
-    nets_condensed = []
-    last_id = ''
-    for loop_net in sorted(all_nets, key=lambda i: (
-            i["id"])):
-        if loop_net["id"] != last_id:
-            nets_condensed = nets_condensed + [loop_net.copy(), ]
-        last_id = loop_net["id"]
-
-    return nets_condensed
-
-
 def filter_nets(all_nets, args):
     """ Filter set of nets according to commandline parameters."""
     filtered_nets = all_nets.copy()
@@ -159,16 +154,20 @@ def print_nets(filtered_nets, outputfile):
         'Domain;Project;Name;Type;State;Restart Required;CIDR;' +
         'VLAN;Is Redundant')
 
-    for nets in sorted(filtered_nets, key=lambda i: (
+    with acs_profile.phase("sort"):
+        sorted_nets = sorted(filtered_nets, key=lambda i: (
             i["domain"],
             i["project"],
-            i["name"])):
-        output_string = (
-            f'{nets["domain"]};{nets["project"]};'
-            f'{nets["name"]};{nets["type"]};'
-            f'{nets["state"]};{nets["restartrequired"]};'
-            f'{nets["cidr"]};{nets["vlan"]};{nets["redundantrouter"]}')
-        outputfile.write(f'{output_string}\n')
+            i["name"],
+            i["id"]))
+    with acs_profile.phase("write"):
+        for nets in sorted_nets:
+            output_string = (
+                f'{nets["domain"]};{nets["project"]};'
+                f'{nets["name"]};{nets["type"]};'
+                f'{nets["state"]};{nets["restartrequired"]};'
+                f'{nets["cidr"]};{nets["vlan"]};{nets["redundantrouter"]}')
+            outputfile.write(f'{output_string}\n')
 
 
 def main():
@@ -181,22 +180,22 @@ def main():
         outputfile = sys.stdout
 
     # Reads ~/.cloudstack.ini
-    cloudstack = CloudStack(**read_config())
+    cloudstack = acs_client.get_cloudstack(args)
 
-    all_nets = collect_nets(cloudstack)
+    with acs_profile.phase("collect"):
+        all_nets = collect_nets(cloudstack)
 
-    projects_container = cloudstack.listProjects(listall=True)
-    projects = projects_container["project"]
+        projects_container = cloudstack.listProjects(listall=True)
+        projects = projects_container["project"]
 
-    for project in sorted(projects, key=lambda key: key["name"]):
-        project_id = project["id"]
-        all_nets = all_nets + collect_nets(
-            cloudstack, project_id)
+        all_nets = all_nets + acs_common.collect_projects(
+            collect_nets, cloudstack, projects, args.cross_project_query)
 
     # pprint.pprint(all_nets)
     # filtered_nets = filter_nets(all_nets, args)
-    condensed_nets = remove_duplicates(all_nets)
-    filtered_nets = filter_nets(condensed_nets, args)
+    with acs_profile.phase("filter"):
+        condensed_nets = acs_common.merge_duplicates(all_nets)
+        filtered_nets = list(filter_nets(condensed_nets, args))
 
     print_nets(filtered_nets, outputfile)
 
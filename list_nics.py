@@ -7,7 +7,13 @@ import sys
 # import pprint
 import argparse
 import textwrap
-from cs import CloudStack, read_config
+import acs_client
+import acs_common
+import acs_profile
+import acs_records
+
+# Detail groups of listVirtualMachines needed for the output.
+VM_DETAILS = "nics,min"
 
 
 def prepare_arguments():
@@ -60,6 +66,13 @@ def prepare_arguments():
         dest='name_outputfile',
         help='Write output to file.',
         required=False)
+    parser.add_argument(
+        '--cross-project-query',
+        dest='cross_project_query',
+        help='Query all projects at once (projectid=-1).',
+        action='store_true',
+        required=False)
+    acs_client.add_arguments(parser)
     args = parser.parse_args()
 
     return args
@@ -70,36 +83,31 @@ def collect_nics(cs, projectid=""):
 
     project_nics = []
     if projectid != "":
-        vms_container = cs.listVirtualMachines(
+        vms = acs_common.fetch_pages(
+            cs, "listVirtualMachines", "virtualmachine",
             listall=True,
+            details=VM_DETAILS,
             projectid=projectid)
     else:
-        vms_container = cs.listVirtualMachines(listall=True)
-
-    if vms_container != {}:
-        vms = vms_container["virtualmachine"]
-        for vm in vms:
-            for key in [
-                    "project",
-                    "projectid",
-                    "hostname"]:
-                if key not in vm:
-                    vm[key] = "n.a."
-            for nic in vm["nic"]:
-                nic["domain"] = vm["domain"]
-                nic["project"] = vm["project"]
-                nic["vmname"] = vm["name"]
-                for key in ["ipaddress", ]:
-                    if key not in nic:
-                        nic[key] = "n.a."
-                project_nics = project_nics + [nic, ]
+        vms = acs_common.fetch_pages(
+            cs, "listVirtualMachines", "virtualmachine",
+            listall=True,
+            details=VM_DETAILS)
+
+    for vm in vms:
+        for nic in vm["nic"]:
+            project_nics.append(acs_records.Nic(
+                nic,
+                domain=vm["domain"],
+                project=vm.get("project", "n.a."),
+                vmname=vm["name"]))
 
     return project_nics
 
 
 def filter_nics(all_nics, args):
     """ Filter set of NICs according to commandline parameters."""
-    filtered_nics = all_nics.copy()
+    filtered_nics = all_nics
     if args.project is not None:
         filtered_nics = filter(
             lambda d: d["project"] == args.project, filtered_nics)
@@ -118,16 +126,19 @@ def print_nics(filtered_nics, outputfile):
         'Networkname')
     outputfile.write(f'{output_string}\n')
 
-    for nic in sorted(filtered_nics, key=lambda i: (
+    with acs_profile.phase("sort"):
+        sorted_nics = sorted(filtered_nics, key=lambda i: (
             i["domain"],
             i["project"],
             i["vmname"],
-            i["ipaddress"])):
-        output_string = (
-            f'{nic["domain"]};{nic["project"]};{nic["vmname"]};'
-            f'{nic["ipaddress"]};'
-            f'{nic["macaddress"]};{nic["isdefault"]};{nic["networkname"]}')
-        outputfile.write(f'{output_string}\n')
+            i["ipaddress"]))
+    with acs_profile.phase("write"):
+        for nic in sorted_nics:
+            output_string = (
+                f'{nic["domain"]};{nic["project"]};{nic["vmname"]};'
+                f'{nic["ipaddress"]};'
+                f'{nic["macaddress"]};{nic["isdefault"]};{nic["networkname"]}')
+            outputfile.write(f'{output_string}\n')
 
 
 def main():
@@ -140,20 +151,20 @@ def main():
         outputfile = sys.stdout
 
     # Reads ~/.cloudstack.ini
-    cs = CloudStack(**read_config())
+    cs = acs_client.get_cloudstack(args)
 
-    all_nics = collect_nics(cs)
+    with acs_profile.phase("collect"):
+        all_nics = collect_nics(cs)
 
-    projects_container = cs.listProjects(listall=True)
-    projects = projects_container["project"]
+        projects_container = cs.listProjects(listall=True)
+        projects = projects_container["project"]
 
-    for project in sorted(projects, key=lambda key: key["name"]):
-        project_id = project["id"]
-        all_nics = all_nics + collect_nics(
-            cs, project_id)
+        all_nics = all_nics + acs_common.collect_projects(
+            collect_nics, cs, projects, args.cross_project_query)
 
     # pprint.pprint(all_nics)
-    filtered_nics = filter_nics(all_nics, args)
+    with acs_profile.phase("filter"):
+        filtered_nics = list(filter_nics(all_nics, args))
     # pprint.pprint(filtered_nics)
     print_nics(filtered_nics, outputfile)
 
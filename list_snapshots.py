@@ -7,7 +7,10 @@ import sys
 # import pprint
 import argparse
 import textwrap
-from cs import CloudStack, read_config
+import acs_client
+import acs_common
+import acs_profile
+import acs_records
 
 parser = argparse.ArgumentParser(
     prog='list_snapshots.py',
@@ -57,23 +60,47 @@ parser.add_argument('-o', '--outputfile',
                     dest='name_outputfile',
                     help='Write output to file.',
                     required=False)
+acs_client.add_arguments(parser)
 args = parser.parse_args()
 
 
-def print_volume_snapshots(projectid=""):
+def collect_volume_names(cloudstack, projectid=""):
+    """ Collects name and VM name of all volumes for one project."""
+
+    if projectid != "":
+        volumes = acs_common.fetch_pages(
+            cloudstack, "listVolumes", "volume",
+            listall=True,
+            projectid=projectid)
+    else:
+        volumes = acs_common.fetch_pages(
+            cloudstack, "listVolumes", "volume",
+            listall=True)
+
+    volume_names = {}
+    for volume in volumes:
+        if "vmname" in volume:
+            volume_names[volume["id"]] = (volume["name"], volume["vmname"])
+        else:
+            volume_names[volume["id"]] = (volume["name"], "n.a.")
+    return volume_names
+
+
+def print_volume_snapshots(cloudstack, projectid=""):
     """ Prints all snapshots for one project."""
 
     tmp_snapshots = []
 
     if projectid != "":
-        snapshots_container = cs.listSnapshots(
+        snapshots_container = cloudstack.listSnapshots(
             listall=True,
             projectid=projectid)
     else:
-        snapshots_container = cs.listSnapshots(listall=True)
+        snapshots_container = cloudstack.listSnapshots(listall=True)
 
     if snapshots_container != {}:
         snapshots = snapshots_container["snapshot"]
+        volume_names = collect_volume_names(cloudstack, projectid)
         # pprint.pprint(snapshots)
         # pylint: disable=redefined-outer-name
         for snapshot in snapshots:
@@ -83,24 +110,9 @@ def print_volume_snapshots(projectid=""):
                 snapshot_project = ""
             snapshot_project = snapshot["project"]
 
-            # Query VMName to snapshot
-            volumes_container = cs.listVolumes(
-                listall=True,
-                id=snapshot["volumeid"],
-                projectid=projectid)
-            if volumes_container != {}:
-                volumes = volumes_container["volume"]
-                volume = volumes[0]
-                volume_name = volume["name"]
-                # volume_virtualmachineid = volume["virtualmachineid"]
-                if "vmname" in volume:
-                    volume_virtualmachinename = volume["vmname"]
-                else:
-                    volume_virtualmachinename = "n.a."
-            else:
-                volume_name = "n.a."
-                # volume_virtualmachineid = "n.a."
-                volume_virtualmachinename = "n.a."
+            # Lookup volume name and VM name of snapshot
+            volume_name, volume_virtualmachinename = volume_names.get(
+                snapshot["volumeid"], ("n.a.", "n.a."))
 
             tags_string = ''
             for tag in snapshot["tags"]:
@@ -108,76 +120,91 @@ def print_volume_snapshots(projectid=""):
             # if tags_string != "":
             #     print(tags_string)
 
-            tmp_snapshots = tmp_snapshots + [({
-                "domain": snapshot["domain"],
-                "project": snapshot_project,
-                "vmname": volume_virtualmachinename,
-                "volname": volume_name,
-                "snapshot_name": snapshot["name"],
-                "vm_or_vol_snappy": 'Volume Snapshot',
-                "snapshot_state": snapshot["state"],
-                "created": snapshot["created"],
-                "virtualsize_gb": round(snapshot["virtualsize"]/1024**3, 2),
-                "physicalsize_gb": round(snapshot["physicalsize"]/1024**3, 2),
-                "intervaltype": snapshot["intervaltype"],
-                "revertable": snapshot["revertable"],
-                "snapshottype": snapshot["snapshottype"],
-                "tags": tags_string}), ]
+            tmp_snapshots.append(acs_records.Snapshot(
+                domain=snapshot["domain"],
+                project=snapshot_project,
+                vmname=volume_virtualmachinename,
+                volname=volume_name,
+                snapshot_name=snapshot["name"],
+                vm_or_vol_snappy='Volume Snapshot',
+                snapshot_state=snapshot["state"],
+                created=snapshot["created"],
+                virtualsize_gb=round(snapshot["virtualsize"]/1024**3, 2),
+                physicalsize_gb=round(snapshot["physicalsize"]/1024**3, 2),
+                intervaltype=snapshot["intervaltype"],
+                revertable=snapshot["revertable"],
+                snapshottype=snapshot["snapshottype"],
+                tags=tags_string))
     return tmp_snapshots
 
 
-def print_vm_snapshots(projectid=""):
+def collect_vm_snapshots(cloudstack, projectid=""):
+    """ Collects all VM snapshots for one project, grouped by VM id."""
+
+    if projectid != "":
+        vmsnapshots = acs_common.fetch_pages(
+            cloudstack, "listVMSnapshot", "vmSnapshot",
+            listall=True,
+            projectid=projectid)
+    else:
+        vmsnapshots = acs_common.fetch_pages(
+            cloudstack, "listVMSnapshot", "vmSnapshot",
+            listall=True)
+
+    vmsnapshots_by_vm = {}
+    for vmsnapshot in vmsnapshots:
+        vmsnapshots_by_vm.setdefault(
+            vmsnapshot["virtualmachineid"], []).append(vmsnapshot)
+    return vmsnapshots_by_vm
+
+
+def print_vm_snapshots(cloudstack, projectid=""):
     """Print all VM Snapshots."""
 
     tmp_snapshots = []
 
+    vmsnapshots_by_vm = collect_vm_snapshots(cloudstack, projectid)
+    if not vmsnapshots_by_vm:
+        return tmp_snapshots
+
     if projectid != "":
-        vms_container = cs.listVirtualMachines(
+        vms_container = cloudstack.listVirtualMachines(
             listall=True,
+            details="min",
             projectid=projectid)
     else:
-        vms_container = cs.listVirtualMachines(listall=True)
+        vms_container = cloudstack.listVirtualMachines(
+            listall=True, details="min")
 
     if vms_container != {}:
         vms = vms_container["virtualmachine"]
         for vm in vms:
             vm_name = vm["name"]
             vm_id = vm["id"]
-            if projectid != "":
-                vmsnapshots_container = cs.listVMSnapshot(
-                    listall=True,
-                    virtualmachineid=vm_id, projectid=projectid)
-            else:
-                vmsnapshots_container = cs.listVMSnapshot(
-                    listall=True,
-                    virtualmachineid=vm_id)
-
-            if vmsnapshots_container != {}:
-                vmsnapshots = vmsnapshots_container["vmSnapshot"]
-                for vmsnapshot in vmsnapshots:
-                    # pprint.pprint(vmsnapshot)
-
-                    tags_string = ''
-                    for tag in vmsnapshot["tags"]:
-                        tags_string = (
-                                tags_string +
-                                f'{tag["key"]}=\"{tag["value"]}\" ')
-
-                    # if tags_string != "":
-                    #     print(tags_string)
-
-                    tmp_snapshots = tmp_snapshots + [({
-                        "domain": vmsnapshot["domain"],
-                        "project": vmsnapshot["project"],
-                        "vmname": vm_name,
-                        "volname": 'n.a.',
-                        "snapshot_name": vmsnapshot["name"],
-                        "vm_or_vol_snappy": 'VM Snapshot',
-                        "snapshot_state": vmsnapshot["state"],
-                        "created": vmsnapshot["created"],
-                        "virtualsize_gb": vmsnapshot["physicalsize"]/1024,
-                        "physicalsize_gb": vmsnapshot["physicalsize"]/1024,
-                        "tags": tags_string})]
+            for vmsnapshot in vmsnapshots_by_vm.get(vm_id, []):
+                # pprint.pprint(vmsnapshot)
+
+                tags_string = ''
+                for tag in vmsnapshot["tags"]:
+                    tags_string = (
+                            tags_string +
+                            f'{tag["key"]}=\"{tag["value"]}\" ')
+
+                # if tags_string != "":
+                #     print(tags_string)
+
+                tmp_snapshots.append(acs_records.Snapshot(
+                    domain=vmsnapshot["domain"],
+                    project=vmsnapshot["project"],
+                    vmname=vm_name,
+                    volname='n.a.',
+                    snapshot_name=vmsnapshot["name"],
+                    vm_or_vol_snappy='VM Snapshot',
+                    snapshot_state=vmsnapshot["state"],
+                    created=vmsnapshot["created"],
+                    virtualsize_gb=vmsnapshot["physicalsize"]/1024,
+                    physicalsize_gb=vmsnapshot["physicalsize"]/1024,
+                    tags=tags_string))
     return tmp_snapshots
 
 
@@ -187,34 +214,31 @@ else:
     outputfile = sys.stdout
 
 # Reads ~/.cloudstack.ini
-cs = CloudStack(**read_config())
+cs = acs_client.get_cloudstack(args)
 
-projects_container = cs.listProjects(listall=True)
-# pprint.pprint(projects_container)
-if projects_container != {}:
-    projects = projects_container["project"]
-else:
-    projects = {}
+with acs_profile.phase("collect"):
+    projects_container = cs.listProjects(listall=True)
+    # pprint.pprint(projects_container)
+    if projects_container != {}:
+        projects = projects_container["project"]
+    else:
+        projects = {}
 
-all_snapshots = []
+    all_snapshots = []
 
-if not args.only_vm_snapshots:
-    for project in sorted(projects, key=lambda key: key["name"]):
-        project_name = project["name"]
-        project_id = project["id"]
-        all_snapshots = all_snapshots + (print_volume_snapshots(project_id))
-    all_snapshots = all_snapshots + (print_volume_snapshots())
+    if not args.only_vm_snapshots:
+        all_snapshots = all_snapshots + acs_common.collect_projects(
+            print_volume_snapshots, cs, projects)
+        all_snapshots = all_snapshots + (print_volume_snapshots(cs))
 
-if not args.only_volume_snapshots:
-    # if args.only_vm_snapshots:
-    #     outputfile.write(
-    #         'Domain;Projekt;VM Name;Volumename;Snapshot Name;'
-    #         'VM or Volume Snapshot;State;Created\n')
-    for project in sorted(projects, key=lambda key: key["name"]):
-        project_name = project["name"]
-        project_id = project["id"]
-        all_snapshots = all_snapshots + (print_vm_snapshots(project_id))
-    all_snapshots = all_snapshots + (print_vm_snapshots())
+    if not args.only_volume_snapshots:
+        # if args.only_vm_snapshots:
+        #     outputfile.write(
+        #         'Domain;Projekt;VM Name;Volumename;Snapshot Name;'
+        #         'VM or Volume Snapshot;State;Created\n')
+        all_snapshots = all_snapshots + acs_common.collect_projects(
+            print_vm_snapshots, cs, projects)
+        all_snapshots = all_snapshots + (print_vm_snapshots(cs))
 
 
 outputfile.write(
@@ -224,27 +248,31 @@ outputfile.write(
     'Revertable;Type;Tags\n')
 # pprint.pprint(all_snapshots)
 # pylint: disable=redefined-outer-name
-for snapshot in sorted(all_snapshots, key=lambda i: (
+with acs_profile.phase("sort"):
+    sorted_snapshots = sorted(all_snapshots, key=lambda i: (
         i["domain"].lower(), i["project"].lower(),
-        i["vmname"].lower(), i["volname"].lower(), i["created"])):
-    if snapshot["vm_or_vol_snappy"] == 'Volume Snapshot':
-        outputfile.write(
-            f'{snapshot["domain"]};{snapshot["project"]};{snapshot["vmname"]};'
-            f'{snapshot["volname"]};{snapshot["snapshot_name"]};'
-            f'{snapshot["vm_or_vol_snappy"]};'
-            f'{snapshot["snapshot_state"]};{snapshot["created"]};'
-            f'{snapshot["virtualsize_gb"]};{snapshot["physicalsize_gb"]};'
-            f'{snapshot["intervaltype"]};'
-            f'{snapshot["revertable"]};{snapshot["snapshottype"]};'
-            f'{snapshot["tags"]}\n')
-    else:
-        outputfile.write(
-            f'{snapshot["domain"]};{snapshot["project"]};'
-            f'{snapshot["vmname"]};n.a.;'
-            f'{snapshot["snapshot_name"]};{snapshot["vm_or_vol_snappy"]};'
-            f'{snapshot["snapshot_state"]};{snapshot["created"]};'
-            f'n.a.;n.a.;'
-            f'n.a.;n.a.;{snapshot["tags"]}\n')
+        i["vmname"].lower(), i["volname"].lower(), i["created"]))
+with acs_profile.phase("write"):
+    for snapshot in sorted_snapshots:
+        if snapshot["vm_or_vol_snappy"] == 'Volume Snapshot':
+            outputfile.write(
+                f'{snapshot["domain"]};'
+                f'{snapshot["project"]};{snapshot["vmname"]};'
+                f'{snapshot["volname"]};{snapshot["snapshot_name"]};'
+                f'{snapshot["vm_or_vol_snappy"]};'
+                f'{snapshot["snapshot_state"]};{snapshot["created"]};'
+                f'{snapshot["virtualsize_gb"]};{snapshot["physicalsize_gb"]};'
+                f'{snapshot["intervaltype"]};'
+                f'{snapshot["revertable"]};{snapshot["snapshottype"]};'
+                f'{snapshot["tags"]}\n')
+        else:
+            outputfile.write(
+                f'{snapshot["domain"]};{snapshot["project"]};'
+                f'{snapshot["vmname"]};n.a.;'
+                f'{snapshot["snapshot_name"]};{snapshot["vm_or_vol_snappy"]};'
+                f'{snapshot["snapshot_state"]};{snapshot["created"]};'
+                f'n.a.;n.a.;'
+                f'n.a.;n.a.;{snapshot["tags"]}\n')
 
 
 if args.name_outputfile is not None:
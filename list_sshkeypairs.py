@@ -6,7 +6,9 @@ import sys
 # import pprint
 import argparse
 import textwrap
-from cs import CloudStack, read_config
+import acs_client
+import acs_common
+import acs_profile
 
 
 def prepare_arguments():
@@ -48,34 +50,43 @@ def prepare_arguments():
         dest='name_outputfile',
         help='Write output to file.',
         required=False)
+    parser.add_argument(
+        '--cross-project-query',
+        dest='cross_project_query',
+        help='Query all projects at once (projectid=-1).',
+        action='store_true',
+        required=False)
+    acs_client.add_arguments(parser)
     args = parser.parse_args()
 
     return args
 
 
-def collect_sshkeys(cloudstack, project="n.a."):
-    """ Collects all keys for one project. """
+def collect_sshkeys(cloudstack, projectid="", project_names=None):
+    """ Collects all keys for one project. project_names maps project ids to
+    project names. """
 
-    if project != "n.a.":
-        sshkeys_container = cloudstack.listSSHKeyPairs(
+    if project_names is None:
+        project_names = {}
+
+    if projectid != "":
+        sshkeys = list(acs_common.fetch_pages(
+            cloudstack, "listSSHKeyPairs", "sshkeypair",
             listall=True,
-            projectid=project["id"])
-        projectname = project["name"]
-    else:
-        sshkeys_container = cloudstack.listSSHKeyPairs(listall=True)
-        projectname = "n.a."
-
-    if sshkeys_container != {}:
-        sshkeys = sshkeys_container["sshkeypair"]
-        for sshkey in sshkeys:
-            sshkey["project"] = projectname
-            # for key in ["project", "projectid"]:
-            #     if key not in sshkey:
-            #         sshkey[key] = "n.a."
-            if sshkey["domain"] == "ROOT":
-                sshkey["domain"] = " ROOT"
+            projectid=projectid))
     else:
-        sshkeys = []
+        sshkeys = list(acs_common.fetch_pages(
+            cloudstack, "listSSHKeyPairs", "sshkeypair",
+            listall=True))
+
+    for sshkey in sshkeys:
+        sshkey["project"] = project_names.get(
+            sshkey.get("projectid", projectid), "n.a.")
+        # for key in ["project", "projectid"]:
+        #     if key not in sshkey:
+        #         sshkey[key] = "n.a."
+        if sshkey["domain"] == "ROOT":
+            sshkey["domain"] = " ROOT"
 
     return sshkeys
 
@@ -106,14 +117,17 @@ def print_sshkeys(filtered_sshkeys, outputfile):
         'Domain;Project;Name\n')
     outputfile.write(output_string)
 
-    for sshkey in sorted(filtered_sshkeys, key=lambda i: (
+    with acs_profile.phase("sort"):
+        sorted_sshkeys = sorted(filtered_sshkeys, key=lambda i: (
             i["domain"],
             i["project"],
-            i["name"])):
-        output_string = (
-            f'{sshkey["domain"]};{sshkey["project"]};'
-            f'{sshkey["name"]}')
-        outputfile.write(f'{output_string}\n')
+            i["name"]))
+    with acs_profile.phase("write"):
+        for sshkey in sorted_sshkeys:
+            output_string = (
+                f'{sshkey["domain"]};{sshkey["project"]};'
+                f'{sshkey["name"]}')
+            outputfile.write(f'{output_string}\n')
 
 
 def main():
@@ -126,20 +140,25 @@ def main():
         outputfile = sys.stdout
 
     # Reads ~/.cloudstack.ini
-    cloudstack = CloudStack(**read_config())
+    cloudstack = acs_client.get_cloudstack(args)
 
-    all_sshkeys = collect_sshkeys(cloudstack)
+    with acs_profile.phase("collect"):
+        projects_container = cloudstack.listProjects(listall=True)
+        projects = projects_container["project"]
+        project_names = {
+            project["id"]: project["name"] for project in projects}
 
-    projects_container = cloudstack.listProjects(listall=True)
-    projects = projects_container["project"]
+        all_sshkeys = collect_sshkeys(cloudstack, project_names=project_names)
 
-    for project in sorted(projects, key=lambda key: key["name"]):
-        all_sshkeys = all_sshkeys + collect_sshkeys(
-            cloudstack, project)
+        all_sshkeys = all_sshkeys + acs_common.collect_projects(
+            lambda cloudstack, projectid: collect_sshkeys(
+                cloudstack, projectid, project_names),
+            cloudstack, projects, args.cross_project_query)
 
     # pprint.pprint(all_sshkeys)
 
-    filtered_sshkeys = filter_sshkeys(all_sshkeys, args)
+    with acs_profile.phase("filter"):
+        filtered_sshkeys = list(filter_sshkeys(all_sshkeys, args))
 
     print_sshkeys(filtered_sshkeys, outputfile)
 
@@ -7,7 +7,9 @@ import sys
 # import pprint
 import argparse
 import textwrap
-from cs import CloudStack, read_config
+import acs_client
+import acs_common
+import acs_profile
 
 parser = argparse.ArgumentParser(
     prog='list_systemvms.py',
@@ -57,19 +59,20 @@ parser.add_argument('-o', '--outputfile',
                     dest='name_outputfile',
                     help='Write output to file.',
                     required=False)
+acs_client.add_arguments(parser)
 args = parser.parse_args()
 
 
-def collect_systemvms(projectid="", projectname=""):
+def collect_systemvms(cloudstack, projectid="", projectname=""):
     """ Collects all system VM for one project. """
 
     tmp_systemvms = []
     if projectid != "":
-        systemvms_container = cs.listSystemVms(
+        systemvms_container = cloudstack.listSystemVms(
             listall=True,
             projectid=projectid)
     else:
-        systemvms_container = cs.listSystemVms(listall=True)
+        systemvms_container = cloudstack.listSystemVms(listall=True)
 
     if systemvms_container != {}:
         systemvms = systemvms_container["systemvm"]
@@ -89,15 +92,15 @@ def collect_systemvms(projectid="", projectname=""):
     return tmp_systemvms
 
 
-def collect_routers(projectid="", projectname=""):
+def collect_routers(cloudstack, projectid="", projectname=""):
     """ Collects all virtual routers for one project. """
     tmp_routers = []
     if projectid != "":
-        routers_container = cs.listRouters(
+        routers_container = cloudstack.listRouters(
             listall=True,
             projectid=projectid)
     else:
-        routers_container = cs.listRouters(listall=True)
+        routers_container = cloudstack.listRouters(listall=True)
 
     if routers_container != {}:
         routers = routers_container["router"]
@@ -132,18 +135,20 @@ else:
     outputfile = sys.stdout
 
 # Reads ~/.cloudstack.ini
-cs = CloudStack(**read_config())
+cs = acs_client.get_cloudstack(args)
 
-all_systemvms = collect_routers()
-all_systemvms = all_systemvms + collect_systemvms()
+with acs_profile.phase("collect"):
+    all_systemvms = collect_routers(cs)
+    all_systemvms = all_systemvms + collect_systemvms(cs)
 
-projects_container = cs.listProjects(listall=True)
-projects = projects_container["project"]
+    projects_container = cs.listProjects(listall=True)
+    projects = projects_container["project"]
 
-for project in sorted(projects, key=lambda key: key["name"]):
-    project_name = project["name"]
-    project_id = project["id"]
-    all_systemvms = all_systemvms + collect_routers(project_id, project_name)
+    project_names = {project["id"]: project["name"] for project in projects}
+    all_systemvms = all_systemvms + acs_common.collect_projects(
+        lambda cloudstack, projectid: collect_routers(
+            cloudstack, projectid, project_names[projectid]),
+        cs, projects)
 
 # pprint.pprint(sorted(all_systemvms, key=lambda i: (
 #         i["project"], i["name"])))
@@ -153,16 +158,19 @@ outputfile.write(
     'Redundant State of Router; State;Name;Hostname;'
     'Public IP;Linklocal IP\n')
 
-for systemvm in sorted(all_systemvms, key=lambda i: (
-        i["project"], i["type"], i["router_guestnetworkname"])):
-    outputfile.write(
-        f'{systemvm["project"]};{systemvm["type"]};'
-        f'{systemvm["router_guestnetworkname"]};'
-        f'{systemvm["router_isredundantrouter"]};'
-        f'{systemvm["router_redundantstate"]};'
-        f'{systemvm["state"]};'
-        f'{systemvm["name"]};{systemvm["hostname"]};'
-        # f'{systemvm["ipaddress"]};'
-        f'{systemvm["linklocalip"]}\n')
+with acs_profile.phase("sort"):
+    sorted_systemvms = sorted(all_systemvms, key=lambda i: (
+        i["project"], i["type"], i["router_guestnetworkname"]))
+with acs_profile.phase("write"):
+    for systemvm in sorted_systemvms:
+        outputfile.write(
+            f'{systemvm["project"]};{systemvm["type"]};'
+            f'{systemvm["router_guestnetworkname"]};'
+            f'{systemvm["router_isredundantrouter"]};'
+            f'{systemvm["router_redundantstate"]};'
+            f'{systemvm["state"]};'
+            f'{systemvm["name"]};{systemvm["hostname"]};'
+            # f'{systemvm["ipaddress"]};'
+            f'{systemvm["linklocalip"]}\n')
 if args.name_outputfile is not None:
     outputfile.close()
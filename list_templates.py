@@ -7,8 +7,13 @@ import sys
 # import pprint
 import argparse
 import textwrap
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-from cs import CloudStack, read_config
+from requests.exceptions import RequestException
+from cs import CloudStackException
+import acs_client
+import acs_common
+import acs_profile
 
 parser = argparse.ArgumentParser(
     prog='list_templates.py',
@@ -46,6 +51,9 @@ parser = argparse.ArgumentParser(
     Send output to file:
         python list_templates.py -o some-outputfile.csv
 
+    Run 16 API calls at a time:
+        python list_templates.py --workers 16
+
     Additional Infos:
 
     Uses the "CS" CloudStack API Client. See https://github.com/exoscale/cs.
@@ -65,74 +73,161 @@ parser.add_argument('-o', '--outputfile',
                     dest='name_outputfile',
                     help='Write output to file.',
                     required=False)
+parser.add_argument('--workers',
+                    dest='workers',
+                    help='Number of concurrent API calls (default: 1).',
+                    type=int,
+                    default=1,
+                    required=False)
+
+acs_client.add_arguments(parser)
 
 args = parser.parse_args()
+if args.workers < 1:
+    parser.error('--workers must be at least 1.')
+if args.workers > 1 and args.async_concurrency > 0:
+    parser.error('--workers can not be combined with --async.')
 
 
-def collect_templates(list_templatefilter, projectid=""):
-    """ Collect all template datasets."""
+def template_filters(list_templatefilter, projectid=""):
+    """ Template filters to query for one project."""
+    worklist = list_templatefilter.copy()
     if projectid != "":
         # pprint.pprint(list_templatefilter)
-        worklist = list_templatefilter.copy()
         for filter_flag in ["featured", "community", "executable"]:
             if filter_flag in worklist:
                 worklist.remove(filter_flag)
-    else:
-        worklist = list_templatefilter.copy()
+    return worklist
+
+
+def collect_templates(cloudstack, loop_templatefilter, projectid=""):
+    """ Collect all template datasets for one template filter."""
 
     temp_templates = []
 
-    for loop_templatefilter in worklist:
-        if projectid != "":
-            templates_container = cs.listTemplates(
-                listall=True,
-                templatefilter=loop_templatefilter,
-                projectid=projectid)
-        else:
-            templates_container = cs.listTemplates(
-                listall=True,
-                templatefilter=loop_templatefilter)
-
-        if templates_container != {}:
-            templates = templates_container["template"]
-            for template in templates:
-                # pprint.pprint(template)
-                for key in ["project", "size", "bootable"]:
-                    if key not in template:
-                        template[key] = "n.a."
-
-                if isinstance(template["size"], int):
-                    template["size"] = round(template["size"]/1024**3, 2)
-
-                tags_string = ''
-                for tag in template["tags"]:
-                    tags_string = (
-                            tags_string +
-                            f'{tag["key"]}=\"{tag["value"]}\" ')
-
-                temp_templates = temp_templates + [{
-                    "id": template["id"],
-                    "domain": template["domain"],
-                    "project": template["project"],
-                    "name": template["name"],
-                    "displaytext": template["displaytext"],
-                    "used_filter": loop_templatefilter,
-                    "status": template["status"],
-                    "size": template["size"],
-                    "hypervisor": template["hypervisor"],
-                    "ostypename": template["ostypename"],
-                    "format": template["format"],
-                    "bootable": template["bootable"],
-                    "isdynamicallyscalable":
-                        template["isdynamicallyscalable"],
-                    "isextractable": template["isextractable"],
-                    "ispublic": template["ispublic"],
-                    "isready": template["isready"],
-                    "passwordenabled": template["passwordenabled"],
-                    "tags": tags_string}, ]
+    if projectid != "":
+        templates_container = cloudstack.listTemplates(
+            listall=True,
+            templatefilter=loop_templatefilter,
+            projectid=projectid)
+    else:
+        templates_container = cloudstack.listTemplates(
+            listall=True,
+            templatefilter=loop_templatefilter)
+
+    if templates_container != {}:
+        templates = templates_container["template"]
+        for template in templates:
+            # pprint.pprint(template)
+            for key in ["project", "size", "bootable"]:
+                if key not in template:
+                    template[key] = "n.a."
+
+            if isinstance(template["size"], int):
+                template["size"] = round(template["size"]/1024**3, 2)
+
+            tags_string = ''
+            for tag in template["tags"]:
+                tags_string = (
+                        tags_string +
+                        f'{tag["key"]}=\"{tag["value"]}\" ')
+
+            temp_templates = temp_templates + [{
+                "id": template["id"],
+                "domain": template["domain"],
+                "project": template["project"],
+                "name": template["name"],
+                "displaytext": template["displaytext"],
+                "used_filter": loop_templatefilter,
+                "status": template["status"],
+                "size": template["size"],
+                "hypervisor": template["hypervisor"],
+                "ostypename": template["ostypename"],
+                "format": template["format"],
+                "bootable": template["bootable"],
+                "isdynamicallyscalable":
+                    template["isdynamicallyscalable"],
+                "isextractable": template["isextractable"],
+                "ispublic": template["ispublic"],
+                "isready": template["isready"],
+                "passwordenabled": template["passwordenabled"],
+                "tags": tags_string}, ]
     return temp_templates
 
 
+def collect_all_templates(cloudstack, list_templatefilter, projects, workers):
+    """ Collect templates for all template filters of all projects and
+    without project. The calls run on a pool of worker threads sharing the
+    API client. Failed calls are reported and skipped.
+
+    Returns the templates and the number of failed calls."""
+
+    def collect_cell(cell):
+        loop_templatefilter, projectid, _ = cell
+        return collect_templates(cloudstack, loop_templatefilter, projectid)
+
+    cells = []
+    for project in sorted(projects, key=lambda key: key["name"]):
+        for loop_templatefilter in template_filters(
+                list_templatefilter, project["id"]):
+            cells.append((loop_templatefilter, project["id"], project["name"]))
+    for loop_templatefilter in template_filters(list_templatefilter):
+        cells.append((loop_templatefilter, "", "n.a."))
+
+    temp_templates = []
+    failed_cells = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(collect_cell, cell): cell for cell in cells}
+        for future in as_completed(futures):
+            try:
+                temp_templates.extend(future.result())
+            except (CloudStackException, RequestException) as error:
+                loop_templatefilter, _, project_name = futures[future]
+                print(
+                    f'Listing templates with filter "{loop_templatefilter}" '
+                    f'for project "{project_name}" failed: {error}',
+                    file=sys.stderr)
+                failed_cells = failed_cells + 1
+    return temp_templates, failed_cells
+
+
+def collect_all_templates_async(cloudstack, list_templatefilter, projects):
+    """ Collect templates for all template filters of all projects and
+    without project. The projects are queried concurrently by
+    acs_common.collect_projects() on the asyncio engine. Failed calls are
+    reported and skipped.
+
+    Returns the templates and the number of failed calls."""
+
+    project_names = {project["id"]: project["name"] for project in projects}
+    # The collector runs again for each round of prefetched responses,
+    # failed calls are only reported and counted once.
+    failed_cells = set()
+
+    def collect_project(cloudstack, projectid):
+        project_templates = []
+        for loop_templatefilter in template_filters(
+                list_templatefilter, projectid):
+            try:
+                project_templates.extend(collect_templates(
+                    cloudstack, loop_templatefilter, projectid))
+            except (CloudStackException, RequestException) as error:
+                if (loop_templatefilter, projectid) not in failed_cells:
+                    print(
+                        f'Listing templates with filter '
+                        f'"{loop_templatefilter}" for project '
+                        f'"{project_names.get(projectid, "n.a.")}" '
+                        f'failed: {error}',
+                        file=sys.stderr)
+                    failed_cells.add((loop_templatefilter, projectid))
+        return project_templates
+
+    temp_templates = acs_common.collect_projects(
+        collect_project, cloudstack, projects)
+    temp_templates = temp_templates + collect_project(cloudstack, "")
+    return temp_templates, len(failed_cells)
+
+
 if args.name_outputfile is not None:
     outputfile = open(args.name_outputfile, 'w')
 else:
@@ -146,58 +241,52 @@ else:
         "featured", "self", "selfexecutable", "sharedexecutable",
         "executable", "community"]
 # Reads ~/.cloudstack.ini
-cs = CloudStack(**read_config())
+cs = acs_client.get_cloudstack(args)
 
-projects_container = cs.listProjects(listall=True)
-projects = projects_container["project"]
+with acs_profile.phase("collect"):
+    projects_container = cs.listProjects(listall=True)
+    projects = projects_container["project"]
 
-all_templates = []
-
-for project in sorted(projects, key=lambda key: key["name"]):
-    project_name = project["name"]
-    project_id = project["id"]
-    # pprint.pprint(templatefilter)
-    all_templates = all_templates + collect_templates(
-        projectid=project_id, list_templatefilter=templatefilter)
-# pprint.pprint(templatefilter)
-all_templates = all_templates + collect_templates(
-        projectid="", list_templatefilter=templatefilter)
+    if getattr(cs, "async_concurrency", 0) > 0:
+        all_templates, failed_calls = collect_all_templates_async(
+            cs, templatefilter, projects)
+    else:
+        all_templates, failed_calls = collect_all_templates(
+            cs, templatefilter, projects, args.workers)
 
 # Filter out duplicates
 
 # pprint.pprint(all_templates)
-templates_condensed = []
-last_id = ''
-for loop_template in sorted(all_templates, key=lambda i: (
-        i["id"],
-        i["used_filter"])):
-
-    if loop_template["id"] != last_id:
-        templates_condensed = templates_condensed + [loop_template.copy(), ]
-    else:
-        templates_condensed[-1]["used_filter"] = (
-            f'{templates_condensed[-1]["used_filter"]}/'
-            f'{loop_template["used_filter"]}')
-    last_id = loop_template["id"]
+with acs_profile.phase("filter"):
+    templates_condensed = acs_common.merge_duplicates(
+        all_templates, "used_filter")
+    for loop_template in templates_condensed:
+        loop_template["used_filter"] = "/".join(
+            sorted(loop_template["used_filter"]))
 
 outputfile.write(
     'Domain;Project;Name;Displaytext;Templatetype;'
     'Status;Size GB;Hypervisor;OSTypename;'
     'Format;Bootable;isDynamicallyScalable;isExtractable;isPublic;isReady;'
     'Passwordenabled;Tags\n')
-for loop_template in sorted(templates_condensed, key=lambda i: (
-        i["domain"], i["project"], i["name"])):
-    outputfile.write(
-        f'{loop_template["domain"]};{loop_template["project"]};'
-        f'{loop_template["name"]};{loop_template["displaytext"]};'
-        f'{loop_template["used_filter"]};'
-        f'{loop_template["status"]};'
-        f'{loop_template["size"]};{loop_template["hypervisor"]};'
-        f'{loop_template["ostypename"]};'
-        f'{loop_template["format"]};{loop_template["bootable"]};'
-        f'{loop_template["isdynamicallyscalable"]};'
-        f'{loop_template["isextractable"]};'
-        f'{loop_template["ispublic"]};{loop_template["isready"]};'
-        f'{loop_template["passwordenabled"]};{loop_template["tags"]}\n')
+with acs_profile.phase("sort"):
+    sorted_templates = sorted(templates_condensed, key=lambda i: (
+        i["domain"], i["project"], i["name"], i["id"]))
+with acs_profile.phase("write"):
+    for loop_template in sorted_templates:
+        outputfile.write(
+            f'{loop_template["domain"]};{loop_template["project"]};'
+            f'{loop_template["name"]};{loop_template["displaytext"]};'
+            f'{loop_template["used_filter"]};'
+            f'{loop_template["status"]};'
+            f'{loop_template["size"]};{loop_template["hypervisor"]};'
+            f'{loop_template["ostypename"]};'
+            f'{loop_template["format"]};{loop_template["bootable"]};'
+            f'{loop_template["isdynamicallyscalable"]};'
+            f'{loop_template["isextractable"]};'
+            f'{loop_template["ispublic"]};{loop_template["isready"]};'
+            f'{loop_template["passwordenabled"]};{loop_template["tags"]}\n')
 if args.name_outputfile is not None:
     outputfile.close()
+if failed_calls:
+    sys.exit(1)
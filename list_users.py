@@ -7,7 +7,8 @@ import sys
 import pprint
 import argparse
 import textwrap
-from cs import CloudStack, read_config
+import acs_client
+import acs_profile
 
 parser = argparse.ArgumentParser(
     prog='list_users.py',
@@ -51,6 +52,7 @@ parser.add_argument('-o', '--outputfile',
                     dest='name_outputfile',
                     help='Write output to file.',
                     required=False)
+acs_client.add_arguments(parser, with_async=False)
 args = parser.parse_args()
 
 
@@ -79,23 +81,27 @@ else:
     outputfile = sys.stdout
 
 # Reads ~/.cloudstack.ini
-cs = CloudStack(**read_config())
+cs = acs_client.get_cloudstack(args)
 
-all_users = print_users()
+with acs_profile.phase("collect"):
+    all_users = print_users()
 
 outputfile.write(
     'Domain;Username;First Name;Last Name;'
     'Email;Created;\n')
 
 # pylint: disable=redefined-outer-name
-for user in sorted(all_users, key=lambda i: (
+with acs_profile.phase("sort"):
+    sorted_users = sorted(all_users, key=lambda i: (
         i["domain"].lower(),
-        i["account"].lower(), i["username"].lower())):
-    outputfile.write(
-        f'{user["domain"]};'
-        f'{user["username"]};'
-        f'{user["firstname"]};{user["lastname"]};'
-        f'{user["email"]};{user["created"]}\n')
+        i["account"].lower(), i["username"].lower()))
+with acs_profile.phase("write"):
+    for user in sorted_users:
+        outputfile.write(
+            f'{user["domain"]};'
+            f'{user["username"]};'
+            f'{user["firstname"]};{user["lastname"]};'
+            f'{user["email"]};{user["created"]}\n')
 
 
 if args.name_outputfile is not None:
@@ -7,7 +7,12 @@ import sys
 # import pprint
 import argparse
 import textwrap
-from cs import CloudStack, read_config
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+import acs_client
+import acs_common
+import acs_profile
+import acs_records
 
 
 def prepare_arguments():
@@ -33,6 +38,12 @@ def prepare_arguments():
         List only stopped VMs:
             ./list_vms.py --only-stopped-vms
 
+        Write VMs as they arrive, without sorting:
+            ./list_vms.py --no-sort --page-size 200
+
+        Collect the VMs of 16 projects at a time:
+            ./list_vms.py --workers 16
+
         Additional Infos:
 
         Uses the "CS" CloudStack API Client.
@@ -84,115 +95,225 @@ def prepare_arguments():
         dest='name_outputfile',
         help='Write output to file.',
         required=False)
+    parser.add_argument(
+        '--cross-project-query',
+        dest='cross_project_query',
+        help='Query all projects at once (projectid=-1).',
+        action='store_true',
+        required=False)
+    parser.add_argument(
+        '--page-size',
+        dest='page_size',
+        help=f'Number of VMs fetched per API call '
+             f'(default: {acs_common.PAGESIZE}).',
+        type=int,
+        default=acs_common.PAGESIZE,
+        required=False)
+    parser.add_argument(
+        '--no-sort',
+        dest='no_sort',
+        help='Write VMs as they arrive instead of sorting them. Network '
+             'columns are repeated for every NIC.',
+        action='store_true',
+        required=False)
+    parser.add_argument(
+        '--workers',
+        dest='workers',
+        help='Number of projects to collect concurrently (default: 1).',
+        type=int,
+        default=1,
+        required=False)
+    acs_client.add_arguments(parser)
     args = parser.parse_args()
 
+    if args.workers < 1:
+        parser.error('--workers must be at least 1.')
+    if args.workers > 1 and args.async_concurrency > 0:
+        parser.error('--workers can not be combined with --async.')
+    if args.page_size < 1:
+        parser.error('--page-size must be at least 1.')
+
     return args
 
 
-def collect_vms(cs, with_total_volumes, projectid=""):
-    """ Collects all VMs for one project. """
+def collect_volume_totals(cs, projectid=""):
+    """ Collects all volumes for one project with a single listing and sums
+    up size and count per VM. """
 
-    project_vms = []
     if projectid != "":
-        vms_container = cs.listVirtualMachines(
+        volumes = acs_common.fetch_pages(
+            cs, "listVolumes", "volume",
             listall=True,
             projectid=projectid)
     else:
-        vms_container = cs.listVirtualMachines(listall=True)
-
-    if vms_container != {}:
-        project_vms = vms_container["virtualmachine"]
-        for my_vm in project_vms:
-            for key in ["project", "projectid", "hostname"]:
-                if key not in my_vm:
-                    my_vm[key] = "n.a."
-
-            if with_total_volumes:
-                tmp_volumestotal = 0
-                tmp_volumescount = 0
-
-                if my_vm["projectid"] == "n.a.":
-                    volumes_container = cs.listVolumes(
-                        virtualmachineid=my_vm["id"],
-                        listall=True)
-                else:
-                    volumes_container = cs.listVolumes(
-                        virtualmachineid=my_vm["id"],
-                        projectid=my_vm["projectid"],
-                        listall=True)
-                if volumes_container:
-                    volumes = volumes_container["volume"]
-                    for volume in volumes:
-                        tmp_volumestotal = (
-                            tmp_volumestotal + int(volume["size"]))
-                        tmp_volumescount = tmp_volumescount + 1
-                my_vm["volumestotalsize"] = f'{int(tmp_volumestotal/1024**3)}'
-                my_vm["volumescount"] = f'{tmp_volumescount}'
-
-    return project_vms
+        volumes = acs_common.fetch_pages(
+            cs, "listVolumes", "volume",
+            listall=True)
+
+    volume_totals = {}
+    for volume in volumes:
+        if "virtualmachineid" not in volume:
+            continue
+        totals = volume_totals.setdefault(
+            volume["virtualmachineid"], [0, 0])
+        totals[0] = totals[0] + int(volume["size"])
+        totals[1] = totals[1] + 1
+
+    return volume_totals
+
+
+def collect_vms(
+        cs, with_total_volumes, projectid="", vm_filters=None,
+        pagesize=acs_common.PAGESIZE):
+    """ Generator yielding all VMs for one project, fetched page by page.
+    Optional vm_filters are passed to listVirtualMachines. """
+
+    if vm_filters is None:
+        vm_filters = {}
+
+    if projectid != "":
+        project_vms = acs_common.fetch_pages(
+            cs, "listVirtualMachines", "virtualmachine",
+            pagesize=pagesize,
+            listall=True,
+            projectid=projectid,
+            **vm_filters)
+    else:
+        project_vms = acs_common.fetch_pages(
+            cs, "listVirtualMachines", "virtualmachine",
+            pagesize=pagesize,
+            listall=True,
+            **vm_filters)
+
+    volume_totals = None
+    for vm in project_vms:
+        my_vm = acs_records.VirtualMachine(vm)
+
+        if with_total_volumes:
+            if volume_totals is None:
+                volume_totals = collect_volume_totals(cs, projectid)
+            tmp_volumestotal, tmp_volumescount = volume_totals.get(
+                my_vm["id"], [0, 0])
+            my_vm["volumestotalsize"] = f'{int(tmp_volumestotal/1024**3)}'
+            my_vm["volumescount"] = f'{tmp_volumescount}'
+
+        yield my_vm
+
+
+def collect_vms_concurrently(
+        cs, projects, with_total_volumes, workers, vm_filters=None,
+        pagesize=acs_common.PAGESIZE):
+    """ Generator yielding all VMs for a list of projects, collected by a
+    bounded pool of worker threads sharing the API client. Results are
+    yielded in the order of the given projects. """
+
+    def collect_project_vms(project):
+        return list(collect_vms(
+            cs, with_total_volumes, project["id"], vm_filters, pagesize))
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for project_vms in executor.map(collect_project_vms, projects):
+            yield from project_vms
+
+
+def prepare_vm_filters(args, hosts_dict):
+    """ Translate commandline parameters into listVirtualMachines
+    parameters, so the management server only returns matching VMs and
+    only the detail groups needed for the output."""
+    vm_filters = {"details": "servoff"}
+    if args.with_networks:
+        vm_filters["details"] = "servoff,nics"
+    if args.only_running_vms:
+        vm_filters["state"] = "Running"
+    elif args.only_stopped_vms:
+        vm_filters["state"] = "Stopped"
+    if args.host in hosts_dict and hosts_dict[args.host][0] != "n.a.":
+        vm_filters["hostid"] = hosts_dict[args.host][0]
+
+    return vm_filters
 
 
 def filter_vms(all_vms, args):
-    """ Filter set of VMs according to commandline parameters."""
-    filtered_vms = all_vms.copy()
+    """ Filter set of VMs according to commandline parameters. The VMs are
+    filtered while they are consumed."""
+    predicates = []
     if args.only_running_vms:
-        filtered_vms = filter(lambda d: d["state"] == "Running", filtered_vms)
+        predicates.append(lambda d: d["state"] == "Running")
     if args.only_stopped_vms:
-        filtered_vms = filter(lambda d: d["state"] == "Stopped", filtered_vms)
+        predicates.append(lambda d: d["state"] == "Stopped")
     # pprint.pprint(args.host)
     if args.host is not None:
-        filtered_vms = filter(
-            lambda d: d["hostname"] == args.host, filtered_vms)
+        predicates.append(lambda d: d["hostname"] == args.host)
     if args.project is not None:
-        filtered_vms = filter(
-            lambda d: d["project"] == args.project, filtered_vms)
+        predicates.append(lambda d: d["project"] == args.project)
 
-    return filtered_vms
+    return acs_profile.filtered(
+        all_vms, lambda vm: all(
+            predicate(vm) for predicate in predicates))
 
 
-def print_vms(filtered_vms, args, outputfile, hosts_dict):
-    """ Printout list of VMs."""
+def format_vm(vm, args, hosts_dict):
+    """ Format one VM as CSV line."""
+    output_string = (
+        f'{vm["domain"]};{vm["project"]};{vm["name"]};'
+        f'{vm["instancename"]};{vm["state"]};'
+        f'{hosts_dict[vm["hostname"]][1]};{vm["hostname"]};'
+        f'{vm["cpunumber"]};{float(round(vm["memory"]/1024,1))}')
+    if args.with_total_volumes:
+        output_string = (
+            output_string +
+            f';{vm["volumestotalsize"]};{vm["volumescount"]}')
+    if args.with_networks:
+        for nic in sorted(vm["nic"], key=lambda i: i["networkname"]):
+            output_string = (
+                output_string +
+                f';{nic["isdefault"]};{nic["networkname"]}')
 
-    filtered_vms = list(filtered_vms)
+    return output_string
 
-    max_nics = 0
-    if args.with_networks:
-        # Find maximum number of networks assigned to VM
-        for vm in filtered_vms:
-            number_nics = len(vm["nic"])
-            if number_nics > max_nics:
-                max_nics = number_nics
+
+def print_vms(filtered_vms, args, outputfile, hosts_dict):
+    """ Printout list of VMs. The VMs are consumed one by one, for sorting
+    only the formatted lines are kept."""
 
     output_string = (
             'Domain;Project;Name;Instancename;State;'
             'Cluster;Hostname;CPUs;RAM [GB]')
     if args.with_total_volumes:
         output_string = output_string + ';Volumes Total [GB];Volumes Count'
+
+    if args.no_sort:
+        if args.with_networks:
+            output_string = output_string + ';Is Default;Network Name'
+        outputfile.write(f'{output_string}\n')
+        with acs_profile.phase("write"):
+            for vm in filtered_vms:
+                outputfile.write(f'{format_vm(vm, args, hosts_dict)}\n')
+        return
+
+    max_nics = 0
+    vm_lines = []
+    # The VMs are collected while they are consumed.
+    with acs_profile.phase("collect"):
+        for vm in filtered_vms:
+            # Find maximum number of networks assigned to VM
+            if args.with_networks:
+                max_nics = max(max_nics, len(vm["nic"]))
+            vm_lines.append((
+                (vm["domain"], vm["project"], vm["name"]),
+                format_vm(vm, args, hosts_dict)))
+
     if args.with_networks:
-        for i in range(number_nics):
+        for i in range(max_nics):
             output_string = (
                 output_string + f';[{i}] Is Default;[{i}] Network Name')
     outputfile.write(f'{output_string}\n')
 
-    for vm in sorted(filtered_vms, key=lambda i: (
-            i["domain"],
-            i["project"],
-            i["name"])):
-        output_string = (
-            f'{vm["domain"]};{vm["project"]};{vm["name"]};'
-            f'{vm["instancename"]};{vm["state"]};'
-            f'{hosts_dict[vm["hostname"]][1]};{vm["hostname"]};'
-            f'{vm["cpunumber"]};{float(round(vm["memory"]/1024,1))}')
-        if args.with_total_volumes:
-            output_string = (
-                output_string +
-                f';{vm["volumestotalsize"]};{vm["volumescount"]}')
-        if args.with_networks:
-            for nic in sorted(vm["nic"], key=lambda i: i["networkname"]):
-                output_string = (
-                    output_string +
-                    f';{nic["isdefault"]};{nic["networkname"]}')
-        outputfile.write(f'{output_string}\n')
+    with acs_profile.phase("sort"):
+        vm_lines.sort(key=lambda i: i[0])
+    with acs_profile.phase("write"):
+        for _, vm_line in vm_lines:
+            outputfile.write(f'{vm_line}\n')
 
 
 def list_hosts(cs):
@@ -224,22 +345,43 @@ def main():
         outputfile = sys.stdout
 
     # Reads ~/.cloudstack.ini
-    cs = CloudStack(**read_config())
-
-    all_vms = collect_vms(cs, args.with_total_volumes)
-
-    projects_container = cs.listProjects(listall=True)
-    projects = projects_container["project"]
-
-    for project in sorted(projects, key=lambda key: key["name"]):
-        project_id = project["id"]
-        all_vms = all_vms + collect_vms(
-            cs, args.with_total_volumes, project_id)
+    cs = acs_client.get_cloudstack(args)
+
+    with acs_profile.phase("collect"):
+        hosts_dict = list_hosts(cs)
+        vm_filters = prepare_vm_filters(args, hosts_dict)
+
+        # VMs without project are listed with project "n.a.".
+        vm_sources = []
+        if args.project is None or args.project == "n.a.":
+            vm_sources.append(collect_vms(
+                cs, args.with_total_volumes, vm_filters=vm_filters,
+                pagesize=args.page_size))
+
+        projects_container = cs.listProjects(listall=True)
+        projects = sorted(
+            projects_container["project"], key=lambda key: key["name"])
+        if args.project is not None:
+            projects = [
+                project for project in projects
+                if project["name"] == args.project]
+
+        if args.workers > 1 and not args.cross_project_query:
+            vm_sources.append(collect_vms_concurrently(
+                cs, projects, args.with_total_volumes, args.workers,
+                vm_filters, args.page_size))
+        else:
+            vm_sources.append(acs_common.iter_projects(
+                lambda cs, projectid: collect_vms(
+                    cs, args.with_total_volumes, projectid, vm_filters,
+                    args.page_size),
+                cs, projects,
+                args.cross_project_query and args.project is None))
+        all_vms = itertools.chain.from_iterable(vm_sources)
 
     # pprint.pprint(all_vms)
     filtered_vms = filter_vms(all_vms, args)
 
-    hosts_dict = list_hosts(cs)
     # pprint.pprint(all_hosts)
     print_vms(filtered_vms, args, outputfile, hosts_dict)
 
@@ -6,7 +6,10 @@ import sys
 import pprint
 import argparse
 import textwrap
-from cs import CloudStack, read_config
+import acs_client
+import acs_common
+import acs_profile
+import acs_records
 
 
 def prepare_arguments():
@@ -32,6 +35,9 @@ def prepare_arguments():
         List all volumes that are currently not attached to a VM
              ./list_volumes.py --only-detached
 
+        Fetch volumes in pages of 200, 8 pages at a time:
+             ./list_volumes.py --page-size 200 --page-workers 8
+
         Additional Infos:
 
         Uses the "CS" CloudStack API Client.
@@ -65,38 +71,70 @@ def prepare_arguments():
         action='store_true',
         help='Write output to file.',
         required=False)
+    parser.add_argument(
+        '--cross-project-query',
+        dest='cross_project_query',
+        help='Query all projects at once (projectid=-1).',
+        action='store_true',
+        required=False)
+    parser.add_argument(
+        '--page-size',
+        dest='page_size',
+        help=f'Number of volumes fetched per API call '
+             f'(default: {acs_common.PAGESIZE}).',
+        type=int,
+        default=acs_common.PAGESIZE,
+        required=False)
+    parser.add_argument(
+        '--page-workers',
+        dest='page_workers',
+        help='Number of pages to fetch concurrently (default: 1).',
+        type=int,
+        default=1,
+        required=False)
+    acs_client.add_arguments(parser)
     args = parser.parse_args()
 
+    if args.page_size < 1:
+        parser.error('--page-size must be at least 1.')
+    if args.page_workers < 1:
+        parser.error('--page-workers must be at least 1.')
+
     return args
 
 
-def collect_volumes(cloudstack, projectid=""):
+def collect_volumes(
+        cloudstack, projectid="", pagesize=acs_common.PAGESIZE,
+        page_workers=1):
     """ Collects all volumes for one project. """
 
     if projectid != "":
-        volumes_container = cloudstack.listVolumes(
+        volumes = acs_common.fetch_pages_concurrently(
+            cloudstack, "listVolumes", "volume",
+            pagesize=pagesize,
+            workers=page_workers,
             listall=True,
             projectid=projectid)
     else:
-        volumes_container = cloudstack.listVolumes(listall=True)
-
-    if volumes_container != {}:
-        volumes = volumes_container["volume"]
-        for volume in volumes:
-            for key in ["project", "projectid", "diskofferingname", "vmname", "clustername", "storage", "path"]:
-                if key not in volume:
-                    volume[key] = "n.a."
-            if volume["domain"] == "ROOT":
-                volume["domain"] = " ROOT"
-    else:
-        volumes = []
+        volumes = acs_common.fetch_pages_concurrently(
+            cloudstack, "listVolumes", "volume",
+            pagesize=pagesize,
+            workers=page_workers,
+            listall=True)
+
+    project_volumes = []
+    for volume in volumes:
+        volume = acs_records.Volume(volume)
+        if volume.domain == "ROOT":
+            volume.domain = " ROOT"
+        project_volumes.append(volume)
 
-    return volumes
+    return project_volumes
 
 
 def filter_volumes(all_volumes, args):
     """ Filter set of volumes according to commandline parameters."""
-    filtered_volumes = all_volumes.copy()
+    filtered_volumes = all_volumes
 
     if args.project:
         filtered_volumes = filter(
@@ -121,18 +159,23 @@ def print_volumes(filtered_volumes, outputfile):
         'Size [GB];Diskoffering;Path\n')
     outputfile.write(output_string)
 
-    for volumes in sorted(filtered_volumes, key=lambda i: (
+    with acs_profile.phase("sort"):
+        sorted_volumes = sorted(filtered_volumes, key=lambda i: (
             i["domain"],
             i["project"],
-            i["name"])):
-        output_string = (
-            f'{volumes["domain"]};{volumes["project"]};'
-            f'{volumes["vmname"]};{volumes["type"]};{volumes["clustername"]};'
-            f'{volumes["hypervisor"]};'
-            f'{volumes["storage"]};{volumes["name"]};'
-            f'{int(volumes["size"]/1024**3)};{volumes["diskofferingname"]};'
-            f'{volumes["path"]}')
-        outputfile.write(f'{output_string}\n')
+            i["name"]))
+    with acs_profile.phase("write"):
+        for volumes in sorted_volumes:
+            output_string = (
+                f'{volumes["domain"]};{volumes["project"]};'
+                f'{volumes["vmname"]};'
+                f'{volumes["type"]};{volumes["clustername"]};'
+                f'{volumes["hypervisor"]};'
+                f'{volumes["storage"]};{volumes["name"]};'
+                f'{int(volumes["size"]/1024**3)};'
+                f'{volumes["diskofferingname"]};'
+                f'{volumes["path"]}')
+            outputfile.write(f'{output_string}\n')
 
 
 def main():
@@ -145,21 +188,25 @@ def main():
         outputfile = sys.stdout
 
     # Reads ~/.cloudstack.ini
-    cloudstack = CloudStack(**read_config())
+    cloudstack = acs_client.get_cloudstack(args)
 
-    all_volumes = collect_volumes(cloudstack)
+    with acs_profile.phase("collect"):
+        all_volumes = collect_volumes(
+            cloudstack, pagesize=args.page_size,
+            page_workers=args.page_workers)
 
-    projects_container = cloudstack.listProjects(listall=True)
-    projects = projects_container["project"]
+        projects_container = cloudstack.listProjects(listall=True)
+        projects = projects_container["project"]
 
-    for project in sorted(projects, key=lambda key: key["name"]):
-        project_id = project["id"]
-        all_volumes = all_volumes + collect_volumes(
-            cloudstack, project_id)
+        all_volumes = all_volumes + acs_common.collect_projects(
+            lambda cloudstack, projectid: collect_volumes(
+                cloudstack, projectid, args.page_size, args.page_workers),
+            cloudstack, projects, args.cross_project_query)
 
     # pprint.pprint(all_volumes)
 
-    filtered_volumes = filter_volumes(all_volumes, args)
+    with acs_profile.phase("filter"):
+        filtered_volumes = list(filter_volumes(all_volumes, args))
 
     print_volumes(filtered_volumes, outputfile)
 
@@ -7,7 +7,8 @@ import sys
 # import pprint
 import argparse
 import textwrap
-from cs import CloudStack, read_config
+import acs_client
+import acs_profile
 
 limit_data_list = [
         {
@@ -161,6 +162,8 @@ def prepare_arguments():
         dest='inputfile',
         help='Read limits from file.',
         required=False)
+    acs_client.add_arguments(
+        parser, with_async=False, with_cache=False, with_inventory=False)
     args = parser.parse_args()
 
     return args
@@ -179,18 +182,22 @@ def print_limits(projects, name_outputfile):
         limit_string += f'{limit_record["type"]};'
     outputfile.write(limit_string + '\n')
 
-    for project in sorted(projects, key=lambda key: (
+    with acs_profile.phase("sort"):
+        sorted_projects = sorted(projects, key=lambda key: (
             key["domain"],
-            key["name"])):
-        limit_string = (
-                f'{project["domain"]};{project["name"]};{project["id"]};')
-        for limit_record in limit_data_list:
-            if project[limit_record["key_limit"]] == "Unlimited":
-                limit = -1
-            else:
-                limit = project[limit_record["key_limit"]]
-            limit_string += f'{limit};'
-        outputfile.write(limit_string + '\n')
+            key["name"]))
+    with acs_profile.phase("write"):
+        for project in sorted_projects:
+            limit_string = (
+                    f'{project["domain"]};{project["name"]};'
+                    f'{project["id"]};')
+            for limit_record in limit_data_list:
+                if project[limit_record["key_limit"]] == "Unlimited":
+                    limit = -1
+                else:
+                    limit = project[limit_record["key_limit"]]
+                limit_string += f'{limit};'
+            outputfile.write(limit_string + '\n')
 
 
 def prepare_limit_matrix(input_file_name):
@@ -364,15 +371,17 @@ def main():
         sys.exit(1)
 
     # Reads ~/.cloudstack.ini
-    cs = CloudStack(**read_config())
+    cs = acs_client.get_cloudstack(args)
 
-    projects_container = cs.listProjects(listall=True)
+    with acs_profile.phase("collect"):
+        projects_container = cs.listProjects(listall=True)
     projects = projects_container["project"]
     if args.project_id:
-        projects_filtered = list(
-                filter(
-                    lambda project: project['id'] == args.project_id,
-                    projects))
+        with acs_profile.phase("filter"):
+            projects_filtered = list(
+                    filter(
+                        lambda project: project['id'] == args.project_id,
+                        projects))
         if projects_filtered == []:
             print(
                     f'Project id \"{args.project_id}\" is not valid, ' +
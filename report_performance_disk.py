@@ -3,10 +3,15 @@
 """ Create Report about Disk Performance. """
 
 import sys
-import pprint
+import json
+# import pprint
 import argparse
 import textwrap
-from cs import CloudStack, read_config
+import itertools
+import acs_client
+import acs_common
+import acs_profile
+import acs_records
 
 
 def prepare_arguments():
@@ -26,6 +31,18 @@ def prepare_arguments():
         Generate performance report:
             ./report_performance_disk.py.py
 
+        Fetch volumes in pages of 200, 8 pages at a time:
+            ./report_performance_disk.py.py --page-size 200 --page-workers 8
+
+        Write volumes as they arrive, keep the raw API records:
+            ./report_performance_disk.py.py --no-sort \\
+                --debug-dump volumes.jsonl
+
+        The 20 volumes with the most IOPS and the 5 busiest of each
+        storage pool:
+            ./report_performance_disk.py.py --top 20 --by iops
+            ./report_performance_disk.py.py --top 5 --by kbs --per storage
+
         Additional Infos:
 
         Uses the "CS" CloudStack API Client.
@@ -34,6 +51,9 @@ def prepare_arguments():
 
         Requires configuration file ~/.cloudstack.ini.
 
+        --top ranks the volumes while they arrive, by IO operations (iops)
+        or KB read and written (kbs, read, write).
+
         Todo:
 
         '''))
@@ -53,88 +73,201 @@ def prepare_arguments():
         dest='name_outputfile',
         help='Write output to file.',
         required=False)
+    parser.add_argument(
+        '--page-size',
+        dest='page_size',
+        help=f'Number of volumes fetched per API call '
+             f'(default: {acs_common.PAGESIZE}).',
+        type=int,
+        default=acs_common.PAGESIZE,
+        required=False)
+    parser.add_argument(
+        '--page-workers',
+        dest='page_workers',
+        help='Number of pages to fetch concurrently (default: 1).',
+        type=int,
+        default=1,
+        required=False)
+    parser.add_argument(
+        '--no-sort',
+        dest='no_sort',
+        help='Write volumes as they arrive instead of sorting them.',
+        action='store_true',
+        required=False)
+    parser.add_argument(
+        '--debug-dump',
+        dest='debug_dump',
+        help='Write the raw API records of the volumes to PATH as JSON '
+             'Lines.',
+        metavar='PATH',
+        required=False)
+    parser.add_argument(
+        '--top',
+        dest='top',
+        help='List only the N volumes with the highest disk counters.',
+        type=int,
+        metavar='N',
+        required=False)
+    parser.add_argument(
+        '--by',
+        dest='by',
+        help='Counters ranked by --top (default: iops).',
+        choices=acs_common.TOP_COUNTERS,
+        default='iops',
+        required=False)
+    parser.add_argument(
+        '--per',
+        dest='per',
+        help='With --top, rank the volumes of each cluster or storage pool.',
+        choices=['cluster', 'storage'],
+        required=False)
+    acs_client.add_arguments(parser)
     args = parser.parse_args()
 
+    if args.page_size < 1:
+        parser.error('--page-size must be at least 1.')
+    if args.page_workers < 1:
+        parser.error('--page-workers must be at least 1.')
+    if args.top is not None and args.top < 1:
+        parser.error('--top must be at least 1.')
+    if args.per is not None and args.top is None:
+        parser.error('--per needs --top.')
+
     return args
 
 
-def collect_volumes(cloudstack, projectid=""):
-    """ Collects all volumes for one project. """
+def collect_volumes(
+        cloudstack, projectid="", pagesize=acs_common.PAGESIZE,
+        page_workers=1, debug_dump=None):
+    """ Collects all volumes for one project. With debug_dump the raw API
+    records are written to this file as JSON Lines once the project is
+    complete. """
 
     if projectid != "":
-        volumes_container = cloudstack.listVolumesMetrics(
+        volumes = acs_common.fetch_pages_concurrently(
+            cloudstack, "listVolumesMetrics", "volume",
+            pagesize=pagesize,
+            workers=page_workers,
             listall=True,
             projectid=projectid)
     else:
-        volumes_container = cloudstack.listVolumesMetrics(listall=True)
-
-    if volumes_container != {}:
-        volumes = volumes_container["volume"]
-        for volume in volumes:
-            for key in [
-                    "project",
-                    "projectid",
-                    "diskofferingname",
-                    "vmname",
-                    "clustername",
-                    "storage",
-                    "path",
-                    "diskioread",
-                    "diskiowrite",
-                    "diskkbsread",
-                    "diskkbswrite"]:
-                if key not in volume:
-                    volume[key] = "n.a."
-            if volume["domain"] == "ROOT":
-                volume["domain"] = " ROOT"
-    else:
-        volumes = []
-
-    return volumes
+        volumes = acs_common.fetch_pages_concurrently(
+            cloudstack, "listVolumesMetrics", "volume",
+            pagesize=pagesize,
+            workers=page_workers,
+            listall=True)
+
+    project_volumes = []
+    raw_volumes = []
+    for volume in volumes:
+        if debug_dump is not None:
+            raw_volumes.append(json.dumps(volume))
+        volume = acs_records.VolumeStats(volume)
+        if volume.domain == "ROOT":
+            volume.domain = " ROOT"
+        project_volumes.append(volume)
+
+    if raw_volumes:
+        debug_dump.write(''.join(f'{line}\n' for line in raw_volumes))
+    return project_volumes
 
 
 def filter_volumes(all_volumes, args):
-    """ Filter set of volumes according to commandline parameters."""
-    filtered_volumes = all_volumes.copy()
+    """ Filter set of volumes according to commandline parameters. The
+    volumes are filtered while they are consumed."""
+    predicates = []
 
     if args.project:
-        filtered_volumes = filter(
-            lambda d: d["project"] == args.project, filtered_volumes)
+        predicates.append(lambda d: d["project"] == args.project)
     if args.storage:
-        filtered_volumes = filter(
-            lambda d: d["storage"] == args.storage, filtered_volumes)
-
-    return filtered_volumes
-
-
-def print_volumes(filtered_volumes, outputfile):
-    """ Printout list of volumes."""
-
-    filtered_volumes = list(filtered_volumes)
-
-    output_string = (
-        'Domain;Project;VM Name;Type;Cluster;Hypervisor;Storage;Name;' +
-        'Size [GB];Diskoffering;Path;' +
-        'diskioread;diskiowrite;diskkbsread;diskkbswrite\n')
-    outputfile.write(output_string)
-
-    pprint.pprint(filtered_volumes)
-    for volumes in sorted(filtered_volumes, key=lambda i: (
-            i["domain"],
-            i["project"],
-            i["name"])):
-        # pprint.pprint(volumes)
-        output_string = (
-            f'{volumes["domain"]};{volumes["project"]};'
-            f'{volumes["vmname"]};{volumes["type"]};{volumes["clustername"]};'
-            f'{volumes["hypervisor"]};'
-            f'{volumes["storage"]};{volumes["name"]};'
-            f'{int(volumes["size"]/1024**3)};{volumes["diskofferingname"]};'
-            f'{volumes["path"]};'
-            f'{volumes["diskioread"]};'
-            f'{volumes["diskiowrite"]};'
-            f'{volumes["diskkbsread"]};{volumes["diskkbswrite"]}')
-        outputfile.write(f'{output_string}\n')
+        predicates.append(lambda d: d["storage"] == args.storage)
+
+    return acs_profile.filtered(
+        all_volumes, lambda volume: all(
+            predicate(volume) for predicate in predicates))
+
+
+# CSV header of the volume lines
+VOLUME_HEADER = (
+    'Domain;Project;VM Name;Type;Cluster;Hypervisor;Storage;Name;'
+    'Size [GB];Diskoffering;Path;'
+    'diskioread;diskiowrite;diskkbsread;diskkbswrite')
+
+
+def format_volume(volume):
+    """ Format one volume as CSV line."""
+
+    return (
+        f'{volume["domain"]};{volume["project"]};'
+        f'{volume["vmname"]};'
+        f'{volume["type"]};{volume["clustername"]};'
+        f'{volume["hypervisor"]};'
+        f'{volume["storage"]};{volume["name"]};'
+        f'{int(volume["size"]/1024**3)};'
+        f'{volume["diskofferingname"]};'
+        f'{volume["path"]};'
+        f'{volume["diskioread"]};'
+        f'{volume["diskiowrite"]};'
+        f'{volume["diskkbsread"]};{volume["diskkbswrite"]}')
+
+
+def print_volumes(filtered_volumes, args, outputfile):
+    """ Printout list of volumes. The volumes are consumed one by one, for
+    sorting only the formatted lines are kept."""
+
+    outputfile.write(f'{VOLUME_HEADER}\n')
+
+    if args.no_sort:
+        with acs_profile.phase("write"):
+            for volume in filtered_volumes:
+                outputfile.write(f'{format_volume(volume)}\n')
+        return
+
+    volume_lines = []
+    # The volumes are collected while they are consumed.
+    with acs_profile.phase("collect"):
+        for volume in filtered_volumes:
+            volume_lines.append((
+                (volume["domain"], volume["project"], volume["name"]),
+                format_volume(volume)))
+
+    with acs_profile.phase("sort"):
+        volume_lines.sort(key=lambda i: i[0])
+    with acs_profile.phase("write"):
+        for _, volume_line in volume_lines:
+            outputfile.write(f'{volume_line}\n')
+
+
+def print_top_volumes(volumes, args, outputfile):
+    """ Printout the volumes with the highest counters, of all volumes or
+    per cluster or storage pool. The volumes are consumed one by one."""
+
+    counters = acs_common.TOP_COUNTERS[args.by]
+    groups = {
+        "cluster": lambda volume: volume["clustername"],
+        "storage": lambda volume: volume["storage"],
+    }
+
+    # The volumes are collected while they are consumed.
+    with acs_profile.phase("collect"):
+        top_volumes = acs_common.top_records(
+            volumes, args.top,
+            lambda volume: acs_common.counter_sum(volume, counters),
+            groups.get(args.per))
+
+    output_string = f'Rank;{args.by};{VOLUME_HEADER}'
+    if args.per is not None:
+        output_string = f'{args.per.capitalize()};{output_string}'
+    outputfile.write(f'{output_string}\n')
+    with acs_profile.phase("write"):
+        for name in sorted(top_volumes):
+            for rank, volume in enumerate(top_volumes[name], 1):
+                output_string = (
+                    f'{rank};{acs_common.counter_sum(volume, counters):.0f};'
+                    f'{format_volume(volume)}')
+                if args.per is not None:
+                    output_string = f'{name};{output_string}'
+                outputfile.write(f'{output_string}\n')
 
 
 def main():
@@ -147,24 +280,40 @@ def main():
         outputfile = sys.stdout
 
     # Reads ~/.cloudstack.ini
-    cloudstack = CloudStack(**read_config())
+    cloudstack = acs_client.get_cloudstack(args)
 
-    all_volumes = collect_volumes(cloudstack)
+    debug_dump = None
+    if args.debug_dump is not None:
+        debug_dump = open(args.debug_dump, 'w')
 
-    projects_container = cloudstack.listProjects(listall=True)
-    projects = projects_container["project"]
+    # Volumes of the projects are fetched while they are consumed.
+    with acs_profile.phase("collect"):
+        all_volumes = collect_volumes(
+            cloudstack, pagesize=args.page_size,
+            page_workers=args.page_workers, debug_dump=debug_dump)
 
-    for project in sorted(projects, key=lambda key: key["name"]):
-        project_id = project["id"]
-        all_volumes = all_volumes + collect_volumes(
-            cloudstack, project_id)
+        projects_container = cloudstack.listProjects(listall=True)
+        projects = projects_container["project"]
+
+        all_volumes = itertools.chain(
+            all_volumes,
+            acs_common.iter_projects(
+                lambda cloudstack, projectid: collect_volumes(
+                    cloudstack, projectid, args.page_size,
+                    args.page_workers, debug_dump),
+                cloudstack, projects))
 
     # pprint.pprint(all_volumes)
 
     filtered_volumes = filter_volumes(all_volumes, args)
 
-    print_volumes(filtered_volumes, outputfile)
+    if args.top is not None:
+        print_top_volumes(filtered_volumes, args, outputfile)
+    else:
+        print_volumes(filtered_volumes, args, outputfile)
 
+    if debug_dump is not None:
+        debug_dump.close()
     if args.name_outputfile is not None:
         outputfile.close()
 
@@ -4,10 +4,20 @@
 """ Create a Report about VM Utilization. """
 
 import sys
+import time
+import itertools
 # import pprint
 import argparse
 import textwrap
-from cs import CloudStack, read_config
+import acs_client
+import acs_common
+import acs_profile
+import acs_records
+
+# Cumulative disk counters of a VM
+COUNTERS = ("diskioread", "diskiowrite", "diskkbsread", "diskkbswrite")
+# Seconds between the two samples of --aggregate without --sample-interval
+AGGREGATE_INTERVAL = 60
 
 
 def prepare_arguments():
@@ -27,6 +37,29 @@ def prepare_arguments():
         List all VMs running on host acs-compute-7 with used storage space.
             ./report_performance_vm.py
 
+        Add CPU, memory and network utilisation of all running VMs:
+            ./report_performance_vm.py --only-running-vms --with-metrics
+
+        The 20 VMs with the most IOPS and the 5 busiest VMs of each host:
+            ./report_performance_vm.py --top 20 --by iops
+            ./report_performance_vm.py --top 5 --by kbs --per host
+
+        Disk IO rates of the last minute summed up per host, with the
+        share of the 3 VMs with the most IOPS on each host:
+            ./report_performance_vm.py --aggregate host
+
+        The same per cluster every 5 minutes until interrupted:
+            ./report_performance_vm.py --aggregate cluster \
+                --sample-interval 300
+
+        Print IOPS and KB/s of all running VMs every 30 seconds until
+        interrupted:
+            ./report_performance_vm.py --sample-interval 30
+
+        Sample the VMs of one host 10 times a minute apart:
+            ./report_performance_vm.py --host acs-compute-7 \\
+                --sample-interval 60 --samples 10
+
         Additional Infos:
 
         Uses the "CS" CloudStack API Client.
@@ -35,6 +68,23 @@ def prepare_arguments():
 
         Requires configuration file ~/.cloudstack.ini.
 
+        The disk counters are cumulative. With --sample-interval the stats
+        of all running VMs are polled with two list calls per sample and
+        the rates between two samples are printed. A counter lower than in
+        the sample before was reset and counts from zero. After a migration
+        the counters of the new host are unrelated, the rates are "n.a.".
+        CloudStack updates the counters every vm.stats.interval, shorter
+        sample intervals show zero rates in between.
+
+        --top ranks the VMs while they arrive, by IO operations (iops) or
+        KB read and written (kbs, read, write) since VM start.
+
+        --aggregate sums up the rates of the running VMs per host or
+        cluster for each sample interval, by default for one interval of
+        60 seconds. Migrated VMs are left out of their interval. "Top 3
+        Share" is the part of the --by rates of the host or cluster caused
+        by its 3 busiest VMs. Requires NumPy, "pip install numpy".
+
         Todo:
 
         '''))
@@ -66,86 +116,455 @@ def prepare_arguments():
         dest='name_outputfile',
         help='Write output to file.',
         required=False)
+    parser.add_argument(
+        '--with-metrics',
+        dest='with_metrics',
+        help='Use listVirtualMachinesMetrics and add CPU used, free '
+             'internal memory and network KBs read/write.',
+        action='store_true',
+        required=False)
+    parser.add_argument(
+        '--top',
+        dest='top',
+        help='List only the N VMs with the highest disk counters.',
+        type=int,
+        metavar='N',
+        required=False)
+    parser.add_argument(
+        '--by',
+        dest='by',
+        help='Counters ranked by --top (default: iops).',
+        choices=acs_common.TOP_COUNTERS,
+        default='iops',
+        required=False)
+    parser.add_argument(
+        '--per',
+        dest='per',
+        help='With --top, rank the VMs of each host or cluster.',
+        choices=['host', 'cluster'],
+        required=False)
+    parser.add_argument(
+        '--aggregate',
+        dest='aggregate',
+        help='Sum up the disk IO rates of the running VMs per host or '
+             'cluster (default: one interval of '
+             f'{AGGREGATE_INTERVAL} seconds).',
+        choices=['host', 'cluster'],
+        required=False)
+    parser.add_argument(
+        '--sample-interval',
+        dest='sample_interval',
+        help='Poll the disk counters every SECONDS and print the rates of '
+             'each interval.',
+        type=float,
+        metavar='SECONDS',
+        required=False)
+    parser.add_argument(
+        '--samples',
+        dest='samples',
+        help='With --sample-interval, stop after this many intervals '
+             '(default: run until interrupted).',
+        type=int,
+        default=0,
+        required=False)
+    acs_client.add_arguments(parser)
     args = parser.parse_args()
 
+    if args.aggregate is not None and args.top is not None:
+        parser.error('--aggregate can not be combined with --top.')
+    if args.aggregate is not None and args.sample_interval is None:
+        args.sample_interval = AGGREGATE_INTERVAL
+        if args.samples == 0:
+            args.samples = 1
+
+    if args.sample_interval is not None:
+        if args.sample_interval <= 0:
+            parser.error('--sample-interval must be above 0.')
+        if args.from_db is not None:
+            parser.error('--sample-interval needs the API, not --from-db.')
+        if args.only_stopped_vms:
+            parser.error('--sample-interval samples only running VMs.')
+        if args.with_metrics:
+            parser.error(
+                '--with-metrics can not be combined with --sample-interval '
+                'or --aggregate.')
+    if args.samples < 0:
+        parser.error('--samples must not be negative.')
+    if args.top is not None:
+        if args.top < 1:
+            parser.error('--top must be at least 1.')
+        if args.sample_interval is not None:
+            parser.error('--top can not be combined with --sample-interval.')
+    elif args.per is not None:
+        parser.error('--per needs --top.')
+
     return args
 
 
-def collect_vms(cs, projectid=""):
-    """ Collects all VMs for one project. """
+def collect_vms(cs, projectid="", vm_filters=None, with_metrics=False):
+    """ Collects all VMs for one project. Optional vm_filters are passed to
+    listVirtualMachines. With metrics listVirtualMachinesMetrics adds CPU,
+    memory and network utilisation in the same call. """
+
+    if vm_filters is None:
+        vm_filters = {}
+
+    if with_metrics:
+        list_command = cs.listVirtualMachinesMetrics
+        record_class = acs_records.VirtualMachineMetrics
+    else:
+        list_command = cs.listVirtualMachines
+        record_class = acs_records.VirtualMachineStats
 
     project_vms = []
     if projectid != "":
-        vms_container = cs.listVirtualMachines(
+        vms_container = list_command(
             listall=True,
-            projectid=projectid)
+            projectid=projectid,
+            **vm_filters)
     else:
-        vms_container = cs.listVirtualMachines(listall=True)
+        vms_container = list_command(listall=True, **vm_filters)
 
     if vms_container != {}:
-        project_vms = vms_container["virtualmachine"]
-        for my_vm in project_vms:
-            for key in [
-                    "project",
-                    "projectid",
-                    "hostname",
-                    ]:
-                if key not in my_vm:
-                    my_vm[key] = "n.a."
-            for key in [
-                    "diskioread",
-                    "diskiowrite",
-                    "diskkbsread",
-                    "diskkbswrite"
-                    ]:
-                if key not in my_vm:
-                    my_vm[key] = 0
+        project_vms = [
+            record_class(vm) for vm in vms_container["virtualmachine"]]
 
     return project_vms
 
 
+def prepare_vm_filters(args, hosts_dict):
+    """ Translate commandline parameters into listVirtualMachines
+    parameters, so the management server only returns matching VMs and
+    only the detail groups needed for the output."""
+    vm_filters = {"details": "servoff,stats"}
+    if args.only_running_vms:
+        vm_filters["state"] = "Running"
+    elif args.only_stopped_vms:
+        vm_filters["state"] = "Stopped"
+    if args.host in hosts_dict and hosts_dict[args.host][0] != "n.a.":
+        vm_filters["hostid"] = hosts_dict[args.host][0]
+
+    return vm_filters
+
+
 def filter_vms(all_vms, args):
-    """ Filter set of VMs according to commandline parameters."""
-    filtered_vms = all_vms.copy()
+    """ Filter set of VMs according to commandline parameters. The VMs are
+    filtered while they are consumed."""
+    predicates = []
     if args.only_running_vms:
-        filtered_vms = filter(lambda d: d["state"] == "Running", filtered_vms)
+        predicates.append(lambda d: d["state"] == "Running")
     if args.only_stopped_vms:
-        filtered_vms = filter(lambda d: d["state"] == "Stopped", filtered_vms)
+        predicates.append(lambda d: d["state"] == "Stopped")
     # pprint.pprint(args.host)
     if args.host is not None:
-        filtered_vms = filter(
-            lambda d: d["hostname"] == args.host, filtered_vms)
+        predicates.append(lambda d: d["hostname"] == args.host)
     if args.project is not None:
-        filtered_vms = filter(
-            lambda d: d["project"] == args.project, filtered_vms)
-
-    return filtered_vms
+        predicates.append(lambda d: d["project"] == args.project)
 
+    return acs_profile.filtered(
+        all_vms, lambda vm: all(
+            predicate(vm) for predicate in predicates))
 
-def print_vms(filtered_vms, outputfile, hosts_dict):
-    """ Printout list of VMs."""
 
-    filtered_vms = list(filtered_vms)
+def vm_header(args):
+    """ CSV header of the VM lines."""
 
     output_string = (
             'Domain;Project;Name;Instancename;State;'
             'Cluster;Hostname;CPUs;RAM [GB];'
             'Disk IO Read;Disk IO Write;Disk KBs Read;Disk KBs Write')
-    outputfile.write(f'{output_string}\n')
+    if args.with_metrics:
+        output_string = (
+            output_string +
+            ';CPU Used;Memory Internal Free [KB];'
+            'Network KBs Read;Network KBs Write')
+    return output_string
+
+
+def format_vm(vm, args, hosts_dict):
+    """ Format one VM as CSV line."""
+
+    output_string = (
+        f'{vm["domain"]};{vm["project"]};{vm["name"]};'
+        f'{vm["instancename"]};{vm["state"]};'
+        f'{hosts_dict[vm["hostname"]][1]};{vm["hostname"]};'
+        f'{vm["cpunumber"]};{float(round(vm["memory"]/1024,1))};'
+        f'{vm["diskioread"]};{vm["diskiowrite"]};'
+        f'{float(vm["diskkbsread"]):.0f};'
+        f'{float(vm["diskkbswrite"]):.0f}')
+    if args.with_metrics:
+        output_string = (
+            output_string +
+            f';{vm["cpuused"]};{vm["memoryintfreekbs"]};'
+            f'{vm["networkkbsread"]};{vm["networkkbswrite"]}')
+    return output_string
+
+
+def print_vms(filtered_vms, args, outputfile, hosts_dict):
+    """ Printout list of VMs."""
+
+    filtered_vms = list(filtered_vms)
 
-    for vm in sorted(filtered_vms, key=lambda i: (
+    outputfile.write(f'{vm_header(args)}\n')
+
+    with acs_profile.phase("sort"):
+        sorted_vms = sorted(filtered_vms, key=lambda i: (
             i["domain"],
             i["project"],
-            i["name"])):
+            i["name"]))
+    with acs_profile.phase("write"):
+        for vm in sorted_vms:
+            outputfile.write(f'{format_vm(vm, args, hosts_dict)}\n')
+
+
+def print_top_vms(vms, args, outputfile, hosts_dict):
+    """ Printout the VMs with the highest counters, of all VMs or per host
+    or cluster. The VMs are consumed one by one."""
+
+    counters = acs_common.TOP_COUNTERS[args.by]
+    groups = {
+        "host": lambda vm: vm["hostname"],
+        "cluster": lambda vm: hosts_dict.get(
+            vm["hostname"], ["n.a.", "n.a."])[1],
+    }
+    group = groups.get(args.per)
+
+    # The VMs are collected while they are consumed.
+    with acs_profile.phase("collect"):
+        top_vms = acs_common.top_records(
+            vms, args.top,
+            lambda vm: acs_common.counter_sum(vm, counters), group)
+
+    output_string = f'Rank;{args.by};{vm_header(args)}'
+    if args.per is not None:
+        output_string = f'{args.per.capitalize()};{output_string}'
+    outputfile.write(f'{output_string}\n')
+    with acs_profile.phase("write"):
+        for name in sorted(top_vms):
+            for rank, vm in enumerate(top_vms[name], 1):
+                output_string = (
+                    f'{rank};{acs_common.counter_sum(vm, counters):.0f};'
+                    f'{format_vm(vm, args, hosts_dict)}')
+                if args.per is not None:
+                    output_string = f'{name};{output_string}'
+                outputfile.write(f'{output_string}\n')
+
+
+def import_numpy():
+    """ Import the optional dependency NumPy, exits with a message if it
+    is missing."""
+
+    try:
+        import numpy  # pylint: disable=import-outside-toplevel
+    except ImportError:
+        sys.exit('--aggregate requires NumPy, install it with '
+                 '"pip install numpy".')
+    return numpy
+
+
+def aggregate_vms(numpy, groups, counters, ranked):
+    """ Sums up the counters of the VMs per group in one vectorized pass.
+    groups holds the group of each VM, counters one row of counters per
+    VM and ranked the value the VMs of a group are ranked by. Returns the
+    group names, the number of VMs, the counter sums and the share of the
+    3 highest ranked VMs of each group. """
+
+    names, inverse = numpy.unique(groups, return_inverse=True)
+    vm_counts = numpy.bincount(inverse, minlength=len(names))
+    sums = numpy.stack([
+        numpy.bincount(inverse, weights=column, minlength=len(names))
+        for column in counters.T], axis=1)
+
+    # Order the VMs by group and descending rank, then number them
+    # within their group.
+    order = numpy.lexsort((-ranked, inverse))
+    starts = numpy.concatenate(([0], numpy.cumsum(vm_counts)[:-1]))
+    positions = numpy.arange(len(order)) - starts[inverse[order]]
+    top = order[positions < 3]
+    top_sums = numpy.bincount(
+        inverse[top], weights=ranked[top], minlength=len(names))
+    totals = numpy.bincount(inverse, weights=ranked, minlength=len(names))
+    shares = numpy.divide(
+        top_sums, totals, out=numpy.zeros(len(names)), where=totals > 0)
+
+    return names, vm_counts, sums, shares
+
+
+def aggregate_header(args):
+    """ CSV header of the rates summed up per host or cluster."""
+
+    output_string = (
+        'Interval [s];VMs;Disk IO Read/s;Disk IO Write/s;Disk KBs Read/s;'
+        f'Disk KBs Write/s;Top 3 Share {args.by} [%]')
+    if args.aggregate == "host":
+        return f'Time;Cluster;Host;{output_string}'
+    return f'Time;Cluster;{output_string}'
+
+
+def print_aggregates(
+        numpy, vm_rates, args, outputfile, hosts_dict, timestamp, interval):
+    """ Printout the disk IO rates of one sample interval summed up per
+    host or cluster with the share of the 3 busiest VMs. vm_rates holds
+    (VM, rates) for each VM."""
+
+    ranked_columns = [
+        COUNTERS.index(counter)
+        for counter in acs_common.TOP_COUNTERS[args.by]]
+    groups = []
+    rate_rows = []
+    for vm, rates in vm_rates:
+        if rates is None or vm["hostname"] == "n.a.":
+            continue
+        cluster = hosts_dict.get(vm["hostname"], ["n.a.", "n.a."])[1]
+        if args.aggregate == "host":
+            groups.append(f'{cluster};{vm["hostname"]}')
+        else:
+            groups.append(cluster)
+        rate_rows.append(rates)
+    if not groups:
+        return
+
+    with acs_profile.phase("filter"):
+        rate_rows = numpy.array(rate_rows, dtype=float)
+        names, vm_counts, sums, shares = aggregate_vms(
+            numpy, numpy.array(groups), rate_rows,
+            rate_rows[:, ranked_columns].sum(axis=1))
+    with acs_profile.phase("write"):
+        for name, vm_count, row, share in zip(
+                names, vm_counts, sums, shares):
+            rates_string = ';'.join(f'{value:.1f}' for value in row)
+            outputfile.write(
+                f'{timestamp};{name};{interval:.1f};{vm_count};'
+                f'{rates_string};{share * 100:.1f}\n')
+        outputfile.flush()
+
+
+def collect_vm_stats(cs, projectid="", vm_filters=None):
+    """ Collects the disk counters of all VMs for one project."""
+
+    if vm_filters is None:
+        vm_filters = {}
+
+    if projectid != "":
+        vms = acs_common.fetch_pages(
+            cs, "listVirtualMachines", "virtualmachine",
+            listall=True,
+            projectid=projectid,
+            **vm_filters)
+    else:
+        vms = acs_common.fetch_pages(
+            cs, "listVirtualMachines", "virtualmachine",
+            listall=True,
+            **vm_filters)
+
+    return [acs_records.VirtualMachineStats(vm) for vm in vms]
+
+
+def sample_vms(cs, args, projects, vm_filters):
+    """ One sample of the disk counters of the VMs, by VM id. Without
+    --project all projects are fetched with one call."""
+
+    vms = []
+    if args.project is None or args.project == "n.a.":
+        vms = collect_vm_stats(cs, vm_filters=vm_filters)
+    vms = vms + acs_common.collect_projects(
+        lambda cs, projectid: collect_vm_stats(cs, projectid, vm_filters),
+        cs, projects, cross_project_query=args.project is None)
+
+    return {vm["id"]: vm for vm in filter_vms(vms, args)}
+
+
+def counter_rates(previous, current, interval):
+    """ Rates per second of the disk counters of a VM between two samples.
+    Counters going backwards were reset and count from zero. Returns None
+    after a migration, the counters of the new host are unrelated."""
+
+    if previous["hostid"] != current["hostid"]:
+        return None
+    rates = []
+    for counter in COUNTERS:
+        delta = float(current[counter]) - float(previous[counter])
+        if delta < 0:
+            delta = float(current[counter])
+        rates.append(delta / interval)
+    return rates
+
+
+def print_vm_rates(vm_rates, outputfile, hosts_dict, timestamp, interval):
+    """ Printout the disk IO rates of each VM for one sample interval.
+    vm_rates holds (VM, rates) for each VM."""
+
+    vm_lines = []
+    for vm, rates in vm_rates:
+        if rates is None:
+            rates_string = 'n.a.;n.a.;n.a.;n.a.'
+        else:
+            rates_string = ';'.join(f'{rate:.1f}' for rate in rates)
+        vm_lines.append((
+            (vm["domain"], vm["project"], vm["name"]),
+            f'{timestamp};{vm["domain"]};{vm["project"]};{vm["name"]};'
+            f'{hosts_dict.get(vm["hostname"], ["", "n.a."])[1]};'
+            f'{vm["hostname"]};{interval:.1f};{rates_string}'))
+
+    with acs_profile.phase("sort"):
+        vm_lines.sort(key=lambda i: i[0])
+    with acs_profile.phase("write"):
+        for _, vm_line in vm_lines:
+            outputfile.write(f'{vm_line}\n')
+        outputfile.flush()
+
+
+def print_rates(cs, args, projects, outputfile, hosts_dict, numpy=None):
+    """ Poll the disk counters of the running VMs every sample interval
+    and print the rates of each interval, with --aggregate summed up per
+    host or cluster."""
+
+    vm_filters = prepare_vm_filters(args, hosts_dict)
+    vm_filters["details"] = "stats"
+    vm_filters["state"] = "Running"
+    # Polled counters must not come from the response cache.
+    cs.cache = None
+
+    if args.aggregate is not None:
+        output_string = aggregate_header(args)
+    else:
         output_string = (
-            f'{vm["domain"]};{vm["project"]};{vm["name"]};'
-            f'{vm["instancename"]};{vm["state"]};'
-            f'{hosts_dict[vm["hostname"]][1]};{vm["hostname"]};'
-            f'{vm["cpunumber"]};{float(round(vm["memory"]/1024,1))};'
-            f'{vm["diskioread"]};{vm["diskiowrite"]};'
-            f'{float(vm["diskkbsread"]):.0f};'
-            f'{float(vm["diskkbswrite"]):.0f}')
-        outputfile.write(f'{output_string}\n')
+            'Time;Domain;Project;Name;Cluster;Hostname;Interval [s];'
+            'Disk IO Read/s;Disk IO Write/s;Disk KBs Read/s;'
+            'Disk KBs Write/s')
+    outputfile.write(f'{output_string}\n')
+
+    previous = {}
+    previous_time = None
+    sample = 0
+    try:
+        while args.samples == 0 or sample <= args.samples:
+            if previous_time is not None:
+                time.sleep(max(
+                    0.0,
+                    previous_time + args.sample_interval - time.monotonic()))
+            sample_time = time.monotonic()
+            with acs_profile.phase("collect"):
+                current = sample_vms(cs, args, projects, vm_filters)
+            interval = sample_time - (previous_time or sample_time)
+            timestamp = time.strftime("%Y-%m-%d %H:%M:%S")
+
+            vm_rates = [
+                (vm, counter_rates(previous[vm_id], vm, interval))
+                for vm_id, vm in current.items() if vm_id in previous]
+            if args.aggregate is None:
+                print_vm_rates(
+                    vm_rates, outputfile, hosts_dict, timestamp, interval)
+            else:
+                print_aggregates(
+                    numpy, vm_rates, args, outputfile, hosts_dict,
+                    timestamp, interval)
+
+            previous = current
+            previous_time = sample_time
+            sample = sample + 1
+    except KeyboardInterrupt:
+        pass
 
 
 def list_hosts(cs):
@@ -177,24 +596,78 @@ def main():
         outputfile = sys.stdout
 
     # Reads ~/.cloudstack.ini
-    cs = CloudStack(**read_config())
+    cs = acs_client.get_cloudstack(args)
 
-    all_vms = collect_vms(cs)
-
-    projects_container = cs.listProjects(listall=True)
-    projects = projects_container["project"]
-
-    for project in sorted(projects, key=lambda key: key["name"]):
-        project_id = project["id"]
-        all_vms = all_vms + collect_vms(
-            cs, project_id)
+    if args.aggregate is not None:
+        numpy = import_numpy()
+    else:
+        numpy = None
+
+    if args.sample_interval is not None:
+        with acs_profile.phase("collect"):
+            hosts_dict = list_hosts(cs)
+            projects = cs.listProjects(listall=True)["project"]
+            if args.project is not None:
+                projects = [
+                    project for project in projects
+                    if project["name"] == args.project]
+        print_rates(cs, args, projects, outputfile, hosts_dict, numpy)
+        if args.name_outputfile is not None:
+            outputfile.close()
+        return
+
+    if args.top is not None:
+        with acs_profile.phase("collect"):
+            hosts_dict = list_hosts(cs)
+            vm_filters = prepare_vm_filters(args, hosts_dict)
+            projects = cs.listProjects(listall=True)["project"]
+            if args.project is not None:
+                projects = [
+                    project for project in projects
+                    if project["name"] == args.project]
+            vm_sources = []
+            if args.project is None or args.project == "n.a.":
+                vm_sources.append(collect_vms(
+                    cs, vm_filters=vm_filters,
+                    with_metrics=args.with_metrics))
+            vm_sources.append(acs_common.iter_projects(
+                lambda cs, projectid: collect_vms(
+                    cs, projectid, vm_filters, args.with_metrics),
+                cs, projects))
+        all_vms = itertools.chain.from_iterable(vm_sources)
+        print_top_vms(
+            filter_vms(all_vms, args), args, outputfile, hosts_dict)
+        if args.name_outputfile is not None:
+            outputfile.close()
+        return
+
+    with acs_profile.phase("collect"):
+        hosts_dict = list_hosts(cs)
+        vm_filters = prepare_vm_filters(args, hosts_dict)
+
+        # VMs without project are listed with project "n.a.".
+        all_vms = []
+        if args.project is None or args.project == "n.a.":
+            all_vms = collect_vms(
+                cs, vm_filters=vm_filters, with_metrics=args.with_metrics)
+
+        projects_container = cs.listProjects(listall=True)
+        projects = projects_container["project"]
+        if args.project is not None:
+            projects = [
+                project for project in projects
+                if project["name"] == args.project]
+
+        all_vms = all_vms + acs_common.collect_projects(
+            lambda cs, projectid: collect_vms(
+                cs, projectid, vm_filters, args.with_metrics),
+            cs, projects)
 
     # pprint.pprint(all_vms)
     filtered_vms = filter_vms(all_vms, args)
 
-    hosts_dict = list_hosts(cs)
     # pprint.pprint(all_hosts)
-    print_vms(filtered_vms, outputfile, hosts_dict)
+    print_vms(filtered_vms, args, outputfile, hosts_dict)
 
     if args.name_outputfile is not None:
         outputfile.close()
@@ -0,0 +1,118 @@
+""" crawl_inventory.py against the mock API of benchmark/mock_cloudstack.py,
+with the response cache enabled. """
+
+import os
+import sys
+import sqlite3
+import tempfile
+import threading
+import subprocess
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "benchmark"))
+
+import mock_cloudstack  # noqa: E402  pylint: disable=wrong-import-position
+
+
+class CrawlAroundChurnTest(unittest.TestCase):
+    """ Crawls before and after VMs were expunged and deployed must leave
+    the current VMs in the inventory, not the cached ones. """
+
+    def setUp(self):
+        self.server = mock_cloudstack.MockServer(
+            ("127.0.0.1", 0),
+            mock_cloudstack.build_cloud(projects=3, vms_per_project=4))
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.database = os.path.join(self.tmpdir.name, "inventory.sqlite")
+
+    def tearDown(self):
+        mock_cloudstack.UTC_OFFSET = 0
+        self.server.shutdown()
+        self.server.server_close()
+        self.tmpdir.cleanup()
+
+    def crawl(self, *options):
+        """ Run crawl_inventory.py with the cache enabled."""
+
+        env = dict(
+            os.environ,
+            CLOUDSTACK_ENDPOINT=(
+                f'http://127.0.0.1:{self.server.server_port}/client/api'),
+            CLOUDSTACK_KEY="key",
+            CLOUDSTACK_SECRET="secret",
+            ACS_TOOLS_CACHE="1")
+        subprocess.run(
+            [sys.executable, os.path.join(ROOT, "crawl_inventory.py"),
+             "--database", self.database,
+             "--cache-file", os.path.join(self.tmpdir.name, "cache.sqlite"),
+             *options],
+            env=env, check=True, capture_output=True)
+
+    def churn(self):
+        """ Expunge and deploy some VMs in the mock."""
+
+        with self.server.lock:
+            self.server.vm_number = mock_cloudstack.churn(
+                self.server.cloud, self.server.rnd, self.server.vm_number,
+                3, 3, 2)
+
+    def expunge_newest_vm(self):
+        """ Expunge the VM deployed last, like churn() does."""
+
+        with self.server.lock:
+            cloud = self.server.cloud
+            vm = cloud["virtualmachine"][-1]
+            cloud["virtualmachine"] = cloud["virtualmachine"][:-1]
+            cloud["volume"] = [
+                volume for volume in cloud["volume"]
+                if volume.get("virtualmachineid") != vm["id"]]
+            mock_cloudstack.add_event(
+                cloud, "VM.DESTROY", vm, "VirtualMachine")
+            mock_cloudstack.add_event(
+                cloud, "VM.EXPUNGE", vm, "VirtualMachine")
+
+    def assert_inventory_current(self):
+        """ The inventory holds exactly the VMs and volumes of the mock."""
+
+        db = sqlite3.connect(self.database)
+        try:
+            for kind in ("virtualmachine", "volume"):
+                stored = {row[0] for row in db.execute(
+                    f'SELECT id FROM {kind}')}
+                current = {record["id"] for record in self.server.cloud[kind]}
+                self.assertEqual(stored, current, kind)
+        finally:
+            db.close()
+
+    def test_full_crawl(self):
+        self.crawl()
+        self.churn()
+        self.crawl()
+        self.assert_inventory_current()
+
+    def test_incremental_sync(self):
+        self.crawl()
+        self.churn()
+        self.crawl("--incremental")
+        self.assert_inventory_current()
+        # The first sync fetched the new VM by id, the second must not get
+        # this response again.
+        self.expunge_newest_vm()
+        self.crawl("--incremental")
+        self.assert_inventory_current()
+
+    def test_incremental_sync_west_of_utc(self):
+        # The dates of a management server 5 hours behind UTC are hours
+        # before the UTC time of this host.
+        mock_cloudstack.UTC_OFFSET = -5 * 3600
+        self.churn()
+        self.crawl()
+        self.churn()
+        self.crawl("--incremental")
+        self.assert_inventory_current()
+
+
+if __name__ == "__main__":
+    unittest.main()